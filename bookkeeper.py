@@ -11,6 +11,7 @@ from sqlalchemy.engine.base import Connection
 import uvicorn
 import datetime
 import logging
+from typing import Any, Callable, Dict, List, Tuple, Union
 
 # 3rd party
 import daiquiri
@@ -24,6 +25,7 @@ from starlette.config import Config
 from starlette.datastructures import URL, Secret
 import databases
 import sqlalchemy
+from sqlalchemy.dialects import postgresql
 import hupper
 
 # App-specific includes
@@ -266,42 +268,46 @@ async def register_dicom(request) -> JSONResponse:
     return JSONResponse({"ok": ""}, background=tasks)
 
 
+def series_tags_values(payload) -> Dict[str, Any]:
+    """Helper function that extracts the series information from the payload sent by the router."""
+    return dict(
+        series_uid=payload.get("SeriesInstanceUID", ""),
+        tag_patientname=payload.get("PatientName", ""),
+        tag_patientid=payload.get("PatientID", ""),
+        tag_accessionnumber=payload.get("AccessionNumber", ""),
+        tag_seriesnumber=payload.get("SeriesNumber", ""),
+        tag_studyid=payload.get("StudyID", ""),
+        tag_patientbirthdate=payload.get("PatientBirthDate", ""),
+        tag_patientsex=payload.get("PatientSex", ""),
+        tag_acquisitiondate=payload.get("AcquisitionDate", ""),
+        tag_acquisitiontime=payload.get("AcquisitionTime", ""),
+        tag_modality=payload.get("Modality", ""),
+        tag_bodypartexamined=payload.get("BodyPartExamined", ""),
+        tag_studydescription=payload.get("StudyDescription", ""),
+        tag_seriesdescription=payload.get("SeriesDescription", ""),
+        tag_protocolname=payload.get("ProtocolName", ""),
+        tag_codevalue=payload.get("CodeValue", ""),
+        tag_codemeaning=payload.get("CodeMeaning", ""),
+        tag_sequencename=payload.get("SequenceName", ""),
+        tag_scanningsequence=payload.get("ScanningSequence", ""),
+        tag_sequencevariant=payload.get("SequenceVariant", ""),
+        tag_slicethickness=payload.get("SliceThickness", ""),
+        tag_contrastbolusagent=payload.get("ContrastBolusAgent", ""),
+        tag_referringphysicianname=payload.get("ReferringPhysicianName", ""),
+        tag_manufacturer=payload.get("Manufacturer", ""),
+        tag_manufacturermodelname=payload.get("ManufacturerModelName", ""),
+        tag_magneticfieldstrength=payload.get("MagneticFieldStrength", ""),
+        tag_deviceserialnumber=payload.get("DeviceSerialNumber", ""),
+        tag_softwareversions=payload.get("SoftwareVersions", ""),
+        tag_stationname=payload.get("StationName", ""),
+    )
+
+
 async def parse_and_submit_tags(payload) -> None:
     global connection
     """Helper function that reads series information from the request body."""
     try:
-        query = dicom_series.insert().values(
-            time=datetime.datetime.now(),
-            series_uid=payload.get("SeriesInstanceUID", ""),
-            tag_patientname=payload.get("PatientName", ""),
-            tag_patientid=payload.get("PatientID", ""),
-            tag_accessionnumber=payload.get("AccessionNumber", ""),
-            tag_seriesnumber=payload.get("SeriesNumber", ""),
-            tag_studyid=payload.get("StudyID", ""),
-            tag_patientbirthdate=payload.get("PatientBirthDate", ""),
-            tag_patientsex=payload.get("PatientSex", ""),
-            tag_acquisitiondate=payload.get("AcquisitionDate", ""),
-            tag_acquisitiontime=payload.get("AcquisitionTime", ""),
-            tag_modality=payload.get("Modality", ""),
-            tag_bodypartexamined=payload.get("BodyPartExamined", ""),
-            tag_studydescription=payload.get("StudyDescription", ""),
-            tag_seriesdescription=payload.get("SeriesDescription", ""),
-            tag_protocolname=payload.get("ProtocolName", ""),
-            tag_codevalue=payload.get("CodeValue", ""),
-            tag_codemeaning=payload.get("CodeMeaning", ""),
-            tag_sequencename=payload.get("SequenceName", ""),
-            tag_scanningsequence=payload.get("ScanningSequence", ""),
-            tag_sequencevariant=payload.get("SequenceVariant", ""),
-            tag_slicethickness=payload.get("SliceThickness", ""),
-            tag_contrastbolusagent=payload.get("ContrastBolusAgent", ""),
-            tag_referringphysicianname=payload.get("ReferringPhysicianName", ""),
-            tag_manufacturer=payload.get("Manufacturer", ""),
-            tag_manufacturermodelname=payload.get("ManufacturerModelName", ""),
-            tag_magneticfieldstrength=payload.get("MagneticFieldStrength", ""),
-            tag_deviceserialnumber=payload.get("DeviceSerialNumber", ""),
-            tag_softwareversions=payload.get("SoftwareVersions", ""),
-            tag_stationname=payload.get("StationName", ""),
-        )
+        query = dicom_series.insert().values(time=datetime.datetime.now(), **series_tags_values(payload))
         connection.execute(query)
     except Exception as e:
         print(e)
@@ -343,6 +349,126 @@ async def post_series_event(request) -> JSONResponse:
     return JSONResponse({"ok": ""}, background=tasks)
 
 
+def mercure_event_values(payload) -> Dict[str, Any]:
+    return dict(
+        sender=payload.get("sender", "Unknown"),
+        event=payload.get("event", monitor.m_events.UNKNOWN),
+        severity=int(payload.get("severity", monitor.severity.INFO)),
+        description=payload.get("description", ""),
+    )
+
+
+def webgui_event_values(payload) -> Dict[str, Any]:
+    return dict(
+        sender=payload.get("sender", "Unknown"),
+        event=payload.get("event", monitor.w_events.UNKNOWN),
+        user=payload.get("user", "UNKNOWN"),
+        description=payload.get("description", ""),
+    )
+
+
+def dicom_file_values(payload) -> Dict[str, Any]:
+    return dict(
+        filename=payload.get("filename", ""),
+        file_uid=payload.get("file_uid", ""),
+        series_uid=payload.get("series_uid", ""),
+    )
+
+
+def dicom_series_file_values(payload) -> List[Dict[str, Any]]:
+    """Helper function that expands the files of a series registered by the router into one row per file."""
+    series_uid = payload.get("series_uid", "")
+    return [
+        dict(filename=file.get("filename", ""), file_uid=file.get("file_uid", ""), series_uid=series_uid)
+        for file in payload.get("files", [])
+    ]
+
+
+def series_event_values(payload) -> Dict[str, Any]:
+    return dict(
+        sender=payload.get("sender", "Unknown"),
+        event=payload.get("event", monitor.s_events.UNKNOWN),
+        series_uid=payload.get("series_uid", ""),
+        file_count=int(payload.get("file_count", 0)),
+        target=str(payload.get("target", "")),
+        info=str(payload.get("info", "")),
+    )
+
+
+# Event types that can be submitted via the bulk endpoint (named like the individual endpoints)
+# Table and conversion function for each event type. The conversion function returns either one row or a list of rows
+bulk_event_types: Dict[
+    str, Tuple[sqlalchemy.Table, Callable[[Dict], Union[Dict[str, Any], List[Dict[str, Any]]]]]
+] = {
+    "mercure-event": (mercure_events, mercure_event_values),
+    "webgui-event": (webgui_events, webgui_event_values),
+    "register-dicom": (dicom_files, dicom_file_values),
+    "register-dicom-series": (dicom_files, dicom_series_file_values),
+    "register-series": (dicom_series, series_tags_values),
+    "series-event": (series_events, series_event_values),
+}
+
+
+def parse_bulk_events(events: List[Dict]) -> Dict[str, List[Dict[str, Any]]]:
+    """Converts the list of submitted events into database rows, grouped by event type. Every event has the format
+    {"type": ..., "time": ..., "data": {...}}, where time is the UNIX timestamp when the event occurred."""
+    rows: Dict[str, List[Dict[str, Any]]] = {}
+    for event in events:
+        event_type = event.get("type", "")
+        if event_type not in bulk_event_types:
+            logger.warning(f"Invalid event type in bulk submission: {event_type}")
+            continue
+        try:
+            values = bulk_event_types[event_type][1](event.get("data", {}))
+            event_rows = values if isinstance(values, list) else [values]
+            if event.get("time"):
+                event_time = datetime.datetime.fromtimestamp(float(event["time"]))
+            else:
+                event_time = datetime.datetime.now()
+            for row in event_rows:
+                row["time"] = event_time
+        except Exception:
+            logger.exception(f"Invalid event in bulk submission: {event}")
+            continue
+        rows.setdefault(event_type, []).extend(event_rows)
+    return rows
+
+
+async def execute_db_bulk_operation(rows: Dict[str, List[Dict[str, Any]]]) -> None:
+    """Writes the rows of a bulk submission into the database using multi-row inserts in one transaction."""
+    global connection
+    try:
+        with connection.begin():
+            for event_type, values in rows.items():
+                table = bulk_event_types[event_type][0]
+                if table is dicom_series:
+                    # Series can be registered repeatedly (e.g., if they have been sent twice), which must
+                    # not abort the transaction
+                    query = postgresql.insert(table).on_conflict_do_nothing(index_elements=["series_uid"])
+                else:
+                    query = table.insert()
+                connection.execute(query, values)
+    except Exception:
+        logger.exception("Unable to store bulk submission")
+
+
+@app.route("/bulk", methods=["POST"])
+async def post_bulk(request) -> JSONResponse:
+    """Endpoint for receiving multiple events of mixed type with one request. Used by the event queue of
+    the mercure services (see common.monitor)."""
+    try:
+        events = await request.json()
+        if not isinstance(events, list):
+            raise ValueError("List of events expected")
+    except Exception:
+        return JSONResponse({"error": "Invalid submission"}, status_code=400)
+
+    rows = parse_bulk_events(events)
+    tasks = BackgroundTasks()
+    tasks.add_task(execute_db_bulk_operation, rows=rows)
+    return JSONResponse({"ok": "", "received": sum(len(values) for values in rows.values())}, background=tasks)
+
+
 ###################################################################################
 ## Main entry function
 ###################################################################################
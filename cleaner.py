@@ -6,6 +6,8 @@ retention time has passed and if it is offpeak time. Offpeak is the time
 period when the cleaning has to be done, because cleaning I/O should be kept
 to minimum when receiving and sending exams.
 """
+import heapq
+import json
 import logging
 import os
 import signal
@@ -14,7 +16,8 @@ import time
 from datetime import timedelta, datetime
 from datetime import time as _time
 from pathlib import Path
-from shutil import rmtree
+from shutil import disk_usage, rmtree
+from typing import Dict, List, Optional, Set, Tuple
 import daiquiri
 import graphyte
 import hupper
@@ -22,6 +25,7 @@ import hupper
 import common.config as config
 import common.helper as helper
 import common.monitor as monitor
+from common.retention import JOURNAL, get_folder_size
 from common.monitor import send_series_event, s_events
 from common.constants import mercure_defs, mercure_folders
 
@@ -39,6 +43,18 @@ daiquiri.setup(
 logger = daiquiri.getLogger("cleaner")
 main_loop = None  # type: helper.RepeatedTimer # type: ignore
 
+# Interval for scanning the folders for entries missing in the retention journals (in seconds)
+RESCAN_INTERVAL = 86400
+# Size after which the journal files are rotated (in bytes)
+JOURNAL_ROTATE_SIZE = 1024 * 1024
+# Change of the reduced retention (relative to the last reported one) after which the reduction is reported again
+RETENTION_REPORT_CHANGE = 0.1
+
+# Reduced retention that has last been reported for each folder (None if the retention isn't reduced)
+reported_retention: Dict[str, Optional[int]] = {}
+# Budget for deleting outside of the off-peak hours, which is kept across the runs of the cleaner
+deletion_budget: Optional["DeletionBudget"] = None
+
 
 def terminate_process(signalNumber, frame) -> None:
     """Triggers the shutdown of the service."""
@@ -69,54 +85,246 @@ def clean(args) -> None:
         )
         return
 
-    # TODO: Adaptively reduce the retention time if the disk space is running low
-
-    if _is_offpeak(
+    offpeak = _is_offpeak(
         config.mercure.offpeak_start,
         config.mercure.offpeak_end,
         datetime.now().time(),
-    ):
-        success_folder = config.mercure.success_folder
-        discard_folder = config.mercure.discard_folder
-        retention = timedelta(seconds=config.mercure.retention)
-        clean_dir(success_folder, retention)
-        clean_dir(discard_folder, retention)
+    )
+
+    for folder in [config.mercure.success_folder, config.mercure.discard_folder]:
+        retention = get_retention(folder)
+        if offpeak:
+            clean_dir(folder, retention)
+        elif retention < timedelta(seconds=config.mercure.retention):
+            # The disk is running full, so clean also outside of the offpeak hours. Limit the deletion rate to avoid
+            # slowing down the reception and dispatching of images
+            clean_dir(folder, retention, get_deletion_budget())
 
 
 def _is_offpeak(offpeak_start: str, offpeak_end: str, current_time: _time) -> bool:
-    try:
-        start_time = datetime.strptime(offpeak_start, "%H:%M").time()
-        end_time = datetime.strptime(offpeak_end, "%H:%M").time()
-    except Exception as e:
-        logger.error("Error parsing offpeak time, please check configuration")
-        logger.exception(e)
-        return True
+    return helper.is_offpeak(offpeak_start, offpeak_end, current_time)
 
-    if start_time < end_time:
-        return current_time >= start_time and current_time <= end_time
-    # End time is after midnight
-    return current_time >= start_time or current_time <= end_time
 
+def get_free_space(folder: str) -> float:
+    """Returns the free space (in percent) of the disk on which the given folder is located."""
+    usage = disk_usage(folder)
+    if not usage.total:
+        return 100
+    return 100 * usage.free / usage.total
 
-def clean_dir(discard_folder, retention) -> None:
+
+def get_retention(folder: str) -> timedelta:
     """
-    Cleans the discard folder if it is older than the retention time, starting
-    from oldest first.
+    Returns the retention time for the given folder. If the free disk space falls below the low watermark, the
+    retention time is reduced linearly, down to the minimum retention time when reaching the critical watermark.
+    """
+    retention = config.mercure.retention
+    min_retention = min(config.mercure.cleaner_min_retention, retention)
+    low = config.mercure.cleaner_space_low
+    critical = min(config.mercure.cleaner_space_critical, low)
+
+    try:
+        free_space = get_free_space(folder)
+    except Exception:
+        logger.exception(f"Unable to determine free disk space for {folder}")
+        return timedelta(seconds=retention)
+    helper.g_log("disk.free_percent", free_space)
+
+    if free_space >= low:
+        if reported_retention.get(folder) is not None:
+            logger.info(f"Disk space for {folder} recovered ({free_space:.1f}% free), using full retention")
+            monitor.send_event(
+                monitor.m_events.PROCESSING,
+                monitor.severity.INFO,
+                f"Disk space recovered ({free_space:.1f}% free), using full retention",
+            )
+        reported_retention[folder] = None
+        return timedelta(seconds=retention)
+    if free_space <= critical:
+        reduced = min_retention
+    else:
+        reduced = int(min_retention + (retention - min_retention) * (free_space - critical) / (low - critical))
+
+    # Only report the reduction when the low watermark has been crossed or the retention has changed noticeably,
+    # instead of during every run of the cleaner
+    previous = reported_retention.get(folder)
+    if previous is None or abs(reduced - previous) > RETENTION_REPORT_CHANGE * previous or (
+        reduced == min_retention and previous != min_retention
+    ):
+        logger.warning(f"Low disk space for {folder} ({free_space:.1f}% free), reducing retention to {reduced} sec")
+        monitor.send_event(
+            monitor.m_events.PROCESSING,
+            monitor.severity.WARNING,
+            f"Low disk space ({free_space:.1f}% free), reducing retention to {reduced} sec",
+        )
+        reported_retention[folder] = reduced
+    return timedelta(seconds=reduced)
+
+
+class DeletionBudget:
     """
-    candidates = [
-        (f, f.stat().st_mtime)
-        for f in Path(discard_folder).iterdir()
-        if f.is_dir() and retention < timedelta(seconds=(time.time() - f.stat().st_mtime))
-    ]
-    oldest_first = sorted(candidates, key=lambda x: x[1], reverse=True)
-    for entry in oldest_first:
-        delete_folder(entry)
+    Limits the rate of deletions to the given number of bytes per second (unlimited if 0). The budget is refilled
+    continuously, up to the amount of one cleaning interval, so that it doesn't accumulate while nothing is deleted.
+    The cleaner never waits for the budget. Once the budget is used up, the deletion continues during the next run.
+    """
+
+    def __init__(self, bytes_per_second: int, interval: float) -> None:
+        self.bytes_per_second = bytes_per_second
+        self.interval = interval
+        self.allowance = bytes_per_second * interval
+        self.updated = time.monotonic()
+        self.deleted = 0
+
+    def is_available(self) -> bool:
+        """Checks if further data can be deleted within the budget."""
+        if self.bytes_per_second <= 0:
+            return True
+        now = time.monotonic()
+        self.allowance = min(
+            self.allowance + (now - self.updated) * self.bytes_per_second, self.bytes_per_second * self.interval
+        )
+        self.updated = now
+        return self.allowance > 0
+
+    def consume(self, size: int) -> None:
+        """Accounts for deleted data."""
+        self.deleted += size
+        if self.bytes_per_second > 0:
+            self.allowance -= size
+
+
+def get_deletion_budget() -> DeletionBudget:
+    """Returns the deletion budget, which is recreated if the settings have changed."""
+    global deletion_budget
+    if (
+        deletion_budget is None
+        or deletion_budget.bytes_per_second != config.mercure.cleaner_io_budget
+        or deletion_budget.interval != config.mercure.cleaner_scan_interval
+    ):
+        deletion_budget = DeletionBudget(config.mercure.cleaner_io_budget, config.mercure.cleaner_scan_interval)
+    return deletion_budget
 
 
-def delete_folder(entry) -> None:
+class RetentionJournal:
+    """
+    Folders contained in the success or discard folder, ordered by the time when they have been moved there. The
+    entries are read incrementally from the journal file written by the other services. As the entries are kept in
+    memory, the journal file is rotated once it has grown large. Folders that are missing in the journal (e.g., after
+    restarting the cleaner) are picked up by a full scan of the folder, using the modification time of the folder.
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        self.entries: List[Tuple[float, str, str, Optional[int]]] = []
+        self.known: Set[str] = set()
+        self.offset = 0
+        self.last_scan: float = 0
+
+    def add(self, entry_time: float, name: str, uid: str, size: Optional[int]) -> None:
+        if name in self.known:
+            return
+        self.known.add(name)
+        heapq.heappush(self.entries, (entry_time, name, uid, size))
+
+    def refresh(self) -> None:
+        """Reads the new journal entries and rescans the folder if the rescan interval has passed."""
+        journal_file = Path(self.folder) / JOURNAL
+        try:
+            if journal_file.stat().st_size < self.offset:
+                # The journal has been replaced
+                self.offset = 0
+            self.offset = self._read(journal_file, self.offset)
+            if self.offset > JOURNAL_ROTATE_SIZE:
+                self._rotate(journal_file)
+        except FileNotFoundError:
+            self.offset = 0
+        except Exception:
+            logger.exception(f"Unable to read retention journal {journal_file}")
+
+        if time.time() - self.last_scan >= RESCAN_INTERVAL:
+            self.scan()
+
+    def _read(self, journal_file: Path, offset: int) -> int:
+        """Adds the entries that have been appended since the given offset. Returns the offset after the last complete
+        entry (an entry might be incomplete if it's currently written)."""
+        with open(journal_file, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+                self.add(float(entry["time"]), entry["folder"], entry.get("uid", ""), entry.get("size"))
+            except Exception:
+                logger.warning(f"Invalid entry in retention journal {journal_file}: {line!r}")
+        return offset + end
+
+    def _rotate(self, journal_file: Path) -> None:
+        """Moves the journal aside, so that the services start a new journal file, and reads the entries that have been
+        appended in the meantime."""
+        rotated_file = journal_file.with_name(JOURNAL + ".old")
+        os.replace(journal_file, rotated_file)
+        self._read(rotated_file, self.offset)
+        rotated_file.unlink()
+        self.offset = 0
+
+    def scan(self) -> None:
+        """Adds all folders that are not contained in the journal."""
+        for entry in os.scandir(self.folder):
+            if entry.is_dir() and entry.name not in self.known:
+                self.add(entry.stat().st_mtime, entry.name, "", None)
+        self.last_scan = time.time()
+
+    def pop_expired(self, before: float) -> Optional[Tuple[float, str, str, Optional[int]]]:
+        """Removes and returns the oldest entry if it has been added before the given time."""
+        if not self.entries or self.entries[0][0] >= before:
+            return None
+        entry = heapq.heappop(self.entries)
+        self.known.discard(entry[1])
+        return entry
+
+
+journals: Dict[str, RetentionJournal] = {}
+
+
+def clean_dir(discard_folder, retention, budget: Optional[DeletionBudget] = None) -> None:
+    """
+    Cleans the discard folder if it is older than the retention time, starting
+    from oldest first. If a budget is given, the deletion rate is limited accordingly. The budget is checked
+    between the folders, and the remaining folders are deleted during the next runs once the budget is used up.
+    """
+    if discard_folder not in journals:
+        journals[discard_folder] = RetentionJournal(discard_folder)
+    journal = journals[discard_folder]
+    journal.refresh()
+
+    reclaimed = 0
+    before = time.time() - retention.total_seconds()
+    while not helper.is_terminated():
+        if budget and not budget.is_available():
+            break
+        entry = journal.pop_expired(before)
+        if entry is None:
+            break
+        _, name, uid, size = entry
+        delete_path = Path(discard_folder) / name
+        if not delete_path.exists():
+            continue
+        if size is None:
+            size = get_folder_size(delete_path) if budget else 0
+        delete_folder(delete_path, uid)
+        reclaimed += size
+        if budget:
+            budget.consume(size)
+
+    if reclaimed:
+        logger.info(f"Reclaimed {reclaimed} bytes in {discard_folder}")
+        helper.g_log("cleaner.reclaimed_bytes", reclaimed)
+
+
+def delete_folder(delete_path: Path, series_uid: str = "") -> None:
     """Deletes given folder."""
-    delete_path = entry[0]
-    series_uid = find_series_uid(delete_path)
+    series_uid = series_uid or find_series_uid(delete_path)
     try:
         rmtree(delete_path)
         logger.info(f"Deleted folder {delete_path} from {series_uid}")
@@ -172,6 +380,7 @@ def main(args=sys.argv[1:]) -> None:
     except Exception:
         logger.exception("Cannot start service. Going down.")
         sys.exit(1)
+    config.start_watcher()
 
     appliance_name = config.mercure.appliance_name
 
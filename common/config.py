@@ -8,10 +8,14 @@ mercure's configuration management, used by various mercure modules
 import json
 import logging
 import os
+import threading
+import time
 from pathlib import Path
 from typing_extensions import Literal
 import daiquiri
-from typing import Dict, cast
+from typing import Any, Dict, Optional, cast
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from watchdog.observers import Observer
 
 # App-specific includes
 import common.monitor as monitor
@@ -29,6 +33,20 @@ configuration_filename = (
     or os.path.realpath(os.path.dirname(os.path.realpath(__file__)) + "/../configuration")
 ) + "/mercure.json"
 
+# Version of the loaded configuration, which is increased whenever the configuration has been replaced, and the
+# version in which each section has changed the last time (all settings except targets, rules, and modules are
+# contained in the section "settings"). Caches derived from the configuration can be rebuilt for changed sections only
+configuration_version = 0
+section_versions: Dict[str, int] = {}
+SECTIONS = ["targets", "rules", "modules"]
+
+# Watcher for the configuration file. While the watcher is active, the file is only read after it has been modified
+# (and additionally every CHECK_INTERVAL seconds, in case a modification has been missed, e.g. on network drives)
+CHECK_INTERVAL = 60
+config_watcher: Optional[Any] = None
+config_modified = threading.Event()
+last_check: float = 0
+
 mercure_defaults = {
     "appliance_name": "master",
     "port": 104,
@@ -39,21 +57,34 @@ mercure_defaults = {
     "error_folder": "./error",
     "discard_folder": "./discard",
     "processing_folder": "./processing",
+    "incoming_series_folders": False,
     "router_scan_interval": 1,  # in seconds
+    "router_rescan_interval": 60,  # in seconds
+    "router_workers": 1,
     "dispatcher_scan_interval": 1,  # in seconds
+    "dispatcher_workers": 1,
+    "processing_slots": 1,
+    "processing_hard_limits": False,
     "cleaner_scan_interval": 60,  # in seconds
     "retention": 259200,  # in seconds (3 days)
+    "cleaner_min_retention": 3600,  # in seconds
+    "cleaner_space_low": 20,  # in percent
+    "cleaner_space_critical": 5,  # in percent
+    "cleaner_io_budget": 52428800,  # in bytes per second (50 MB/s)
     "retry_delay": 900,  # in seconds (15 min)
     "retry_max": 5,
+    "retry_max_delay": 14400,  # in seconds (4 hours)
     "series_complete_trigger": 60,  # in seconds
     "study_complete_trigger": 900,  # in seconds
     "study_forcecomplete_trigger": 5400,  # in seconds
     "graphite_ip": "",
     "graphite_port": 2003,
     "bookkeeper": "0.0.0.0:8080",
+    "bookkeeper_bulk_register": False,
     "offpeak_start": "22:00",
     "offpeak_end": "06:00",
     "process_runner": "docker",
+    "status_board": "./status.db",
     "targets": {},
     "rules": {},
     "modules": {},
@@ -77,10 +108,95 @@ def get_runner() -> str:
     return os.getenv("MERCURE_RUNNER", "systemd")
 
 
+class ConfigEventHandler(FileSystemEventHandler):
+    """Flags the configuration as modified if the configuration file has been written or replaced."""
+
+    def on_any_event(self, event: FileSystemEvent) -> None:
+        paths = [event.src_path, getattr(event, "dest_path", "")]
+        if configuration_filename in paths:
+            config_modified.set()
+
+
+def start_watcher() -> None:
+    """Starts watching the configuration file, so that read_config doesn't need to check the file on every call."""
+    global config_watcher
+    if config_watcher is not None:
+        return
+    try:
+        observer = Observer()
+        observer.schedule(ConfigEventHandler(), os.path.dirname(configuration_filename), recursive=False)
+        observer.daemon = True
+        observer.start()
+        config_watcher = observer
+        # Read the file once more, as it might have been modified before the watcher was started
+        config_modified.set()
+    except Exception:
+        logger.exception("Unable to watch configuration file, checking the file periodically instead")
+
+
+def stop_watcher() -> None:
+    global config_watcher
+    if config_watcher is not None:
+        config_watcher.stop()
+        config_watcher = None
+
+
+def get_section_version(section: str) -> int:
+    """Returns the configuration version in which the given section (targets, rules, modules, or settings) has
+    changed the last time."""
+    return section_versions.get(section, configuration_version)
+
+
+def get_sections(config: Config) -> Dict[str, Any]:
+    values = config.dict()
+    sections = {section: values.pop(section) for section in SECTIONS}
+    sections["settings"] = values
+    return sections
+
+
+def update_versions(previous: Optional[Config], current: Optional[Config]) -> None:
+    """Increases the configuration version and records which sections have changed. All sections are considered as
+    changed if one of the configurations isn't given."""
+    global configuration_version
+    configuration_version += 1
+    if previous is None or current is None:
+        for section in SECTIONS + ["settings"]:
+            section_versions[section] = configuration_version
+        return
+
+    previous_sections = get_sections(previous)
+    for section, values in get_sections(current).items():
+        if previous_sections.get(section) != values:
+            section_versions[section] = configuration_version
+
+
 def read_config() -> Config:
     """Reads the configuration settings (rules, targets, general settings) from the configuration file. The configuration will
     only be updated if the file has changed compared the the last function call. If the configuration file is locked by
-    another process, an exception will be raised."""
+    another process, an exception will be raised. The loaded configuration is replaced as a whole, so callers holding
+    a reference to the previous configuration will continue to see a consistent configuration."""
+    global last_check
+
+    # If the configuration file is watched, there is nothing to do unless the file has been modified
+    if (
+        config_watcher is not None
+        and configuration_timestamp
+        and not config_modified.is_set()
+        and time.monotonic() - last_check < CHECK_INTERVAL
+    ):
+        return mercure
+
+    config_modified.clear()
+    last_check = time.monotonic()
+    try:
+        return read_config_file()
+    except Exception:
+        # Try again during the next call
+        config_modified.set()
+        raise
+
+
+def read_config_file() -> Config:
     global mercure
     global configuration_timestamp
     configuration_file = Path(configuration_filename)
@@ -111,12 +227,16 @@ def read_config() -> Config:
             # Reset configuration to default values (to ensure all needed
             # keys are present in the configuration)
             merged: Dict = {**mercure_defaults, **loaded_config}
-            mercure = Config(**merged)
+            new_config = Config(**merged)
+            previous_config = globals().get("mercure")
+            mercure = new_config
 
             # TODO: Check configuration for errors (esp targets and rules)
 
-            # Check if directories exist
-            if not check_folders():
+            update_versions(previous_config, new_config)
+
+            # Check if directories exist (only needed if the folder settings might have changed)
+            if section_versions["settings"] == configuration_version and not check_folders():
                 raise FileNotFoundError("Configured folders missing")
 
             # logger.info("")
@@ -156,6 +276,8 @@ def save_config() -> None:
         configuration_timestamp = stat.st_mtime
     except AttributeError:
         configuration_timestamp = 0
+    # The configuration might have been modified in place before saving, so consider all sections as changed
+    update_versions(None, None)
 
     monitor.send_event(monitor.m_events.CONFIG_UPDATE, monitor.severity.INFO, "Saved new configuration.")
     logger.info(f"Stored configuration into: {configuration_file}")
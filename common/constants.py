@@ -19,6 +19,8 @@ class mercure_names:
     HALT = "HALT"
     TASKFILE = "task.json"
     SENDLOG = "sent.txt"
+    SENTFILES = ".sent_files"
+    RESENDFOLDER = ".resend"
     DCM = ".dcm"
     DCMFILTER = "*.dcm"
 
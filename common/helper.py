@@ -5,11 +5,16 @@ Various internal helper functions for mercure.
 """
 # Standard python includes
 import asyncio
+from datetime import datetime
+from datetime import time as _time
 from pathlib import Path
 import threading
 from typing import Callable, Optional
+import daiquiri
 import graphyte
 
+logger = daiquiri.getLogger("helper")
+
 
 # Global variable to broadcast when the process should terminate
 terminate = False
@@ -39,6 +44,23 @@ def g_log(*args, **kwargs) -> None:
     asyncio.run_coroutine_threadsafe(send_to_graphite(*args, **kwargs), loop)
 
 
+def is_offpeak(offpeak_start: str, offpeak_end: str, current_time: _time) -> bool:
+    """Checks if the given time is within the offpeak window. The window can span midnight. If the window has been
+    configured incorrectly, it is treated as offpeak time."""
+    try:
+        start_time = datetime.strptime(offpeak_start, "%H:%M").time()
+        end_time = datetime.strptime(offpeak_end, "%H:%M").time()
+    except Exception as e:
+        logger.error("Error parsing offpeak time, please check configuration")
+        logger.exception(e)
+        return True
+
+    if start_time < end_time:
+        return current_time >= start_time and current_time <= end_time
+    # End time is after midnight
+    return current_time >= start_time or current_time <= end_time
+
+
 class RepeatedTimer(object):
     """
     Helper class for running a continuous timer that is suspended
@@ -0,0 +1,94 @@
+"""
+manifest.py
+===========
+Manifest of the DICOM files of a case, which the router writes into the task file. It lists the names, sizes and SOP
+instance UIDs of the files, so that the other services can check if the files are present and count them without
+listing the folder. Task files without manifest (e.g., written by older versions or by processing modules) are
+handled by scanning the folder as before.
+"""
+
+# Standard python includes
+import json
+import os
+from pathlib import Path
+from typing import List, Optional, Union
+import daiquiri
+
+# App-specific includes
+from common.constants import mercure_names
+from common.types import ManifestEntry
+
+
+logger = daiquiri.getLogger("manifest")
+
+
+def create_manifest(folder: Union[str, Path], file_list: List[str]) -> List[ManifestEntry]:
+    """Returns the manifest for the given files (stems relative to the folder, as collected by the router). The SOP
+    instance UIDs are taken from the tags files written by getdcmtags."""
+    manifest: List[ManifestEntry] = []
+    for entry in file_list:
+        stem = Path(folder) / entry
+        try:
+            size = os.stat(str(stem) + mercure_names.DCM).st_size
+        except OSError:
+            size = 0
+        try:
+            with open(str(stem) + mercure_names.TAGS, "r") as json_file:
+                sop_uid = json.load(json_file).get("SOPInstanceUID", "")
+        except Exception:
+            logger.warning(f"Unable to read SOPInstanceUID from tags file of {entry}")
+            sop_uid = ""
+        manifest.append(ManifestEntry(name=os.path.basename(entry), size=size, sop_uid=sop_uid))
+    return manifest
+
+
+def read_manifest(folder: Union[str, Path]) -> Optional[List[ManifestEntry]]:
+    """Returns the manifest stored in the task file of the given folder, or None if there is none."""
+    try:
+        with open(Path(folder) / mercure_names.TASKFILE, "r") as json_file:
+            entries = json.load(json_file).get("manifest")
+        if entries is None:
+            return None
+        return [ManifestEntry(**entry) for entry in entries]
+    except Exception:
+        # Missing or invalid task files are reported by the services when reading the task
+        return None
+
+
+def has_dicom_files(folder: Union[str, Path], manifest: Optional[List[ManifestEntry]]) -> bool:
+    """Checks if the folder contains DICOM files. With a manifest, only the first listed file needs to be checked."""
+    if manifest:
+        return (Path(folder) / (manifest[0].name + mercure_names.DCM)).exists()
+    return next(Path(folder).glob(mercure_names.DCMFILTER), None) is not None
+
+
+def count_dicom_files(folder: Union[str, Path], manifest: Optional[List[ManifestEntry]]) -> int:
+    """Returns the number of DICOM files in the folder, as listed in the manifest (if available)."""
+    if manifest:
+        return len(manifest)
+    return sum(1 for _ in Path(folder).glob(mercure_names.DCMFILTER))
+
+
+def get_manifest_size(manifest: Optional[List[ManifestEntry]]) -> Optional[int]:
+    """Returns the total size of the files listed in the manifest, or None if there is no manifest."""
+    if manifest is None:
+        return None
+    return sum(entry.size for entry in manifest)
+
+
+def remove_manifest(folder: Union[str, Path]) -> None:
+    """Removes the manifest from the task file of the given folder, e.g. because the files have been replaced by the
+    results of a processing module."""
+    task_file = Path(folder) / mercure_names.TASKFILE
+    try:
+        with open(task_file, "r") as json_file:
+            task = json.load(json_file)
+        if task.get("manifest") is None:
+            return
+        del task["manifest"]
+        with open(task_file, "w") as json_file:
+            json.dump(task, json_file)
+    except FileNotFoundError:
+        pass
+    except Exception:
+        logger.exception(f"Unable to remove manifest from {task_file}")
@@ -5,7 +5,11 @@ Helper functions and definitions for monitoring mercure's operations via the boo
 """
 
 # Standard python includes
-from typing import Dict
+from typing import Any, Dict, List, Optional, Tuple
+import atexit
+import queue
+import threading
+import time
 import requests
 import daiquiri
 import logging
@@ -16,6 +20,22 @@ logger = daiquiri.getLogger("config")
 sender_name = ""
 bookkeeper_address = ""
 
+# Events are not transmitted from the calling thread but are put into a bounded queue, which is processed by
+# a background thread. If the bookkeeper cannot keep up and the queue is full, further events are dropped
+EVENT_QUEUE_SIZE = 10000
+EVENT_BATCH_SIZE = 100
+EVENT_FLUSH_INTERVAL = 0.5  # in seconds
+# Minimum time between two reports of dropped events by the sender thread
+STATISTICS_INTERVAL = 60  # in seconds
+
+event_queue: "queue.Queue[Tuple[str, Dict, float]]" = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+sender_thread: Optional[threading.Thread] = None
+sent_events = 0
+failed_events = 0
+dropped_events = 0
+reported_dropped_events = 0
+last_statistics_report: float = 0
+
 
 class m_events:
     """Event types for general mercure monitoring."""
@@ -76,40 +96,148 @@ def configure(module, instance, address) -> None:
     will not be transmitted to the bookkeeper."""
     global sender_name
     global bookkeeper_address
+    global sender_thread
     sender_name = module + "." + instance
     bookkeeper_address = "http://" + address
 
+    if sender_thread is None:
+        sender_thread = threading.Thread(target=process_event_queue, name="bookkeeper_sender", daemon=True)
+        sender_thread.start()
+        # Try to deliver the remaining events (e.g., the shutdown event) when the service terminates
+        atexit.register(flush_events)
+
+
+def _to_json_value(value: Any) -> Any:
+    """Converts values that can't be serialized as JSON (e.g., the bytes output of a failed command) into strings."""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    if isinstance(value, dict):
+        return {str(key): _to_json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json_value(item) for item in value]
+    return str(value)
+
+
+def queue_event(endpoint: str, payload: Dict) -> None:
+    """Queues the given payload for transmission to the bookkeeper, together with the time when the event occurred.
+    Never blocks the caller. If the queue is full, the event is dropped."""
+    global dropped_events
+    try:
+        event_queue.put_nowait((endpoint, _to_json_value(payload), time.time()))
+    except queue.Full:
+        # Reported by the sender thread, so that the caller isn't slowed down by logging
+        dropped_events += 1
+
+
+def process_event_queue() -> None:
+    """Background thread that transmits the queued events to the bookkeeper in batches. A batch is sent once
+    it contains EVENT_BATCH_SIZE events or the flush interval has passed after the first event."""
+    global failed_events
+    session = requests.Session()
+    while True:
+        batch = [event_queue.get()]
+        deadline = time.monotonic() + EVENT_FLUSH_INTERVAL
+        while len(batch) < EVENT_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(event_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            send_batch(session, batch)
+        except Exception:
+            # Never end the sender thread, otherwise no further events would be transmitted
+            failed_events += len(batch)
+            logger.exception("Unable to send events to bookkeeper")
+        finally:
+            for _ in batch:
+                event_queue.task_done()
+        report_statistics()
+
+
+def send_batch(session: requests.Session, batch) -> None:
+    """Transmits a batch of events with one request to the bulk endpoint of the bookkeeper, using the pooled
+    connections of the given session."""
+    global sent_events
+    global failed_events
+    events = [
+        {"type": endpoint.lstrip("/"), "time": event_time, "data": payload} for endpoint, payload, event_time in batch
+    ]
+    try:
+        response = session.post(bookkeeper_address + "/bulk", json=events, timeout=5)
+        response.raise_for_status()
+        sent_events += len(batch)
+    except requests.exceptions.RequestException:
+        failed_events += len(batch)
+        logger.error("Failed request to bookkeeper")
+
+
+def flush_events(timeout: float = 2) -> bool:
+    """Waits until all queued events have been transmitted, or until the timeout has passed. Returns True if the
+    queue has been emptied."""
+    deadline = time.monotonic() + timeout
+    while event_queue.unfinished_tasks > 0:
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def get_event_statistics() -> Dict[str, int]:
+    """Returns the counters of the bookkeeper event transmission."""
+    return {
+        "queued": event_queue.qsize(),
+        "sent": sent_events,
+        "failed": failed_events,
+        "dropped": dropped_events,
+    }
+
+
+def report_statistics() -> None:
+    """Logs a warning with the counters of the event transmission if events have been dropped since the last report.
+    Called by the sender thread, at most every STATISTICS_INTERVAL seconds."""
+    global reported_dropped_events
+    global last_statistics_report
+    if time.monotonic() - last_statistics_report < STATISTICS_INTERVAL:
+        return
+    last_statistics_report = time.monotonic()
+    if dropped_events <= reported_dropped_events:
+        return
+    logger.warning(
+        f"Bookkeeper event queue full. Dropped {dropped_events - reported_dropped_events} events since last report "
+        f"({get_event_statistics()})"
+    )
+    reported_dropped_events = dropped_events
+
 
 def send_event(event, severity=severity.INFO, description: str = "") -> None:
     """Sends information about general mercure events to the bookkeeper (e.g., during module start)."""
     if not bookkeeper_address:
         return
-    try:
-        payload = {
-            "sender": sender_name,
-            "event": event,
-            "severity": severity,
-            "description": description,
-        }
-        requests.post(bookkeeper_address + "/mercure-event", data=payload, timeout=1)
-    except requests.exceptions.RequestException:
-        logger.error("Failed request to bookkeeper")
+    payload = {
+        "sender": sender_name,
+        "event": event,
+        "severity": severity,
+        "description": description,
+    }
+    queue_event("/mercure-event", payload)
 
 
 def send_webgui_event(event, user, description="") -> None:
     """Sends information about an event on the webgui to the bookkeeper."""
     if not bookkeeper_address:
         return
-    try:
-        payload = {
-            "sender": sender_name,
-            "event": event,
-            "user": user,
-            "description": description,
-        }
-        requests.post(bookkeeper_address + "/webgui-event", data=payload, timeout=1)
-    except requests.exceptions.RequestException:
-        logger.error("Failed request to bookkeeper")
+    payload = {
+        "sender": sender_name,
+        "event": event,
+        "user": user,
+        "description": description,
+    }
+    queue_event("/webgui-event", payload)
 
 
 def send_register_series(tags: Dict[str, str]) -> None:
@@ -117,25 +245,27 @@ def send_register_series(tags: Dict[str, str]) -> None:
     fully received and the DICOM tags have been parsed."""
     if not bookkeeper_address:
         return
-    try:
-        requests.post(bookkeeper_address + "/register-series", data=tags, timeout=1)
-    except requests.exceptions.RequestException:
-        logger.error("Failed request to bookkeeper")
+    queue_event("/register-series", dict(tags))
+
+
+def send_register_instances(series_uid: str, instances: List[Dict[str, str]]) -> None:
+    """Registers the received DICOM files of a series on the bookkeeper with a single event. Each instance has the
+    keys filename and file_uid. Used instead of the per-file registration by getdcmtags if bulk registration is on."""
+    if not bookkeeper_address or not instances:
+        return
+    queue_event("/register-dicom-series", {"series_uid": series_uid, "files": instances})
 
 
 def send_series_event(event, series_uid, file_count, target, info) -> None:
     """Send an event related to a specific series to the bookkeeper."""
     if not bookkeeper_address:
         return
-    try:
-        payload = {
-            "sender": sender_name,
-            "event": event,
-            "series_uid": series_uid,
-            "file_count": file_count,
-            "target": target,
-            "info": info,
-        }
-        requests.post(bookkeeper_address + "/series-event", data=payload, timeout=1)
-    except requests.exceptions.RequestException:
-        logger.error("Failed request to bookkeeper")
+    payload = {
+        "sender": sender_name,
+        "event": event,
+        "series_uid": series_uid,
+        "file_count": file_count,
+        "target": target,
+        "info": info,
+    }
+    queue_event("/series-event", payload)
@@ -0,0 +1,65 @@
+"""
+retention.py
+============
+Journal of the folders that have been moved into the success and discard folders. The services append an entry
+whenever they move a folder there, so that the cleaner can delete the expired folders in the order of their arrival
+without having to scan the folders.
+"""
+
+# Standard python includes
+import json
+import os
+import time
+from pathlib import Path
+from typing import Optional, Union
+import daiquiri
+
+# App-specific includes
+import common.config as config
+
+
+logger = daiquiri.getLogger("retention")
+
+# Name of the journal file, which is stored in the success and discard folders
+JOURNAL = ".retention"
+
+
+def get_folder_size(folder: Union[str, Path]) -> int:
+    """Returns the total size of the files in the given folder (in bytes)."""
+    size = 0
+    for root, _, files in os.walk(folder):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def record(folder: Union[str, Path], uid: str = "", size: Optional[int] = None) -> None:
+    """
+    Appends an entry for the given folder to the journal of the folder containing it. Only folders that are moved
+    into the success or discard folders are recorded, as the other folders are not deleted by the cleaner. The size
+    should be taken from the manifest of the task. If it is not known, the cleaner determines it during deletion, so
+    that the calling service doesn't need to walk the folder.
+    """
+    folder_path = Path(folder)
+    parent = str(folder_path.parent)
+    if parent not in (
+        os.path.normpath(config.mercure.success_folder),
+        os.path.normpath(config.mercure.discard_folder),
+    ):
+        return
+
+    try:
+        entry = json.dumps({"folder": folder_path.name, "uid": uid, "size": size, "time": time.time()}) + "\n"
+        # Each entry is written with a single call in append mode, so that entries written by different services
+        # can't interleave
+        fd = os.open(Path(parent) / JOURNAL, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+        try:
+            os.write(fd, entry.encode())
+        finally:
+            os.close(fd)
+    except Exception:
+        # The cleaner still finds the folder during the next full scan
+        logger.exception(f"Unable to write retention journal for {folder_path}")
@@ -5,11 +5,15 @@ Helper functions for evaluating routing rules and study-completion conditions.
 """
 
 # Standard python includes
-from typing import Any, Dict, Union
+import ast
+import re
+from types import CodeType
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple, Union
 import daiquiri
 
 # App-specific includes
 import common.monitor as monitor
+from common.types import Rule
 
 # Create local logger instance
 logger = daiquiri.getLogger("rule_evaluation")
@@ -44,6 +48,10 @@ def replace_tags(rule: str, tags: Dict[str, str]) -> Any:
 
 # Allow typecasting the DICOM tags during evaluation of routing rules
 safe_eval_cmds = {"float": float, "int": int, "str": str}
+rule_globals = {"__builtins__": {}, **safe_eval_cmds}
+
+# Tag variables in the rule expressions have the format @tagname@
+tag_pattern = re.compile(r"@([A-Za-z][A-Za-z0-9_]*)@")
 
 
 def parse_rule(rule: str, tags: Dict[str, str]) -> Union[Any, bool]:
@@ -58,11 +66,194 @@ def parse_rule(rule: str, tags: Dict[str, str]) -> Union[Any, bool]:
         return result
     except Exception as e:
         logger.error(f"ERROR: {e}")
-        logger.warn(f"WARNING: Invalid rule expression {rule}", '"' + rule + '"')
+        logger.warning(f"WARNING: Invalid rule expression {rule}")
         monitor.send_event(monitor.m_events.CONFIG_UPDATE, monitor.severity.ERROR, f"Invalid rule encountered {rule}")
         return False
 
 
+class CompiledRule:
+    """Routing rule that has been translated into a code object once, so that it can be evaluated for every
+    series without repeating the tag substitution and parsing. Tags are read directly from the tags dictionary."""
+
+    def __init__(self, rule: str) -> None:
+        self.rule = rule
+        self.code: Optional[CodeType] = None
+        # Tag and tag values that are required for the rule to trigger (if this can be determined from the rule)
+        self.required_values: Optional[Tuple[str, FrozenSet[str]]] = None
+        self.tags = tag_pattern.findall(rule)
+        expression = tag_pattern.sub(lambda match: f"__tags__[{match.group(1)!r}]", rule)
+        try:
+            tree = ast.parse(expression.strip(), "<rule>", "eval")
+            self.required_values = get_required_values(tree.body)
+            self.code = compile(tree, "<rule>", "eval")
+        except Exception as e:
+            logger.error(f"ERROR: {e}")
+            logger.warning(f"WARNING: Invalid rule expression {rule}")
+            monitor.send_event(monitor.m_events.CONFIG_UPDATE, monitor.severity.ERROR, f"Invalid rule encountered {rule}")
+
+    def evaluate(self, tags: Dict[str, str]) -> Union[Any, bool]:
+        """Evaluates the rule for the given tags dictionary. Returns False if the rule is invalid or if the rule
+        refers to tags that are not available for the series."""
+        if self.code is None:
+            return False
+        try:
+            # The tags are passed as global, so that they are also visible inside comprehensions and lambdas
+            return eval(self.code, {**rule_globals, "__tags__": tags})
+        except Exception as e:
+            logger.error(f"ERROR: {e}")
+            logger.warning(f"WARNING: Unable to evaluate rule expression {self.rule}")
+            monitor.send_event(
+                monitor.m_events.CONFIG_UPDATE, monitor.severity.ERROR, f"Invalid rule encountered {self.rule}"
+            )
+            return False
+
+
+def get_tag_name(node: ast.AST) -> Optional[str]:
+    """Returns the tag name if the given node reads a tag value (i.e., if it has the form __tags__['name'])."""
+    if not (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == "__tags__"):
+        return None
+    index = node.slice
+    # Python < 3.9 wraps the subscript into an Index node
+    if hasattr(ast, "Index") and isinstance(index, getattr(ast, "Index")):
+        index = index.value  # type: ignore
+    if isinstance(index, ast.Constant) and isinstance(index.value, str):
+        return index.value
+    return None
+
+
+def get_string_values(node: ast.AST) -> Optional[FrozenSet[str]]:
+    """Returns the values if the given node is a string constant or a list/tuple/set of string constants."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return frozenset([node.value])
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        values = [get_string_values(element) for element in node.elts]
+        if values and all(value is not None and len(value) == 1 for value in values):
+            return frozenset(next(iter(value)) for value in values)  # type: ignore
+    return None
+
+
+def get_required_values(node: ast.AST) -> Optional[Tuple[str, FrozenSet[str]]]:
+    """
+    Analyzes the given rule expression and returns a tag together with the values that the tag must have for the rule
+    to trigger. Returns None if no such condition can be derived (the rule then needs to be evaluated for every series).
+    Supported are equality tests (@tag@ == 'value'), membership tests (@tag@ in ['value1', 'value2']), as well as
+    conjunctions and disjunctions of such tests.
+    """
+    if isinstance(node, ast.Compare) and len(node.ops) == 1:
+        left, right = node.left, node.comparators[0]
+        if isinstance(node.ops[0], ast.Eq):
+            if get_tag_name(right) and not get_tag_name(left):
+                left, right = right, left
+            tag = get_tag_name(left)
+            values = get_string_values(right)
+            if tag and values is not None and len(values) == 1:
+                return tag, values
+        if isinstance(node.ops[0], ast.In):
+            tag = get_tag_name(left)
+            values = get_string_values(right)
+            if tag and values is not None and not isinstance(right, ast.Constant):
+                return tag, values
+        return None
+
+    operands: List[ast.AST] = []
+    conjunction = False
+    if isinstance(node, ast.BoolOp):
+        operands = node.values
+        conjunction = isinstance(node.op, ast.And)
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+        operands = [node.left, node.right]
+        conjunction = isinstance(node.op, ast.BitAnd)
+    else:
+        return None
+
+    required = [get_required_values(operand) for operand in operands]
+    if conjunction:
+        # All operands must be true, so the condition of any of the operands is needed
+        return next((entry for entry in required if entry is not None), None)
+
+    # At least one of the operands must be true, which is only indexable if all operands test the same tag
+    if any(entry is None for entry in required) or len({entry[0] for entry in required if entry}) != 1:
+        return None
+    tag = required[0][0]  # type: ignore
+    return tag, frozenset().union(*(entry[1] for entry in required if entry))
+
+
+class RuleIndex:
+    """
+    Index of the enabled rules by tag value, so that only rules that can trigger for a series need to be evaluated.
+    Rules for which no required tag value can be determined are always evaluated.
+    """
+
+    def __init__(self, rules: Dict[str, Rule], compiled: Dict[str, CompiledRule]) -> None:
+        self.position: Dict[str, int] = {}
+        self.unindexed: List[str] = []
+        self.indexed: Dict[str, Dict[str, List[str]]] = {}
+        self.fallback_rule = ""
+
+        for position, (rule_name, rule) in enumerate(rules.items()):
+            if rule.get("disabled", "False") == "True":
+                continue
+            if rule.get("fallback", "False") == "True":
+                self.fallback_rule = rule_name
+            self.position[rule_name] = position
+            required_values = compiled[rule_name].required_values
+            if required_values is None:
+                self.unindexed.append(rule_name)
+                continue
+            tag, values = required_values
+            for value in values:
+                self.indexed.setdefault(tag, {}).setdefault(value, []).append(rule_name)
+
+    def get_candidates(self, tags: Dict[str, str]) -> List[str]:
+        """Returns the names of the rules that can trigger for the given tags, in the order of the configuration."""
+        candidates = list(self.unindexed)
+        for tag, rules_by_value in self.indexed.items():
+            value = tags.get(tag)
+            if value is not None:
+                candidates.extend(rules_by_value.get(value, []))
+        return sorted(candidates, key=self.position.__getitem__)
+
+
+# Cache of the compiled rules, keyed by the rule expression so that unchanged rules are reused after
+# configuration updates. The rule map and rule index are rebuilt only when the configuration version changes
+compiled_expressions: Dict[str, CompiledRule] = {}
+compiled_rules: Dict[str, CompiledRule] = {}
+compiled_rules_version: Any = None
+rule_index: Optional[RuleIndex] = None
+
+
+def get_compiled_rules(rules: Dict[str, Rule], version: float) -> Dict[str, CompiledRule]:
+    """Returns the compiled expressions for the given rules. The rules are only compiled again if the
+    configuration version has changed, and only rules with modified expressions are recompiled."""
+    global compiled_expressions
+    global compiled_rules
+    global compiled_rules_version
+    global rule_index
+
+    if compiled_rules_version == (version, id(rules)):
+        return compiled_rules
+
+    expressions: Dict[str, CompiledRule] = {}
+    new_rules: Dict[str, CompiledRule] = {}
+    for rule_name, rule in rules.items():
+        expression = rule.get("rule", "False")
+        if expression not in expressions:
+            expressions[expression] = compiled_expressions.get(expression) or CompiledRule(expression)
+        new_rules[rule_name] = expressions[expression]
+
+    compiled_expressions = expressions
+    compiled_rules = new_rules
+    compiled_rules_version = (version, id(rules))
+    rule_index = RuleIndex(rules, compiled_rules)
+    return compiled_rules
+
+
+def get_rule_index(rules: Dict[str, Rule], version: float) -> RuleIndex:
+    """Returns the index of the given rules, which is rebuilt together with the compiled rules."""
+    get_compiled_rules(rules, version)
+    return rule_index  # type: ignore
+
+
 def test_rule(rule: str, tags: Dict[str, str]) -> str:
     """Tests the given rule for validity using the given tags dictionary. Similar to parse_rule but with
     more diagnostic output format for the testing dialog. Also warns about invalid tags."""
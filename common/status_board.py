@@ -0,0 +1,286 @@
+"""
+status_board.py
+===============
+Shared status board for the job queues shown in the web interface. The services publish the jobs that they track in
+their in-memory indexes into a small SQLite database (in WAL mode, so that the web interface can read while the
+services write). Thus, neither the web interface nor the services need to scan the queue folders and parse all task
+files for every request. If no status board has been configured, the web interface reads the queue folders directly.
+"""
+
+# Standard python includes
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+import daiquiri
+
+# App-specific includes
+import common.config as config
+from common.constants import mercure_names
+from common.types import Task
+
+
+logger = daiquiri.getLogger("status_board")
+
+# Time after which a queue is considered outdated, e.g. because the publishing service isn't running (in seconds)
+STALE_TIMEOUT = 60
+
+connection: Optional[sqlite3.Connection] = None
+connection_file = ""
+board_lock = threading.Lock()
+
+
+###################################################################################
+## Description of the jobs in the queue folders
+###################################################################################
+
+
+def get_job_scope(task: Task) -> str:
+    if task.info.uid_type == "series":
+        return "Series"
+    return "Study"
+
+
+def describe_processing_job(path: Path) -> Dict[str, Any]:
+    """Returns the information shown in the processing queue for the given folder."""
+    job_status = "Queued"
+    task_file = path / mercure_names.TASKFILE
+    if (path / mercure_names.PROCESSING).exists():
+        job_status = "Processing"
+        task_file = path / "in" / mercure_names.TASKFILE
+
+    try:
+        with open(task_file, "r") as f:
+            task: Task = Task(**json.load(f))
+        job_module = ""
+        if task.process and task.process.module_name:
+            job_module = task.process.module_name
+        return {
+            "Module": job_module,
+            "ACC": task.info.acc,
+            "MRN": task.info.mrn,
+            "Status": job_status,
+            "Scope": get_job_scope(task),
+        }
+    except Exception as e:
+        logger.exception(e)
+        return {"Module": "Error", "ACC": "Error", "MRN": "Error", "Status": "Error", "Scope": "Error"}
+
+
+def describe_routing_job(path: Path) -> Dict[str, Any]:
+    """Returns the information shown in the routing queue for the given folder."""
+    try:
+        with open(path / mercure_names.TASKFILE, "r") as f:
+            task: Task = Task(**json.load(f))
+        job_target = ""
+        if task.dispatch and task.dispatch.target_name:
+            job_target = task.dispatch.target_name
+        return {
+            "Target": job_target,
+            "ACC": task.info.acc,
+            "MRN": task.info.mrn,
+            "Status": "Queued",
+            "Scope": get_job_scope(task),
+        }
+    except Exception as e:
+        logger.exception(e)
+        return {"Target": "Error", "ACC": "Error", "MRN": "Error", "Status": "Error", "Scope": "Error"}
+
+
+# Information shown in the studies queue for studies without valid task file
+STUDY_ERROR = {
+    "UID": "Error",
+    "Rule": "Error",
+    "ACC": "Error",
+    "MRN": "Error",
+    "Completion": "Error",
+    "Created": "Error",
+    "Series": 0,
+}
+
+
+def describe_study_task(task: Task) -> Dict[str, Any]:
+    """Returns the information shown in the studies queue for the given study task."""
+    try:
+        if (not task.study) or (not task.info):
+            raise Exception()
+        job_completion = "Timeout"
+        if task.study.complete_force == "True":
+            job_completion = "Force"
+        elif task.study.complete_trigger == "received_series":
+            job_completion = "Series"
+        return {
+            "UID": task.info.uid,
+            "Rule": task.info.applied_rule or "",
+            "ACC": task.info.acc,
+            "MRN": task.info.mrn,
+            "Completion": job_completion,
+            "Created": task.study.creation_time,
+            "Series": len(task.study.received_series or []),
+        }
+    except Exception as e:
+        logger.exception(e)
+        return dict(STUDY_ERROR)
+
+
+def describe_study(path: Path) -> Dict[str, Any]:
+    """Returns the information shown in the studies queue for the given folder."""
+    try:
+        with open(path / mercure_names.TASKFILE, "r") as f:
+            task: Task = Task(**json.load(f))
+    except Exception as e:
+        logger.exception(e)
+        return dict(STUDY_ERROR)
+    return describe_study_task(task)
+
+
+# Folder (name of the configuration setting) and description function for each queue
+queues: Dict[str, Tuple[str, Callable[[Path], Dict[str, Any]]]] = {
+    "processing": ("processing_folder", describe_processing_job),
+    "routing": ("outgoing_folder", describe_routing_job),
+    "studies": ("studies_folder", describe_study),
+}
+
+
+def scan_queue(queue: str) -> Dict[str, Dict[str, Any]]:
+    """Returns the jobs of the given queue by scanning the queue folder and parsing all task files."""
+    folder_setting, describe = queues[queue]
+    jobs: Dict[str, Dict[str, Any]] = {}
+    with os.scandir(config.mercure.get(folder_setting)) as it:
+        for entry in it:
+            if entry.is_dir():
+                jobs[entry.name] = describe(Path(entry.path))
+    return jobs
+
+
+###################################################################################
+## Access to the status board
+###################################################################################
+
+
+def get_connection() -> Optional[sqlite3.Connection]:
+    """Returns the connection to the status board, or None if no status board has been configured."""
+    global connection
+    global connection_file
+
+    board_file = config.mercure.status_board
+    if not board_file:
+        return None
+    if connection is not None and connection_file == board_file:
+        return connection
+    if connection is not None:
+        connection.close()
+
+    connection = sqlite3.connect(board_file, timeout=5, check_same_thread=False, isolation_level=None)
+    connection_file = board_file
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS jobs (queue TEXT, name TEXT, search TEXT, data TEXT, PRIMARY KEY (queue, name))"
+    )
+    connection.execute("CREATE TABLE IF NOT EXISTS queues (queue TEXT PRIMARY KEY, count INTEGER, updated REAL)")
+    return connection
+
+
+class QueuePublisher:
+    """
+    Publishes the jobs of a queue to the status board. The services pass the jobs as tracked by their in-memory
+    indexes, so the queue folders are not scanned for the board. Only jobs whose state has changed are described
+    again, and only changed rows are written.
+    """
+
+    def __init__(self, queue: str) -> None:
+        self.queue = queue
+        self.states: Dict[str, Any] = {}
+        self.published: Optional[Dict[str, Dict[str, Any]]] = None
+        self.last_write: float = 0
+
+    def publish(self, states: Dict[str, Any], describe: Callable[[str], Dict[str, Any]]) -> None:
+        """Publishes the given jobs. The states map the names of the jobs to a value that changes whenever the
+        description of the job might have changed (e.g., the modification time of the job folder)."""
+        try:
+            with board_lock:
+                db = get_connection()
+                if db is None:
+                    return
+                previous = self.published or {}
+                jobs = {
+                    name: previous[name] if name in previous and self.states.get(name) == state else describe(name)
+                    for name, state in states.items()
+                }
+                self._write(db, jobs)
+                self.states = dict(states)
+        except Exception:
+            # The status board is only used for display, so it must not affect the processing
+            logger.exception(f"Unable to update status board for queue {self.queue}")
+            self.published = None
+
+    def _write(self, db: sqlite3.Connection, jobs: Dict[str, Dict[str, Any]]) -> None:
+        if jobs == self.published:
+            # Show that the queue is still up-to-date
+            if time.time() - self.last_write > STALE_TIMEOUT / 4:
+                db.execute("UPDATE queues SET updated = ? WHERE queue = ?", (time.time(), self.queue))
+                self.last_write = time.time()
+            return
+        previous = self.published or {}
+        changed = [(name, job) for name, job in jobs.items() if previous.get(name) != job]
+        removed = [name for name in previous if name not in jobs]
+
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if self.published is None:
+                # First update by this service, so the entries left by the previous instance are replaced
+                db.execute("DELETE FROM jobs WHERE queue = ?", (self.queue,))
+            db.executemany("DELETE FROM jobs WHERE queue = ? AND name = ?", [(self.queue, name) for name in removed])
+            db.executemany(
+                "INSERT OR REPLACE INTO jobs (queue, name, search, data) VALUES (?, ?, ?, ?)",
+                [(self.queue, name, get_search_text(name, job), json.dumps(job)) for name, job in changed],
+            )
+            db.execute(
+                "INSERT OR REPLACE INTO queues (queue, count, updated) VALUES (?, ?, ?)",
+                (self.queue, len(jobs), time.time()),
+            )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        self.published = jobs
+        self.last_write = time.time()
+
+
+def get_search_text(name: str, job: Dict[str, Any]) -> str:
+    return " ".join([name] + [str(value) for value in job.values()]).lower()
+
+
+def read_jobs(
+    queue: str, offset: int = 0, limit: Optional[int] = None, search: str = ""
+) -> Optional[Tuple[int, Dict[str, Dict[str, Any]]]]:
+    """
+    Returns the total number of matching jobs and the requested page of jobs of the given queue from the status board
+    (ordered by the name of the job folder). Returns None if no status board is available or the queue hasn't been
+    published recently, in which case the queue folder needs to be scanned instead.
+    """
+    with board_lock:
+        db = get_connection()
+        if db is None:
+            return None
+        updated = db.execute("SELECT updated FROM queues WHERE queue = ?", (queue,)).fetchone()
+        if updated is None or time.time() - updated[0] > STALE_TIMEOUT:
+            return None
+
+        condition = "queue = ?"
+        parameters: list = [queue]
+        if search:
+            condition += " AND search LIKE ? ESCAPE '\\'"
+            escaped = search.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            parameters.append(f"%{escaped}%")
+
+        total = db.execute(f"SELECT COUNT(*) FROM jobs WHERE {condition}", parameters).fetchone()[0]
+        rows = db.execute(
+            f"SELECT name, data FROM jobs WHERE {condition} ORDER BY name LIMIT ? OFFSET ?",
+            parameters + [limit if limit is not None else -1, offset],
+        ).fetchall()
+    return total, {name: json.loads(data) for name, data in rows}
@@ -0,0 +1,206 @@
+"""
+target_health.py
+================
+Health state of the dispatch targets (circuit breaker). After several consecutive failed transfers to a target, the
+dispatcher stops sending to the target instead of running a full transfer attempt for every queued job. The target is
+then checked periodically with a lightweight C-ECHO request in the background. Once the target responds, a single job
+is sent as trial, and transfers are resumed if the trial succeeds. Only failures caused by the network or the target
+count towards the breaker, not failures caused by the job itself (e.g., invalid input files). The state is stored in
+the outgoing folder, so that it can be shown in the web interface.
+"""
+
+# Standard python includes
+import json
+import os
+import subprocess
+import threading
+import time
+from pathlib import Path
+from shlex import split
+from typing import Any, Dict, Optional, Set, Tuple, Union
+import daiquiri
+
+# App-specific includes
+import common.monitor as monitor
+from common.types import DicomTarget, SftpTarget
+
+
+logger = daiquiri.getLogger("target_health")
+
+# Name of the file in the outgoing folder that stores the health of the targets
+HEALTH_FILE = ".targets"
+# Number of consecutive failed transfers after which a target is considered unavailable
+FAILURE_THRESHOLD = 3
+# Time between two checks of an unavailable target (in seconds)
+PROBE_INTERVAL = 30
+# Timeout of the C-ECHO request (in seconds)
+PROBE_TIMEOUT = 5
+# Time after which another trial job is sent if the trial job has not reported a result (in seconds)
+TRIAL_TIMEOUT = 600
+# Minimum time between two updates of the stored state if only the transfer times have changed (in seconds)
+SAVE_INTERVAL = 10
+
+
+class TargetState:
+    """Health of a single target."""
+
+    def __init__(self, values: Optional[Dict[str, Any]] = None) -> None:
+        values = values or {}
+        self.failures: int = values.get("failures", 0)
+        self.unavailable_since: float = values.get("unavailable_since", 0)
+        self.last_probe: float = values.get("last_probe", 0)
+        self.echo_latency: Optional[float] = values.get("echo_latency")
+        self.transfer_time: Optional[float] = values.get("transfer_time")
+        self.last_error: str = values.get("last_error", "")
+        # The target has responded to the probe, so a single job is sent as trial
+        self.probe_passed: bool = values.get("probe_passed", False)
+        # Start time of the trial job (not restored, as no transfer is running after a restart)
+        self.trial_started: float = 0
+
+    def is_open(self) -> bool:
+        return self.unavailable_since > 0
+
+
+def probe_target(target: Union[DicomTarget, SftpTarget]) -> Tuple[bool, float]:
+    """Checks if the target responds to a C-ECHO request. Returns the result and the round-trip time (in seconds).
+    SFTP targets can't be checked this way, so the next transfer serves as test."""
+    if not isinstance(target, DicomTarget):
+        return True, 0
+    command = (
+        f"echoscu -to {PROBE_TIMEOUT} -ta {PROBE_TIMEOUT} -td {PROBE_TIMEOUT} "
+        + f"-aec {target.aet_target or 'ANY-SCP'} -aet {target.aet_source or 'ECHOSCU'} {target.ip} {target.port or 104}"
+    )
+    start = time.monotonic()
+    try:
+        subprocess.run(split(command), check=True, capture_output=True, timeout=3 * PROBE_TIMEOUT + 1)
+        return True, time.monotonic() - start
+    except Exception:
+        return False, time.monotonic() - start
+
+
+class TargetHealth:
+    """Circuit breaker for the targets of the dispatcher, keyed by target name."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.folder = ""
+        self.targets: Dict[str, TargetState] = {}
+        self.probing: Set[str] = set()
+        self.last_save: float = 0
+
+    def configure(self, folder: str) -> None:
+        """Sets the outgoing folder. The stored state is loaded when the folder changes."""
+        if folder == self.folder:
+            return
+        with self._lock:
+            self.folder = folder
+            self.targets = {name: TargetState(values) for name, values in read_health(folder).items()}
+
+    def _get(self, target_name: str) -> TargetState:
+        if target_name not in self.targets:
+            self.targets[target_name] = TargetState()
+        return self.targets[target_name]
+
+    def _save(self) -> None:
+        if not self.folder:
+            return
+        health_file = Path(self.folder) / HEALTH_FILE
+        try:
+            with open(str(health_file) + ".tmp", "w") as json_file:
+                json.dump({name: vars(state) for name, state in self.targets.items()}, json_file)
+            os.replace(str(health_file) + ".tmp", health_file)
+            self.last_save = time.time()
+        except Exception:
+            logger.exception(f"Unable to write target health {health_file}")
+
+    def is_available(self, target_name: str, target: Union[DicomTarget, SftpTarget]) -> bool:
+        """Checks if jobs for the target should be sent. If the target is unavailable, it is probed again in the
+        background once the probe interval has passed. After a successful probe, a single job is let through as
+        trial, while the other jobs of the target keep waiting for its result."""
+        with self._lock:
+            state = self._get(target_name)
+            if not state.is_open():
+                return True
+            if state.probe_passed:
+                if state.trial_started and time.time() - state.trial_started < TRIAL_TIMEOUT:
+                    return False
+                state.trial_started = time.time()
+                return True
+            if target_name in self.probing or time.time() - state.last_probe < PROBE_INTERVAL:
+                return False
+            state.last_probe = time.time()
+            self.probing.add(target_name)
+
+        # The probe can take several seconds, so it must not block the dispatching of jobs for other targets
+        threading.Thread(
+            target=self._probe, args=(target_name, target), name=f"probe_{target_name}", daemon=True
+        ).start()
+        return False
+
+    def _probe(self, target_name: str, target: Union[DicomTarget, SftpTarget]) -> None:
+        available, latency = probe_target(target)
+        with self._lock:
+            self.probing.discard(target_name)
+            state = self._get(target_name)
+            if available and state.is_open():
+                logger.info(f"Target {target_name} responds again, sending one job as trial")
+                state.probe_passed = True
+                state.trial_started = 0
+                state.echo_latency = latency if isinstance(target, DicomTarget) else None
+            self._save()
+
+    def record_success(self, target_name: str, transfer_time: float) -> None:
+        with self._lock:
+            state = self._get(target_name)
+            if state.is_open():
+                logger.info(f"Target {target_name} is available again, resuming transfers")
+                monitor.send_event(
+                    monitor.m_events.PROCESSING, monitor.severity.INFO, f"Target {target_name} is available again"
+                )
+            changed = state.failures > 0 or state.is_open()
+            state.failures = 0
+            state.unavailable_since = 0
+            state.probe_passed = False
+            state.trial_started = 0
+            state.transfer_time = transfer_time
+            if changed or time.time() - self.last_save >= SAVE_INTERVAL:
+                self._save()
+
+    def record_failure(self, target_name: str, error: str, target_error: bool = True) -> None:
+        """Registers a failed transfer. Only failures caused by the network or the target (target_error) count
+        towards the breaker. If the trial job of an unavailable target fails, the target is probed again."""
+        with self._lock:
+            state = self._get(target_name)
+            state.last_error = error
+            if not target_error:
+                # The failure says nothing about the target, so another job can be sent as trial
+                state.trial_started = 0
+                self._save()
+                return
+            state.failures += 1
+            if state.is_open():
+                state.probe_passed = False
+                state.trial_started = 0
+                state.last_probe = time.time()
+            elif state.failures >= FAILURE_THRESHOLD:
+                state.unavailable_since = time.time()
+                state.last_probe = time.time()
+                error_message = f"Target {target_name} failed {state.failures} times, pausing transfers"
+                logger.error(error_message)
+                monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
+            self._save()
+
+
+target_health = TargetHealth()
+
+
+def read_health(folder: str) -> Dict[str, Dict[str, Any]]:
+    """Returns the stored health of the targets, as shown in the web interface."""
+    try:
+        with open(Path(folder) / HEALTH_FILE, "r") as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return {}
+    except Exception:
+        logger.exception(f"Unable to read target health {Path(folder) / HEALTH_FILE}")
+        return {}
@@ -31,6 +31,7 @@ class EmptyDict(TypedDict):
 class Target(BaseModel, Compat):
     contact: Optional[str] = ""
     comment: str = ""
+    max_parallel_transfers: int = 1
 
 
 class DicomTarget(Target):
@@ -115,6 +116,25 @@ class Config(BaseModel, Compat):
     rules: Dict[str, Rule]
     modules: Dict[str, Module]
     process_runner: Literal["docker", "nomad", ""] = ""
+    router_rescan_interval: int = 60  # in seconds
+    router_workers: int = 1
+    dispatcher_workers: int = 1
+    incoming_series_folders: bool = False
+    processing_slots: int = 1
+    processing_hard_limits: bool = False
+    cleaner_min_retention: int = 3600  # in seconds
+    cleaner_space_low: float = 20  # in percent
+    cleaner_space_critical: float = 5  # in percent
+    cleaner_io_budget: int = 52428800  # in bytes per second
+    status_board: str = "./status.db"
+    retry_max_delay: int = 14400  # in seconds
+    bookkeeper_bulk_register: bool = False
+
+
+class ManifestEntry(BaseModel, Compat):
+    name: str  # file name without extension
+    size: int  # size of the DICOM file in bytes
+    sop_uid: str = ""
 
 
 class TaskInfo(BaseModel, Compat):
@@ -128,6 +148,7 @@ class TaskInfo(BaseModel, Compat):
     mercure_version: str
     mercure_appliance: str
     mercure_server: str
+    priority: Literal["normal", "urgent", "offpeak"] = "normal"
 
 
 class TaskDispatch(BaseModel, Compat):
@@ -160,6 +181,7 @@ class Task(BaseModel, Compat):
     process: Union[TaskProcessing, EmptyDict] = cast(EmptyDict, {})
     study: Union[TaskStudy, EmptyDict] = cast(EmptyDict, {})
     nomad_info: Optional[Any]
+    manifest: Optional[List[ManifestEntry]]
 
     class Config:
         extra = "forbid"
@@ -0,0 +1,106 @@
+"""
+outgoing_index.py
+=================
+In-memory table of the jobs in the outgoing folder. For every job folder, the index keeps the modification time of the
+folder together with the dispatch information parsed from the task file and the readiness state. The task file is
+only read again when the modification time of the folder changes (i.e., when files are added, removed or renamed,
+as happens when a job is locked, sent, or retried). Jobs that wait in the retry queue are not checked at all until
+their next attempt is due.
+"""
+
+# Standard python includes
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import daiquiri
+
+# App-specific includes
+from common.types import TaskDispatch
+from dispatch.retry import RetryQueue
+from dispatch.status import has_been_send, is_ready_for_sending
+
+# Create local logger instance
+logger = daiquiri.getLogger("outgoing_index")
+
+# Folders that have been modified more recently (in seconds) are always checked again, as further changes within the
+# timestamp resolution of the file system would not change the modification time
+MTIME_GRACE = 2
+
+
+class OutgoingJob:
+    """Cached state of a job folder in the outgoing folder."""
+
+    def __init__(self, mtime: int, dispatch_info: Optional[TaskDispatch]) -> None:
+        self.mtime = mtime
+        self.dispatch_info = dispatch_info
+
+
+class OutgoingIndex:
+    """Map of the job folders in the outgoing folder (keyed by path) to their cached readiness state."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.jobs: Dict[str, OutgoingJob] = {}
+        self.reads = 0
+
+    def refresh(self, folder: str, retry_queue: Optional[RetryQueue] = None) -> None:
+        """Updates the index from the outgoing folder. Only folders that have been modified since the last call are
+        checked again, and folders waiting in the retry queue are skipped."""
+        jobs: Dict[str, OutgoingJob] = {}
+        now = time.time()
+        with os.scandir(folder) as it:
+            for entry in it:
+                try:
+                    if not entry.is_dir():
+                        continue
+                    cached = self.jobs.get(entry.path)
+                    if cached is not None and retry_queue is not None and retry_queue.is_waiting(entry.name, now):
+                        jobs[entry.path] = cached
+                        continue
+                    mtime = entry.stat().st_mtime_ns
+                except OSError:
+                    # The folder has been moved away in the meantime
+                    continue
+
+                if cached is None or cached.mtime != mtime or now - mtime / 1e9 < MTIME_GRACE:
+                    cached = OutgoingJob(mtime, self._read_job(entry.path))
+                jobs[entry.path] = cached
+
+        with self._lock:
+            self.jobs = jobs
+
+    def _read_job(self, path: str) -> Optional[TaskDispatch]:
+        self.reads += 1
+        if has_been_send(path):
+            return None
+        return is_ready_for_sending(path)
+
+    def invalidate(self, path: str) -> None:
+        """Reads the job folder again during the next refresh, e.g. after an attempt to send it."""
+        with self._lock:
+            self.jobs.pop(path, None)
+
+    def get_ready_jobs(self, now: Optional[float] = None) -> List[Tuple[str, TaskDispatch]]:
+        """Returns the jobs that are ready for sending and not waiting for a retry, ordered by folder name."""
+        now = now or time.time()
+        with self._lock:
+            ready = [
+                (path, job.dispatch_info)
+                for path, job in self.jobs.items()
+                if job.dispatch_info is not None and (job.dispatch_info.next_retry_at or 0) <= now
+            ]
+        return sorted(ready, key=lambda item: item[0])
+
+    def job_count(self) -> int:
+        with self._lock:
+            return len(self.jobs)
+
+    def job_states(self) -> Dict[str, int]:
+        """Returns the modification time of every job folder (keyed by job name), which changes with the job state."""
+        with self._lock:
+            return {os.path.basename(path): job.mtime for path, job in self.jobs.items()}
+
+    def job_names(self) -> List[str]:
+        with self._lock:
+            return [os.path.basename(path) for path in self.jobs]
@@ -1,15 +1,21 @@
 import argparse
 import json
+import os
+import re
 import sys
 import logging
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List, Optional, Set
 import daiquiri
 from common import config
 
 daiquiri.setup(config.get_loglevel())
 logger = daiquiri.getLogger("process_dcmsend_result")
 
+# DIMSE status codes of a C-STORE response (DICOM PS3.4 B.2.3) under which the instance has been stored
+STATUS_SUCCESS = 0x0000
+STATUS_WARNINGS = {0x0001, 0x0107, 0x0116, 0xB000, 0xB006, 0xB007}
+
 
 def _parse_header(header) -> Dict:
     result = {}
@@ -54,6 +60,60 @@ def parse(result_file) -> Dict:
     return result
 
 
+def _parse_dimse_status(value: str) -> Optional[int]:
+    """Returns the numeric DIMSE status of a status field (e.g., "0x0000 (Success)"), or None if there is none."""
+    match = re.match(r"0x([0-9a-fA-F]{4})\b", value.strip())
+    if not match:
+        return None
+    return int(match.group(1), 16)
+
+
+def parse_instances(result_file) -> Dict[str, bool]:
+    """
+    Parses the status details of the dcmsend result file and returns for every listed file (by file name) if it has
+    been stored on the peer. Every record of the details is evaluated by its "DIMSE Status" field only. Files that
+    have been stored with success or a warning status count as stored. Files whose record has no DIMSE status code
+    (e.g., because they have not been sent) or an unrecognized code count as failed.
+    """
+    with Path(result_file).open() as f:
+        content = f.readlines()
+
+    records: List[Dict[str, str]] = []
+    in_details = False
+    for line in content:
+        if line.startswith("Status Details"):
+            in_details = True
+            continue
+        if line.startswith("Status Summary"):
+            in_details = False
+            continue
+        if not in_details or ":" not in line:
+            continue
+
+        key, value = line.split(":", 1)
+        key = key.strip()
+        # Every record of the details starts with its running number
+        if key == "Number":
+            records.append({})
+        if records:
+            records[-1][key] = value.strip()
+
+    instances: Dict[str, bool] = {}
+    for record in records:
+        if not record.get("Filename"):
+            continue
+        status = _parse_dimse_status(record.get("DIMSE Status", ""))
+        instances[os.path.basename(record["Filename"])] = status is not None and (
+            status == STATUS_SUCCESS or status in STATUS_WARNINGS
+        )
+    return instances
+
+
+def get_stored_files(result_file) -> Set[str]:
+    """Returns the names of the files that have been stored on the peer according to the dcmsend result file."""
+    return {name for name, stored in parse_instances(result_file).items() if stored}
+
+
 def create_arg_parser() -> argparse.ArgumentParser:
     """Creates and returns the ArgumentParser object."""
     parser = argparse.ArgumentParser(
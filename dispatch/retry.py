@@ -1,15 +1,173 @@
-from typing import Dict, cast
+from typing import Dict, Iterable, List, Tuple, cast
 from common.types import Task, TaskDispatch
+import heapq
 import json
+import os
+import random
+import threading
 import time
 from pathlib import Path
 
+import daiquiri
+
 from common.constants import mercure_names
 
+logger = daiquiri.getLogger("retry")
+
+# Name of the file in the outgoing folder that stores the retry queue, so that it survives restarts
+RETRY_FILE = ".retries"
+# Fraction of the retry delay that is randomized, so that the jobs of a target are not retried all at once
+JITTER = 0.5
+
+
+def get_max_delay(failures: int, retry_delay: float, max_delay: float) -> float:
+    """Returns the longest delay before the next attempt after the given number of consecutive failures. The delay
+    doubles with every failure up to the maximum delay."""
+    return min(retry_delay * 2 ** max(0, failures - 1), max(max_delay, retry_delay))
+
+
+def get_backoff_delay(failures: int, retry_delay: float, max_delay: float) -> float:
+    """Returns the delay before the next attempt after the given number of consecutive failures. Part of the delay is
+    random."""
+    delay = get_max_delay(failures, retry_delay, max_delay)
+    return delay * (1 - JITTER) + random.uniform(0, delay * JITTER)
+
+
+class RetryQueue:
+    """
+    Jobs of the outgoing folder that wait for their next attempt, ordered by the time of the attempt, together with the
+    number of consecutive failures of each target. The delay grows exponentially with the failures of the target, so
+    that all jobs of a target back off while the target is unavailable. All jobs of a target that fail within the same
+    backoff period count as one failure of the target. The jobs are identified by their folder name. Changes are
+    written to the outgoing folder when the queue is flushed.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.folder = ""
+        self.max_delay: float = 14400
+        self.jobs: Dict[str, float] = {}
+        self.heap: List[Tuple[float, str]] = []
+        self.target_failures: Dict[str, int] = {}
+        # Time of the last failure that has been counted for each target
+        self.last_failures: Dict[str, float] = {}
+        self.changed = False
+
+    def configure(self, folder: str, max_delay: float) -> None:
+        """Sets the outgoing folder and the maximum delay. The stored queue is loaded when the folder changes."""
+        self.max_delay = max_delay
+        if folder == self.folder:
+            return
+        with self._lock:
+            if self.changed:
+                self._save()
+            self.folder = folder
+            self.jobs = {}
+            self.target_failures = {}
+            self.last_failures = {}
+            self.changed = False
+            try:
+                with open(Path(folder) / RETRY_FILE, "r") as json_file:
+                    stored = json.load(json_file)
+                self.jobs = {name: float(due) for name, due in stored.get("jobs", {}).items()}
+                self.target_failures = {name: int(count) for name, count in stored.get("targets", {}).items()}
+            except FileNotFoundError:
+                pass
+            except Exception:
+                logger.exception(f"Unable to read retry queue {Path(folder) / RETRY_FILE}")
+            self.heap = [(due, name) for name, due in self.jobs.items()]
+            heapq.heapify(self.heap)
+
+    def flush(self) -> None:
+        """Writes the queue to the outgoing folder if it has changed since the last flush."""
+        with self._lock:
+            if self.changed:
+                self._save()
+
+    def _save(self) -> None:
+        self.changed = False
+        if not self.folder:
+            return
+        retry_file = Path(self.folder) / RETRY_FILE
+        try:
+            # Replace the file in one step, so that it is never read partially written
+            with open(str(retry_file) + ".tmp", "w") as json_file:
+                json.dump({"jobs": self.jobs, "targets": self.target_failures}, json_file)
+            os.replace(str(retry_file) + ".tmp", retry_file)
+        except Exception:
+            logger.exception(f"Unable to write retry queue {retry_file}")
+
+    def schedule(self, name: str, target_name: str, retries: int, retry_delay: float) -> float:
+        """Registers a failed attempt for the job and returns the time of the next attempt."""
+        now = time.time()
+        with self._lock:
+            failures = self.target_failures.get(target_name, 0)
+            # Further jobs that fail before the shortest delay of the current backoff has passed belong to the same
+            # period of unavailability, so they don't increase the backoff again
+            window = get_max_delay(failures, retry_delay, self.max_delay) * (1 - JITTER)
+            if failures == 0 or now - self.last_failures.get(target_name, 0) >= window:
+                failures += 1
+                self.target_failures[target_name] = failures
+                self.last_failures[target_name] = now
+            due = now + get_backoff_delay(max(failures, retries), retry_delay, self.max_delay)
+            self.jobs[name] = due
+            heapq.heappush(self.heap, (due, name))
+            self.changed = True
+        return due
+
+    def record_success(self, target_name: str) -> None:
+        """Resets the backoff of the target after a successful transfer."""
+        with self._lock:
+            self.last_failures.pop(target_name, None)
+            if self.target_failures.pop(target_name, None) is not None:
+                self.changed = True
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            if self.jobs.pop(name, None) is not None:
+                self.changed = True
+
+    def is_waiting(self, name: str, now: float) -> bool:
+        """Checks if the job is waiting for its next attempt, so that the job folder doesn't need to be checked."""
+        with self._lock:
+            return self.jobs.get(name, 0) > now
+
+    def pop_due(self, now: float) -> List[str]:
+        """Returns the jobs whose next attempt is due and removes them from the queue."""
+        due_jobs: List[str] = []
+        with self._lock:
+            while self.heap and self.heap[0][0] <= now:
+                due, name = heapq.heappop(self.heap)
+                # Skip outdated heap entries (the job has been removed or rescheduled)
+                if self.jobs.get(name) != due:
+                    continue
+                del self.jobs[name]
+                due_jobs.append(name)
+            if due_jobs:
+                self.changed = True
+        return due_jobs
+
+    def prune(self, names: Iterable[str]) -> None:
+        """Removes the jobs whose folders have left the outgoing folder (e.g., because they have been deleted)."""
+        existing = set(names)
+        with self._lock:
+            removed = [name for name in self.jobs if name not in existing]
+            for name in removed:
+                del self.jobs[name]
+            if removed:
+                self.changed = True
+
+    def waiting_count(self) -> int:
+        with self._lock:
+            return len(self.jobs)
+
+
+retry_queue = RetryQueue()
+
 
 def increase_retry(source_folder, retry_max, retry_delay) -> bool:
     """Increases the retries counter and set the wait counter to a new time
-    in the future.
+    in the future, as determined by the backoff of the target.
     :return True if increase has been successful or False if maximum retries
     has been reached
     """
@@ -19,11 +177,14 @@ def increase_retry(source_folder, retry_max, retry_delay) -> bool:
 
     dispatch = cast(TaskDispatch, task.dispatch)
     dispatch.retries = (dispatch.get("retries") or 0) + 1
-    dispatch.next_retry_at = time.time() + retry_delay
 
     if dispatch.retries >= retry_max:
+        retry_queue.remove(Path(source_folder).name)
         return False
 
+    dispatch.next_retry_at = retry_queue.schedule(
+        Path(source_folder).name, dispatch.get("target_name") or "", dispatch.retries, retry_delay
+    )
     with open(target_json_path, "w") as file:
         json.dump(task.dict(), file)
     return True
@@ -4,19 +4,25 @@ send.py
 The functions for sending DICOM series
 to target destinations.
 """
+import json
+import os
 import shutil
 import subprocess
 import time
 from datetime import datetime
 from pathlib import Path
-from shlex import split
+from shlex import quote, split
 from subprocess import PIPE, CalledProcessError, check_output
-from typing import Tuple
+from typing import List, Optional, Set, Tuple
 
 import daiquiri
 
+import common.retention as retention
+from common.target_health import target_health
+from common.manifest import count_dicom_files, get_manifest_size, read_manifest
 from common.monitor import s_events, send_series_event, send_event, m_events, severity
-from dispatch.retry import increase_retry
+from dispatch.process_dcmsend_result import get_stored_files
+from dispatch.retry import increase_retry, retry_queue
 from dispatch.status import is_ready_for_sending
 from common.constants import mercure_names
 from common.types import DicomTarget, SftpTarget, TaskDispatch
@@ -35,9 +41,15 @@ DCMSEND_ERROR_CODES = {
     65: "EXITCODE_CANNOT_ADD_PRESENTATION_CONTEXT",
 }
 
+# Exit codes of dcmsend caused by the network or the target, which count towards the circuit breaker of the target
+DCMSEND_TARGET_ERRORS = range(60, 66)
+# Exit code of sftp if the connection to the server fails
+SFTP_CONNECTION_ERROR = 255
 
-def _create_command(dispatch_info: TaskDispatch, folder: Path) -> Tuple[str, dict]:
-    """Composes the command for calling the dcmsend tool from DCMTK, which is used for sending out the DICOMS."""
+
+def _create_command(dispatch_info: TaskDispatch, folder: Path, input_folder: Optional[Path] = None) -> Tuple[str, dict]:
+    """Composes the command for calling the dcmsend tool from DCMTK, which is used for sending out the DICOMS. If an
+    input folder is given, the DICOM files are read from this folder instead of the job folder (DICOM targets only)."""
     logger.debug(dispatch_info.target)
     target = dispatch_info.target
     if isinstance(target, DicomTarget):
@@ -47,8 +59,7 @@ def _create_command(dispatch_info: TaskDispatch, folder: Path) -> Tuple[str, dic
         target_aet_source = target.aet_source or ""
 
         dcmsend_status_file = Path(folder) / mercure_names.SENDLOG
-
-        command = f"""dcmsend {target_ip} {target_port} +sd {folder}
+        command = f"""dcmsend {target_ip} {target_port} +sd {quote(str(input_folder or folder))}
                 -aet {target_aet_source} -aec {target_aet_target} -nuc
                 +sp '*.dcm' -to 60 +crf {dcmsend_status_file}"""
 
@@ -74,6 +85,64 @@ EOF"""
         return command, dict(shell=True, executable="/bin/bash")
 
 
+def _read_sent_files(folder: Path) -> Set[str]:
+    """Returns the files of the folder that have been stored on the target during previous attempts."""
+    try:
+        with open(Path(folder) / mercure_names.SENTFILES, "r") as f:
+            return set(json.load(f))
+    except FileNotFoundError:
+        return set()
+    except Exception:
+        logger.exception(f"Invalid list of sent files in {folder}, sending all files")
+        return set()
+
+
+def _record_sent_files(folder: Path) -> None:
+    """Adds the files that have been stored on the target according to the dcmsend report to the list of sent files.
+    The report is removed afterwards, as it would otherwise mark the folder as sent."""
+    report_file = Path(folder) / mercure_names.SENDLOG
+    if not report_file.exists():
+        return
+    try:
+        stored_files = get_stored_files(report_file)
+        if stored_files:
+            sent_files = _read_sent_files(folder) | stored_files
+            with open(Path(folder) / mercure_names.SENTFILES, "w") as f:
+                json.dump(sorted(sent_files), f)
+            logger.info(f"{len(sent_files)} files of {folder} have been stored on the target")
+    except Exception:
+        logger.exception(f"Unable to parse dcmsend report {report_file}")
+    report_file.unlink()
+
+
+def _get_remaining_files(folder: Path) -> Tuple[Optional[List[str]], int]:
+    """Returns the DICOM files that still need to be sent after a previous attempt failed partially (or None if all
+    files need to be sent), together with the total number of DICOM files in the folder."""
+    manifest = read_manifest(folder)
+    sent_files = _read_sent_files(folder)
+    if not sent_files:
+        return None, count_dicom_files(folder, manifest)
+    if manifest:
+        files = [entry.name + mercure_names.DCM for entry in manifest]
+    else:
+        files = sorted(file.name for file in Path(folder).glob(mercure_names.DCMFILTER))
+    return [file for file in files if file not in sent_files], len(files)
+
+
+def _stage_files(folder: Path, files: List[str]) -> Path:
+    """Links the given files of the folder into a staging subfolder, from which dcmsend reads them. The files are not
+    passed on the command line, as the command could otherwise exceed the maximum length for large studies."""
+    staging_folder = Path(folder) / mercure_names.RESENDFOLDER
+    shutil.rmtree(staging_folder, ignore_errors=True)
+    staging_folder.mkdir()
+    for file in files:
+        try:
+            os.link(Path(folder) / file, staging_folder / file)
+        except OSError:
+            shutil.copy2(Path(folder) / file, staging_folder / file)
+    return staging_folder
+
+
 def execute(
     source_folder: Path, success_folder: Path, error_folder: Path, retry_max, retry_delay,
 ):
@@ -109,14 +178,33 @@ def execute(
             logger.exception(f"Unable to create lock file {lock_file.name}")
             return
 
-        command, opts = _create_command(target_info, source_folder)
-        logger.debug(f"Running command {command}")
+        # If a previous attempt has failed partially, only the files that have not been stored are sent again
+        remaining_files: Optional[List[str]] = None
+        file_count = 0
+        if isinstance(target_info.target, DicomTarget):
+            remaining_files, file_count = _get_remaining_files(source_folder)
+            if remaining_files is not None:
+                logger.info(f"Sending {len(remaining_files)} remaining files of {file_count} files")
+
+        staging_folder: Optional[Path] = None
+        command = ""
+        transfer_start = time.monotonic()
         try:
-            result = check_output(command, stderr=subprocess.STDOUT, **opts)
+            if remaining_files == []:
+                result = b"All files have been stored during previous attempts"
+            else:
+                if remaining_files is not None:
+                    staging_folder = _stage_files(source_folder, remaining_files)
+                command, opts = _create_command(target_info, source_folder, staging_folder)
+                logger.debug(f"Running command {command}")
+                result = check_output(command if opts else split(command), stderr=subprocess.STDOUT, **opts)
+                target_health.record_success(target_name, time.monotonic() - transfer_start)
+            _remove_staging_folder(staging_folder)
             logger.info(f"Folder {source_folder} successfully sent, moving to {success_folder}")
             logger.debug(result.decode("utf-8"))
             # Send bookkeeper notification
-            file_count = len(list(Path(source_folder).glob(mercure_names.DCMFILTER)))
+            if not file_count:
+                file_count = count_dicom_files(source_folder, read_manifest(source_folder))
             send_series_event(
                 s_events.DISPATCH,
                 target_info.get("series_uid", "series_uid-missing"),
@@ -124,33 +212,61 @@ def execute(
                 target_info.get("target_name", "target_name-missing"),
                 "",
             )
-            _move_sent_directory(source_folder, success_folder)
+            _move_sent_directory(source_folder, success_folder, series_uid)
             send_series_event(s_events.MOVE, series_uid, 0, success_folder, "")
+            retry_queue.record_success(target_name)
         except CalledProcessError as e:
+            _remove_staging_folder(staging_folder)
             dcmsend_error_message = None
-            if isinstance(target_info, DicomTarget):
+            if isinstance(target_info.target, DicomTarget):
                 dcmsend_error_message = DCMSEND_ERROR_CODES.get(e.returncode, None)
                 logger.exception(f"Failed command:\n {command} \nbecause of {dcmsend_error_message}")
             else:
                 logger.error(f"Failed. Command exited with value {e.returncode}: \n {command}")
             logger.debug(e.output)
+            if isinstance(target_info.target, DicomTarget):
+                _record_sent_files(source_folder)
+                target_error = e.returncode in DCMSEND_TARGET_ERRORS
+            else:
+                target_error = e.returncode == SFTP_CONNECTION_ERROR
+            error_text = dcmsend_error_message or f"Exit code {e.returncode}"
+            target_health.record_failure(target_name, error_text, target_error)
             send_event(m_events.PROCESSING, severity.ERROR, f"Error sending {series_uid} to {target_name}")
             send_series_event(s_events.ERROR, series_uid, 0, target_name, dcmsend_error_message or e.output)
-            retry_increased = increase_retry(source_folder, retry_max, retry_delay)
-            if retry_increased:
-                lock_file.unlink()
-            else:
-                logger.info(f"Max retries reached, moving to {error_folder}")
-                send_series_event(s_events.SUSPEND, series_uid, 0, target_name, "Max retries reached")
-                _move_sent_directory(source_folder, error_folder)
-                send_series_event(s_events.MOVE, series_uid, 0, error_folder, "")
-                send_event(m_events.PROCESSING, severity.ERROR, f"Series suspended after reaching max retries")
+            _retry_later(source_folder, error_folder, series_uid, target_name, retry_max, retry_delay)
+        except OSError as e:
+            # The command could not be started or the files could not be staged, which says nothing about the target
+            _remove_staging_folder(staging_folder)
+            logger.exception(f"Unable to run command:\n {command}")
+            target_health.record_failure(target_name, str(e), False)
+            send_event(m_events.PROCESSING, severity.ERROR, f"Error sending {series_uid} to {target_name}")
+            send_series_event(s_events.ERROR, series_uid, 0, target_name, str(e))
+            _retry_later(source_folder, error_folder, series_uid, target_name, retry_max, retry_delay)
     else:
         pass
         # logger.warning(f"Folder {source_folder} is *not* ready for sending")
 
 
-def _move_sent_directory(source_folder, destination_folder) -> None:
+def _remove_staging_folder(staging_folder: Optional[Path]) -> None:
+    if staging_folder is not None:
+        shutil.rmtree(staging_folder, ignore_errors=True)
+
+
+def _retry_later(source_folder: Path, error_folder: Path, series_uid: str, target_name: str, retry_max, retry_delay):
+    """Schedules the next attempt after a failed transfer and unlocks the folder. If the maximum number of retries
+    has been reached, the folder is moved to the error folder instead."""
+    retry_increased = increase_retry(source_folder, retry_max, retry_delay)
+    if retry_increased:
+        (Path(source_folder) / mercure_names.PROCESSING).unlink()
+    else:
+        logger.info(f"Max retries reached, moving to {error_folder}")
+        send_series_event(s_events.SUSPEND, series_uid, 0, target_name, "Max retries reached")
+        _move_sent_directory(source_folder, error_folder, series_uid)
+        send_series_event(s_events.MOVE, series_uid, 0, error_folder, "")
+        send_event(m_events.PROCESSING, severity.ERROR, f"Series suspended after reaching max retries")
+
+
+def _move_sent_directory(source_folder, destination_folder, series_uid: str = "") -> None:
     """
     This check is needed if there is already a folder with the same name
     in the success folder. If so a new directory is create with a timestamp
@@ -163,9 +279,11 @@ def _move_sent_directory(source_folder, destination_folder) -> None:
             shutil.move(source_folder, target_folder, copy_function=shutil.copy2)
             (Path(target_folder) / mercure_names.PROCESSING).unlink()
         else:
-            logger.debug(f"Moving {source_folder} to {destination_folder / source_folder.name}")
-            shutil.move(source_folder, destination_folder / source_folder.name)
-            (destination_folder / source_folder.name / mercure_names.PROCESSING).unlink()
+            target_folder = destination_folder / source_folder.name
+            logger.debug(f"Moving {source_folder} to {target_folder}")
+            shutil.move(source_folder, target_folder)
+            (target_folder / mercure_names.PROCESSING).unlink()
+        retention.record(target_folder, series_uid, get_manifest_size(read_manifest(target_folder)))
     except:
         logger.info(f"Error moving folder {source_folder} to {destination_folder}")
         send_event(m_events.PROCESSING, severity.ERROR, f"Error moving {source_folder} to {destination_folder}")
@@ -4,6 +4,7 @@ from typing import Any, Optional
 
 from common.monitor import s_events, send_series_event
 from common.constants import mercure_names
+from common.manifest import has_dicom_files
 from common.types import Task, TaskDispatch
 import daiquiri
 
@@ -16,19 +17,20 @@ def is_ready_for_sending(folder) -> Optional[TaskDispatch]:
     No lock file (.lock) should be in sending folder and no error file (.error),
     if there is one copy/move is not done yet. Also at least some dicom files
     should be there for sending. Also checks for a task.json file and if it is
-    valid.
+    valid. The DICOM files are looked up via the manifest of the task file (if available).
     """
     path = Path(folder)
     folder_status = (
         not (path / mercure_names.LOCK).exists()
         and not (path / mercure_names.ERROR).exists()
         and not (path / mercure_names.PROCESSING).exists()
-        and len(list(path.glob(mercure_names.DCMFILTER))) > 0
     )
-    content = is_target_json_valid(folder)
+    if not folder_status:
+        return None
 
-    if folder_status and content:
-        return content
+    task = read_task(folder)
+    if task and task.dispatch and has_dicom_files(folder, task.manifest):
+        return task.dispatch
     return None
 
 
@@ -43,7 +45,25 @@ def is_target_json_valid(folder) -> Optional[TaskDispatch]:
     subkeys are target_ip, target_port and target_aet_target under the
     dispatch key
     """
+    task = read_task(folder)
+    if task is None:
+        return None
+    return task.dispatch or None
+    # dispatch = target.dispatch.dict() if target.dispatch else {}
+    # if not all([key in dispatch for key in ["target_ip", "target_port", "target_aet_target"]]):
+    #     send_series_event(
+    #         s_events.ERROR,
+    #         dispatch.get("series_uid", "None"),  # type: ignore
+    #         0,
+    #         dispatch.get("target_name", "None"),  # type: ignore
+    #         f"task.json is missing a mandatory key {target}",
+    #     )
+    #     return None
+    # return target.dispatch or None
 
+
+def read_task(folder) -> Optional[Task]:
+    """Reads the task file of the given folder. Returns None if the file doesn't exist or has an invalid format."""
     path = Path(folder) / mercure_names.TASKFILE
     if not path.exists():
         return None
@@ -61,15 +81,4 @@ def is_target_json_valid(folder) -> Optional[TaskDispatch]:
             f"task.json has invalid format",
         )
         return None
-    return target.dispatch or None
-    # dispatch = target.dispatch.dict() if target.dispatch else {}
-    # if not all([key in dispatch for key in ["target_ip", "target_port", "target_aet_target"]]):
-    #     send_series_event(
-    #         s_events.ERROR,
-    #         dispatch.get("series_uid", "None"),  # type: ignore
-    #         0,
-    #         dispatch.get("target_name", "None"),  # type: ignore
-    #         f"task.json is missing a mandatory key {target}",
-    #     )
-    #     return None
-    # return target.dispatch or None
+    return target
@@ -7,8 +7,11 @@ import logging
 import os
 import signal
 import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional, Set, Union
 import daiquiri
 import graphyte
 import hupper
@@ -16,10 +19,14 @@ import hupper
 import common.config as config
 import common.helper as helper
 import common.monitor as monitor
-from dispatch.status import has_been_send, is_ready_for_sending
+import common.status_board as status_board
+from common.target_health import target_health
+from dispatch.outgoing_index import OutgoingIndex
+from dispatch.retry import retry_queue
 from dispatch.send import execute
 
 from common.constants import mercure_defs, mercure_folders
+from common.types import DicomTarget, SftpTarget
 
 daiquiri.setup(
     config.get_loglevel(),
@@ -34,6 +41,17 @@ daiquiri.setup(
 logger = daiquiri.getLogger("dispatcher")
 main_loop = None  # type: helper.RepeatedTimer # type: ignore
 
+# Pool for running multiple transfers in parallel, together with the folders that are currently being sent
+# and the number of active transfers per target (guarded by dispatch_lock)
+dispatch_pool: Optional[ThreadPoolExecutor] = None
+dispatch_pool_size = 0
+dispatch_lock = threading.Lock()
+active_folders: Set[str] = set()
+active_transfers: Dict[str, int] = {}
+routing_queue = status_board.QueuePublisher("routing")
+# Readiness of the jobs in the outgoing folder, which is only checked again if a job folder has changed
+outgoing_index = OutgoingIndex()
+
 
 def terminate_process(signalNumber, frame) -> None:
     """Triggers the shutdown of the service."""
@@ -69,21 +87,119 @@ def dispatch(args) -> None:
     retry_max = config.mercure.retry_max
     retry_delay = config.mercure.retry_delay
 
+    # Jobs whose next attempt is due are checked again, while the other jobs in the retry queue are skipped
+    retry_queue.configure(config.mercure.outgoing_folder, config.mercure.retry_max_delay)
+    for name in retry_queue.pop_due(time.time()):
+        outgoing_index.invalidate(os.path.join(config.mercure.outgoing_folder, name))
+    outgoing_index.refresh(config.mercure.outgoing_folder, retry_queue)
+    routing_queue.publish(
+        outgoing_index.job_states(),
+        lambda name: status_board.describe_routing_job(Path(config.mercure.outgoing_folder) / name),
+    )
+    target_health.configure(config.mercure.outgoing_folder)
+    retry_queue.prune(outgoing_index.job_names())
+    retry_queue.flush()
+    helper.g_log("outgoing.jobs", outgoing_index.job_count())
+    helper.g_log("outgoing.retries", retry_queue.waiting_count())
+
+    if config.mercure.dispatcher_workers > 1:
+        dispatch_parallel(config.mercure.dispatcher_workers, success_folder, error_folder, retry_max, retry_delay)
+        return
+
     # TODO: Sort list so that the oldest DICOMs get dispatched first
-    with os.scandir(config.mercure.outgoing_folder) as it:
-        for entry in it:
-            if entry.is_dir() and not has_been_send(entry.path) and is_ready_for_sending(entry.path):
-                logger.info(f"Sending folder {entry.path}")
-                execute(Path(entry.path), success_folder, error_folder, retry_max, retry_delay)
-
-            # If termination is requested, stop processing series after the
-            # active one has been completed
-            if helper.is_terminated():
+    for folder, dispatch_info in outgoing_index.get_ready_jobs():
+        # Jobs for targets that are currently unavailable are skipped without using up their retries
+        target_name = dispatch_info.get("target_name", "target_name-missing")
+        if not target_health.is_available(target_name, get_target(target_name, dispatch_info)):
+            continue
+
+        logger.info(f"Sending folder {folder}")
+        execute(Path(folder), success_folder, error_folder, retry_max, retry_delay)
+        outgoing_index.invalidate(folder)
+
+        # If termination is requested, stop processing series after the
+        # active one has been completed
+        if helper.is_terminated():
+            break
+
+
+def get_dispatch_pool(workers: int) -> ThreadPoolExecutor:
+    """Returns the pool for running the transfers. The pool is recreated if the number of workers has been changed
+    in the configuration. Transfers that are still running in the previous pool will be completed."""
+    global dispatch_pool
+    global dispatch_pool_size
+
+    if dispatch_pool is None or dispatch_pool_size != workers:
+        if dispatch_pool is not None:
+            dispatch_pool.shutdown(wait=False)
+        dispatch_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatch")
+        dispatch_pool_size = workers
+    return dispatch_pool
+
+
+def get_target(target_name: str, dispatch_info) -> Union[DicomTarget, SftpTarget]:
+    """Returns the definition of the given target. The current configuration has priority over the target definition
+    that has been stored in the task file."""
+    return config.mercure.targets.get(target_name) or dispatch_info.target
+
+
+def get_target_limit(target_name: str, dispatch_info) -> int:
+    """Returns the number of transfers that may run in parallel for the given target."""
+    return max(1, get_target(target_name, dispatch_info).max_parallel_transfers)
+
+
+def release_transfer(folder: str, target_name: str, future: Future) -> None:
+    """Marks the transfer of the given folder as completed, so that the next transfer to the target can be started."""
+    with dispatch_lock:
+        active_folders.discard(folder)
+        active_transfers[target_name] = max(0, active_transfers.get(target_name, 1) - 1)
+        if active_transfers[target_name] == 0:
+            del active_transfers[target_name]
+    outgoing_index.invalidate(folder)
+
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Error sending folder {folder}: {future.exception()}")
+        monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, f"Error sending folder {folder}")
+
+
+def dispatch_parallel(workers: int, success_folder: Path, error_folder: Path, retry_max, retry_delay) -> None:
+    """Starts the transfer of all folders that are ready for sending, without waiting for the transfers to complete.
+    The number of transfers is limited both globally and per target. Folders that exceed the limits are picked up
+    again during one of the next runs."""
+    pool = get_dispatch_pool(workers)
+
+    for folder, dispatch_info in outgoing_index.get_ready_jobs():
+        if helper.is_terminated():
+            break
+
+        with dispatch_lock:
+            if len(active_folders) >= workers:
                 break
+            if folder in active_folders:
+                continue
+
+        target_name = dispatch_info.get("target_name", "target_name-missing")
+        if not target_health.is_available(target_name, get_target(target_name, dispatch_info)):
+            continue
+        target_limit = get_target_limit(target_name, dispatch_info)
+
+        with dispatch_lock:
+            if active_transfers.get(target_name, 0) >= target_limit:
+                continue
+            active_folders.add(folder)
+            active_transfers[target_name] = active_transfers.get(target_name, 0) + 1
+
+        logger.info(f"Sending folder {folder}")
+        future = pool.submit(execute, Path(folder), success_folder, error_folder, retry_max, retry_delay)
+        future.add_done_callback(lambda f, folder=folder, target_name=target_name: release_transfer(folder, target_name, f))
 
 
 def exit_dispatcher(args) -> None:
     """Stop the asyncio event loop."""
+    # Wait until the active transfers have been completed
+    if dispatch_pool is not None:
+        dispatch_pool.shutdown(wait=True)
+    retry_queue.flush()
     helper.loop.call_soon_threadsafe(helper.loop.stop)
 
 
@@ -109,6 +225,7 @@ def main(args=sys.argv[1:]) -> None:
     except Exception:
         logger.exception("Cannot start service. Going down.")
         sys.exit(1)
+    config.start_watcher()
 
     appliance_name = config.mercure.appliance_name
 
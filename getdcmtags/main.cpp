@@ -2,6 +2,8 @@
 #include <stdlib.h>
 #include <sstream>
 #include <iomanip>
+#include <errno.h>
+#include <sys/stat.h>
 
 #include "dcmtk/dcmdata/dcpath.h"
 #include "dcmtk/dcmdata/dcerror.h"
@@ -54,6 +56,8 @@ static OFString tagInstanceNumber = "";
 static OFString tagAcquisitionNumber = "";
 
 static std::string bookkeeperAddress = "";
+static bool useSeriesFolders = false;
+static bool skipRegister = false;
 
 // Escape the JSON values properly to avoid problems if DICOM tags contains invalid characters
 // (see https://stackoverflow.com/questions/7724448/simple-json-string-escape-for-c)
@@ -77,7 +81,7 @@ std::string escapeJSONValue(const OFString &s)
 
 void sendBookkeeperPost(OFString filename, OFString fileUID, OFString seriesUID)
 {
-    if (bookkeeperAddress.empty())
+    if (bookkeeperAddress.empty() || skipRegister)
     {
         return;
     }
@@ -259,14 +263,26 @@ int main(int argc, char *argv[])
         std::cout << "getdcmtags ver " << VERSION << std::endl;
         std::cout << "-------------------" << std::endl
                   << std::endl;
-        std::cout << "Usage: [dcm file to analyze] [ip:port of bookkeeper]" << std::endl
+        std::cout << "Usage: [dcm file to analyze] [ip:port of bookkeeper] [--series-folders] [--skip-register]" << std::endl
                   << std::endl;
         return 0;
     }
 
-    if (argc > 2)
+    for (int i = 2; i < argc; i++)
     {
-        bookkeeperAddress = std::string(argv[2]);
+        if (std::string(argv[i]) == "--series-folders")
+        {
+            useSeriesFolders = true;
+        }
+        else if (std::string(argv[i]) == "--skip-register")
+        {
+            // The received files are registered on the bookkeeper by the router once the series is complete
+            skipRegister = true;
+        }
+        else
+        {
+            bookkeeperAddress = std::string(argv[i]);
+        }
     }
 
     OFString origFilename = OFString(argv[1]);
@@ -347,26 +363,53 @@ int main(int argc, char *argv[])
     }
 
     OFString newFilename = tagSeriesInstanceUID + "#" + origFilename;
+    OFString seriesPath = path;
 
-    if (rename((path + origFilename).c_str(), (path + newFilename + ".dcm").c_str()) != 0)
+    if (useSeriesFolders)
     {
-        OFString errorString = "Unable to rename DICOM file to ";
-        errorString.append(newFilename);
-        errorString.append("\n");
-        writeErrorInformation(path + origFilename, errorString);
-        return 1;
+        // Collect the files of each series in a separate subfolder, so that the router can move
+        // the complete series with a single rename operation
+        seriesPath = path + tagSeriesInstanceUID + "/";
     }
 
-    if (!writeTagsFile(path + newFilename, origFilename))
+    // The tags file is written before the DICOM file is moved into place, so that the router never finds a
+    // DICOM file without tags file. The series folder might get moved away by the router in the moment the
+    // file is added, so create the folder and the tags file again if renaming the file into the folder fails
+    int renameResult = -1;
+    for (int attempt = 0; attempt < 3; attempt++)
     {
-        OFString errorString = "Unable to write tagsfile file for ";
+        if (useSeriesFolders && (mkdir(seriesPath.c_str(), 0777) != 0) && (errno != EEXIST))
+        {
+            break;
+        }
+        if (!writeTagsFile(seriesPath + newFilename, origFilename))
+        {
+            struct stat folderInfo;
+            if (useSeriesFolders && (stat(seriesPath.c_str(), &folderInfo) != 0))
+            {
+                // The series folder has been moved away after it was created
+                continue;
+            }
+            OFString errorString = "Unable to write tagsfile file for ";
+            errorString.append(newFilename);
+            errorString.append("\n");
+            writeErrorInformation(path + origFilename, errorString);
+            return 1;
+        }
+        renameResult = rename((path + origFilename).c_str(), (seriesPath + newFilename + ".dcm").c_str());
+        if ((renameResult == 0) || (errno != ENOENT) || (!useSeriesFolders))
+        {
+            break;
+        }
+    }
+
+    if (renameResult != 0)
+    {
+        remove((seriesPath + newFilename + ".tags").c_str());
+        OFString errorString = "Unable to rename DICOM file to ";
         errorString.append(newFilename);
         errorString.append("\n");
         writeErrorInformation(path + origFilename, errorString);
-
-        // Rename DICOM file back to original name, so that the name matches to
-        // the .error file and can be moved to the error folder by the router
-        rename((path + newFilename + ".dcm").c_str(), (path + origFilename).c_str());
         return 1;
     }
 
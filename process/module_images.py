@@ -0,0 +1,161 @@
+"""
+module_images.py
+================
+Management of the Docker images used by the processing modules. The processor keeps a single Docker client and pulls
+the images of all configured modules in the background whenever the configuration changes, so that the first job after
+a module update doesn't need to wait for the image download while occupying a processing slot.
+"""
+
+# Standard python includes
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+import daiquiri
+import docker
+
+# App-specific includes
+import common.monitor as monitor
+import common.config as config
+
+
+logger = daiquiri.getLogger("module_images")
+
+# Shared Docker client and the host path of the mercure_data volume (only needed if mercure runs inside Docker)
+docker_client: Optional[docker.DockerClient] = None
+base_path: Optional[Path] = None
+client_lock = threading.Lock()
+
+# Single worker that pulls the images one after the other, the configuration version for which the images have been
+# requested, and the pulls that are currently active (jobs using the image wait until the pull has finished)
+pull_pool: Optional[ThreadPoolExecutor] = None
+pulled_config_version = -1
+active_pulls: Dict[str, threading.Event] = {}
+pull_lock = threading.Lock()
+# Maximum time that a job waits for a background pull of its image (in seconds). After that, the container is started
+# anyway, which pulls the image itself if needed
+PULL_WAIT_TIMEOUT = 300
+
+
+def get_docker_client() -> docker.DockerClient:
+    """Returns the Docker client of the processor, which is created on first use."""
+    global docker_client
+    with client_lock:
+        if docker_client is None:
+            docker_client = docker.from_env()
+        return docker_client
+
+
+def get_base_path() -> Path:
+    """Returns the host path of the mercure data folder. The volume is only inspected once, as it can't change while
+    the processor is running."""
+    global base_path
+    with client_lock:
+        if base_path is not None:
+            return base_path
+
+    try:
+        path = Path(get_docker_client().api.inspect_volume("mercure_data")["Options"]["device"])
+    except Exception:
+        path = Path("/opt/mercure/data")
+        logger.error(f"Unable to find volume 'mercure_data'; assuming data directory is {path}")
+        # Don't cache the fallback, so that the volume is inspected again for the next job
+        return path
+
+    logger.info(f"Base path: {path}")
+    with client_lock:
+        base_path = path
+    return path
+
+
+def get_module_tags() -> List[str]:
+    """Returns the Docker tags of all configured modules (without duplicates)."""
+    tags: List[str] = []
+    for module in config.mercure.modules.values():
+        if module.docker_tag and module.docker_tag not in tags:
+            tags.append(module.docker_tag)
+    return tags
+
+
+def update_module_images() -> None:
+    """Requests pulling the images of the configured modules if the configuration has changed since the last call."""
+    global pull_pool
+    global pulled_config_version
+
+    if pulled_config_version == config.get_section_version("modules"):
+        return
+    pulled_config_version = config.get_section_version("modules")
+
+    if pull_pool is None:
+        pull_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="module_images")
+
+    for tag in get_module_tags():
+        with pull_lock:
+            if tag in active_pulls:
+                continue
+            active_pulls[tag] = threading.Event()
+        future = pull_pool.submit(pull_image, tag)
+        future.add_done_callback(lambda f, tag=tag: finish_pull(tag))
+
+
+def pull_image(tag: str) -> bool:
+    """Pulls the given image and logs the download progress. If the image can't be pulled (e.g., because it has been
+    built locally), it is checked whether the image exists on the server. Returns True if the image can be used."""
+    client = get_docker_client()
+    repository, name = docker.utils.parse_repository_tag(tag)
+    logger.info(f"Pulling image {tag}")
+
+    try:
+        layers: Dict[str, str] = {}
+        completed = 0
+        for line in client.api.pull(repository, name or "latest", stream=True, decode=True):
+            layer = line.get("id")
+            progress = line.get("status", "")
+            if not layer or progress.startswith("Pulling from"):
+                continue
+            layers[layer] = progress
+            done = sum(1 for value in layers.values() if value in ("Pull complete", "Already exists"))
+            if done != completed:
+                completed = done
+                logger.info(f"Pulling image {tag}: {completed} of {len(layers)} layers complete")
+        logger.info(f"Image {tag} is up-to-date")
+        return True
+    except Exception as e:
+        logger.warning(f"Unable to pull image {tag}: {e}")
+
+    try:
+        client.images.get(tag)
+        logger.info(f"Using local image {tag}")
+        return True
+    except Exception:
+        logger.error(f"Image {tag} is not available")
+        monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, f"Unable to pull image {tag}")
+        return False
+
+
+def finish_pull(tag: str) -> None:
+    """Marks the pull as complete and releases the jobs waiting for the image."""
+    with pull_lock:
+        event = active_pulls.pop(tag, None)
+    if event is not None:
+        event.set()
+
+
+def wait_for_image(tag: str, timeout: Optional[float] = PULL_WAIT_TIMEOUT) -> bool:
+    """Waits until a pull of the given image that is currently running has been completed. Returns False if the pull
+    has not been completed within the timeout."""
+    with pull_lock:
+        event = active_pulls.get(tag)
+    if event is None:
+        return True
+    logger.info(f"Waiting for image {tag} to be pulled")
+    if event.wait(timeout):
+        return True
+    logger.warning(f"Image {tag} has not been pulled within {timeout} seconds")
+    return False
+
+
+def shutdown() -> None:
+    """Cancels the pending pulls when the processor terminates."""
+    if pull_pool is not None:
+        pull_pool.shutdown(wait=False)
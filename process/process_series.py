@@ -5,9 +5,12 @@ Helper functions for mercure's processor module
 """
 
 # Standard python includes
+import hashlib
 import json
+import re
+import threading
 from pathlib import Path
-from typing import Any, Dict, cast, Optional
+from typing import Any, Dict, Tuple, cast, Optional
 import json
 import shutil
 import daiquiri
@@ -21,15 +24,82 @@ from jinja2 import Template
 import common.monitor as monitor
 import common.helper as helper
 import common.config as config
+import common.retention as retention
+import process.module_images as module_images
 from common.constants import mercure_names
+from common.manifest import remove_manifest
 from common.types import Task, Module
 
 
 logger = daiquiri.getLogger("process_series")
 
+# Settings of the (Nomad-style) resource requirements of modules that are also respected when running with Docker
+resource_pattern = re.compile(r"\b(memory|cores)\s*=\s*([0-9.]+)")
+
+
+def get_module_resources(module: Optional[Module]) -> Tuple[int, float]:
+    """Returns the memory (in MB) and the number of CPU cores requested in the resource requirements of the module,
+    which are given in Nomad's HCL format (e.g., "memory = 4096 cores = 2"). Returns 0 if a value is not specified."""
+    memory = 0
+    cores = 0.0
+    if module is None or not module.resources:
+        return memory, cores
+    for key, value in resource_pattern.findall(module.resources):
+        try:
+            if key == "memory":
+                memory = int(float(value))
+            else:
+                cores = float(value)
+        except ValueError:
+            logger.warning(f"Invalid resource requirement {key} = {value}")
+    return memory, cores
+
+
+# Connection to Nomad and the hashes of the job specifications that have been registered (per job ID), so that the
+# parameterized jobs only need to be registered again if the module configuration has changed
+nomad_connection: Optional[nomad.Nomad] = None
+registered_jobs: Dict[str, str] = {}
+nomad_lock = threading.Lock()
+# Prefix of the IDs of the parameterized processing jobs (followed by the module name)
+NOMAD_JOB_PREFIX = "processor-"
+
+
+def get_nomad_connection() -> nomad.Nomad:
+    global nomad_connection
+    with nomad_lock:
+        if nomad_connection is None:
+            nomad_connection = nomad.Nomad(host="172.17.0.1", timeout=5)
+        return nomad_connection
+
+
+def register_nomad_job(job_id: str, rendered: str) -> bool:
+    """Registers the parameterized job for the module, unless the same job specification has been registered already."""
+    spec_hash = hashlib.sha256(rendered.encode()).hexdigest()
+    with nomad_lock:
+        if registered_jobs.get(job_id) == spec_hash:
+            return True
+
+    nomad_connection = get_nomad_connection()
+    logger.info(rendered)
+    try:
+        job_definition = nomad_connection.jobs.parse(rendered)
+    except nomad.api.exceptions.BadRequestNomadException as err:
+        logger.error(err)
+        print(err.nomad_resp.reason)
+        print(err.nomad_resp.text)
+        return False
+    logger.info(job_definition)
+
+    job_definition["ID"] = job_id
+    job_definition["Name"] = job_id
+    nomad_connection.job.register_job(job_definition["ID"], dict(Job=job_definition))
+    with nomad_lock:
+        registered_jobs[job_id] = spec_hash
+    return True
+
 
 def nomad_runtime(task: Task, folder: str) -> bool:
-    nomad_connection = nomad.Nomad(host="172.17.0.1", timeout=5)
+    nomad_connection = get_nomad_connection()
 
     if not task.process:
         return False
@@ -46,23 +116,23 @@ def nomad_runtime(task: Task, folder: str) -> bool:
             image=module.docker_tag, constraints=module.constraints, resources=module.resources
         )
 
-    logger.info(rendered)
-    try:
-        job_definition = nomad_connection.jobs.parse(rendered)
-    except nomad.api.exceptions.BadRequestNomadException as err:
-        logger.error(err)
-        print(err.nomad_resp.reason)
-        print(err.nomad_resp.text)
+    job_id = f"{NOMAD_JOB_PREFIX}{task.process.module_name}"
+    if not register_nomad_job(job_id, rendered):
         return False
-    logger.info(job_definition)
-
-    job_definition["ID"] = f"processor-{task.process.module_name}"
-    job_definition["Name"] = f"processor-{task.process.module_name}"
-    nomad_connection.job.register_job(job_definition["ID"], dict(Job=job_definition))
 
     meta = {"PATH": f_path.name}
     logger.debug(meta)
-    job_info = nomad_connection.job.dispatch_job(f"processor-{task.process.module_name}", meta=meta)
+    try:
+        job_info = nomad_connection.job.dispatch_job(job_id, meta=meta)
+    except nomad.api.exceptions.BaseNomadException:
+        # The job might have been removed from Nomad since it was registered (e.g., after a restart of Nomad), so
+        # register the job again and retry once
+        logger.warning(f"Unable to dispatch job {job_id}, registering job again")
+        with nomad_lock:
+            registered_jobs.pop(job_id, None)
+        if not register_nomad_job(job_id, rendered):
+            return False
+        job_info = nomad_connection.job.dispatch_job(job_id, meta=meta)
     with open(f_path / "nomad_job.json", "w") as json_file:
         json.dump(job_info, json_file, indent=4)
 
@@ -70,7 +140,7 @@ def nomad_runtime(task: Task, folder: str) -> bool:
 
 
 def docker_runtime(task: Task, folder: str) -> bool:
-    docker_client = docker.from_env()
+    docker_client = module_images.get_docker_client()
 
     if not task.process:
         return False
@@ -92,13 +162,7 @@ def docker_runtime(task: Task, folder: str) -> bool:
 
     if config.get_runner() == "docker":
         # We want to bind the correct path into the processor, but if we're inside docker we need to use the host path
-        try:
-            base_path = Path(docker_client.api.inspect_volume("mercure_data")['Options']['device'])
-        except Exception as e:
-            base_path = Path("/opt/mercure/data")
-            logger.error(f"Unable to find volume 'mercure_data'; assuming data directory is {base_path}")
-        
-        logger.info(f"Base path: {base_path}")
+        base_path = module_images.get_base_path()
         real_folder = base_path / "processing" / real_folder.stem
 
     default_volumes = {
@@ -120,6 +184,20 @@ def docker_runtime(task: Task, folder: str) -> bool:
     # Merge the two dictionaries
     merged_volumes = {**default_volumes, **additional_volumes}
 
+    # The requested resources are only used for scheduling the processing slots, unless the containers should be
+    # limited to them (a module exceeding its request would otherwise be killed or throttled)
+    if config.mercure.processing_hard_limits:
+        memory, cores = get_module_resources(module)
+        if memory and "mem_limit" not in arguments:
+            arguments["mem_limit"] = f"{memory}m"
+        if cores and "nano_cpus" not in arguments:
+            arguments["nano_cpus"] = int(cores * 1e9)
+
+    # If the image is currently pulled in the background, wait for the pull instead of starting a second download.
+    # If the pull takes too long, the container is started anyway (Docker then pulls the image if it is missing)
+    if not module_images.wait_for_image(docker_tag, module_images.PULL_WAIT_TIMEOUT):
+        logger.info(f"Starting container without waiting for the pull of {docker_tag}")
+
     processing_success = True
     # Run the container, handle errors of running the container
     try:
@@ -270,9 +348,12 @@ def move_out_folder(source_folder_str, destination_folder_str, move_all=False) -
         if move_all:
             shutil.move(str(source_folder), target_folder)
         else:
+            # The results of the module replace the received files, so the manifest of the task file is outdated
+            remove_manifest(source_folder / "out")
             shutil.move(str(source_folder / "out"), target_folder)
             lockfile = source_folder / mercure_names.LOCK
             lockfile.unlink()
+        retention.record(target_folder)
 
     except:
         logger.info(f"Error moving folder {source_folder} to {destination_folder}")
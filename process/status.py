@@ -9,6 +9,7 @@ from pathlib import Path
 
 # App-specific includes
 from common.constants import mercure_names
+from common.manifest import has_dicom_files, read_manifest
 
 
 def is_ready_for_processing(folder) -> bool:
@@ -17,6 +18,6 @@ def is_ready_for_processing(folder) -> bool:
     folder_status = (
         not (path / mercure_names.LOCK).exists()
         and not (path / mercure_names.PROCESSING).exists()
-        and len(list(path.glob("*.dcm"))) > 0
+        and has_dicom_files(path, read_manifest(path))
     )
     return folder_status
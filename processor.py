@@ -10,21 +10,33 @@ import signal
 import os
 import sys
 import json
+import threading
 import graphyte
 import logging
 import daiquiri
-import nomad
+from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 import hupper
 
 # App-specific includes
 import common.helper as helper
 import common.config as config
 import common.monitor as monitor
-from common.constants import mercure_defs
+import common.status_board as status_board
+from common.constants import mercure_defs, mercure_names, mercure_options
+from common.types import Task
 
 from process.status import is_ready_for_processing
-from process.process_series import process_series, move_results
+from process.process_series import (
+    NOMAD_JOB_PREFIX,
+    get_module_resources,
+    get_nomad_connection,
+    move_results,
+    process_series,
+)
+import process.module_images as module_images
 
 
 daiquiri.setup(
@@ -44,20 +56,29 @@ main_loop = None  # type: helper.RepeatedTimer # type: ignore
 processor_lockfile = None
 processor_is_locked = False
 
-try:
-    nomad_connection = nomad.Nomad(host="172.17.0.1", timeout=5)
-    logger.info("Connected to Nomad")
-except:
-    nomad_connection = None
+# Pool for running multiple processing jobs in parallel, together with the memory (in MB) and CPU cores reserved
+# by the active jobs (guarded by slot_lock)
+processing_pool: Optional[ThreadPoolExecutor] = None
+processing_pool_size = 0
+slot_lock = threading.Lock()
+active_jobs: Dict[str, Tuple[int, float]] = {}
+
+# Number of scheduling runs (the priority of urgent cases is ignored every third run, so that normal cases can't
+# starve) and the priorities of the waiting cases, which don't need to be read from the task files again
+scheduler_runs = 0
+task_priorities: Dict[str, str] = {}
+processing_queue = status_board.QueuePublisher("processing")
 
 
 def search_folder(counter) -> bool:
     global processor_lockfile
     global processor_is_locked
-    global nomad_connection
     helper.g_log("events.run", 1)
 
     tasks = {}
+    running_jobs: Dict[str, str] = {}
+    # Jobs shown in the processing queue of the web interface (True if the job is currently processing)
+    queue_states: Dict[str, bool] = {}
 
     complete = []
     for entry in os.scandir(config.mercure.processing_folder):
@@ -67,23 +88,34 @@ def search_folder(counter) -> bool:
                 logger.debug(f"{entry.name} ready for processing")
                 modification_time = entry.stat().st_mtime
                 tasks[entry.path] = modification_time
+                queue_states[entry.name] = False
                 continue
 
             # Some tasks are actually currently processing
-            if (Path(entry.path) / ".processing").exists() and (Path(entry.path) / "nomad_job.json").exists():
+            if not (Path(entry.path) / ".processing").exists():
+                continue
+            queue_states[entry.name] = True
+            if (Path(entry.path) / "nomad_job.json").exists():
                 logger.debug(f"{entry.name} currently processing")
                 with open(Path(entry.path) / "nomad_job.json", "r") as f:
                     id = json.load(f).get("DispatchedJobID")
                 logger.debug(f"Job id: {id}")
-                job_info = nomad_connection.job.get_job(id)
-                # job_allocations = nomad_connection.job.get_allocations(id)
-                status = job_info.get("Status")
-                if status == "dead":
-                    logger.debug(f"{entry.name} is complete")
-                    # logger.debug(job_allocations)
-                    complete.append(dict(path=Path(entry.path)))  # , info=job_info, allocations=job_allocations))
-                else:
-                    logger.debug(f"Status: {status}")
+                running_jobs[entry.path] = id
+
+    processing_queue.publish(
+        queue_states,
+        lambda name: status_board.describe_processing_job(Path(config.mercure.processing_folder) / name),
+    )
+
+    # Query the status of all dispatched Nomad jobs at once
+    job_status = get_job_status(list(running_jobs.values()))
+    for path, id in running_jobs.items():
+        status = job_status.get(id)
+        if status == "dead":
+            logger.debug(f"{Path(path).name} is complete")
+            complete.append(dict(path=Path(path)))
+        else:
+            logger.debug(f"Status: {status}")
 
     # Move complete tasks
     for c in complete:
@@ -136,9 +168,13 @@ def search_folder(counter) -> bool:
     if not len(tasks):
         return False
 
-    sorted_tasks = sorted(tasks)
-    # TODO: Add priority sorting. However, do not honor the priority flag for every third run
-    #       so that stagnation of cases is avoided
+    sorted_tasks = prioritize_tasks(tasks)
+    if not sorted_tasks:
+        return False
+
+    if config.mercure.processing_slots > 1:
+        start_processing_jobs(sorted_tasks, config.mercure.processing_slots)
+        return False
 
     # Only process one case at a time because the processing might take a while and
     # another instance might have processed the other entries already. So the folder
@@ -156,6 +192,189 @@ def search_folder(counter) -> bool:
         return False
 
 
+def get_job_status(job_ids: List[str]) -> Dict[str, str]:
+    """Returns the status of the given Nomad jobs. The jobs are listed with a single request (the dispatched jobs
+    share the prefix of their parameterized job). Jobs missing in the list are queried individually."""
+    if not job_ids:
+        return {}
+
+    nomad_connection = get_nomad_connection()
+    job_status: Dict[str, str] = {}
+    # Without a common prefix that is more specific than the one of all processing jobs, listing the jobs would
+    # return every job on the cluster, so the jobs are only queried individually
+    prefix = os.path.commonprefix(job_ids)
+    if len(prefix) > len(NOMAD_JOB_PREFIX):
+        try:
+            for job in nomad_connection.jobs.get_jobs(prefix=prefix):
+                job_status[job.get("ID")] = job.get("Status")
+        except Exception:
+            logger.exception("Unable to list Nomad jobs")
+
+    for id in job_ids:
+        if id not in job_status:
+            try:
+                job_status[id] = nomad_connection.job.get_job(id).get("Status")
+            except Exception:
+                logger.exception(f"Unable to get status of Nomad job {id}")
+    return job_status
+
+
+def get_task_priority(folder: str) -> str:
+    """Returns the priority of the case in the given folder, as stored in the task file by the router."""
+    if folder in task_priorities:
+        return task_priorities[folder]
+    priority = mercure_options.NORMAL
+    try:
+        with open(Path(folder) / mercure_names.TASKFILE, "r") as f:
+            priority = json.load(f).get("info", {}).get("priority", mercure_options.NORMAL)
+    except Exception:
+        # Invalid task files are reported by process_series
+        pass
+    task_priorities[folder] = priority
+    return priority
+
+
+def prioritize_tasks(tasks: Dict[str, float]) -> List[str]:
+    """
+    Sorts the cases that are ready for processing in the order in which they should be processed. Urgent cases come
+    first, followed by normal cases and offpeak cases, each sorted by arrival time. Every third run, urgent cases are
+    treated like normal cases so that normal cases make progress during a constant stream of urgent cases. Offpeak
+    cases are always processed last and only during the offpeak window.
+    """
+    global scheduler_runs
+    global task_priorities
+    scheduler_runs += 1
+    honor_urgent = scheduler_runs % 3 != 0
+    offpeak = helper.is_offpeak(config.mercure.offpeak_start, config.mercure.offpeak_end, datetime.now().time())
+
+    # Forget the priorities of cases that have left the queue
+    task_priorities = {folder: priority for folder, priority in task_priorities.items() if folder in tasks}
+
+    ranked_tasks = []
+    for folder, modification_time in tasks.items():
+        priority = get_task_priority(folder)
+        if priority == mercure_options.OFFPEAK:
+            if not offpeak:
+                continue
+            rank = 2
+        elif priority == mercure_options.URGENT and honor_urgent:
+            rank = 0
+        else:
+            rank = 1
+        ranked_tasks.append((rank, modification_time, folder))
+
+    if len(ranked_tasks) < len(tasks):
+        logger.debug(f"Holding {len(tasks) - len(ranked_tasks)} offpeak cases until the offpeak window")
+    return [folder for _, _, folder in sorted(ranked_tasks)]
+
+
+def get_processing_pool(slots: int) -> ThreadPoolExecutor:
+    """Returns the pool for running the processing jobs. The pool is recreated if the number of slots has been changed
+    in the configuration. Jobs that are still running in the previous pool will be completed."""
+    global processing_pool
+    global processing_pool_size
+
+    if processing_pool is None or processing_pool_size != slots:
+        if processing_pool is not None:
+            processing_pool.shutdown(wait=False)
+        logger.info(f"Starting {slots} processing slots")
+        processing_pool = ThreadPoolExecutor(max_workers=slots, thread_name_prefix="process_series")
+        processing_pool_size = slots
+    return processing_pool
+
+
+def get_job_resources(folder: str) -> Tuple[int, float]:
+    """Returns the resources requested by the module that will process the given folder."""
+    try:
+        with open(Path(folder) / mercure_names.TASKFILE, "r") as f:
+            task: Task = Task(**json.load(f))
+        if task.process:
+            return get_module_resources(task.process.module_config)  # type: ignore
+    except Exception:
+        # Invalid task files are reported by process_series
+        pass
+    return 0, 0
+
+
+def resources_available(memory: int, cores: float) -> bool:
+    """Checks if the requested resources are available considering the jobs that are already running. A job is
+    always started if no other job is running, even if it requests more resources than the server has."""
+    if not active_jobs:
+        return True
+    used_memory = sum(job[0] for job in active_jobs.values())
+    used_cores = sum(job[1] for job in active_jobs.values())
+    total_memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    total_cores = os.cpu_count() or 1
+    return (used_memory + memory <= total_memory) and (used_cores + cores <= total_cores)
+
+
+def claim_folder(folder: str) -> bool:
+    """Creates the .processing marker in the given folder. Returns False if the folder has been claimed already
+    (by another slot or another processor instance)."""
+    try:
+        os.close(os.open(Path(folder) / mercure_names.PROCESSING, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        return False
+    except Exception:
+        logger.exception(f"Unable to create lock file in {folder}")
+        monitor.send_event(
+            monitor.m_events.PROCESSING,
+            monitor.severity.ERROR,
+            f"Unable to create lock file in processing folder {folder}",
+        )
+        return False
+
+
+def release_slot(folder: str, future: Future) -> None:
+    """Frees the processing slot and the reserved resources once the job has finished."""
+    with slot_lock:
+        active_jobs.pop(folder, None)
+
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Problems while processing series {folder}: {future.exception()}")
+        monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, "Exception while processing series")
+
+
+def start_processing_jobs(tasks: List[str], slots: int) -> None:
+    """Starts processing jobs for the given folders in the given order, as long as processing slots and resources
+    are available. Doesn't wait for the jobs to complete."""
+    pool = get_processing_pool(slots)
+
+    for task in tasks:
+        if helper.is_terminated():
+            return
+
+        with slot_lock:
+            if len(active_jobs) >= slots:
+                break
+            if task in active_jobs:
+                continue
+
+        memory, cores = get_job_resources(task)
+        with slot_lock:
+            # Don't let smaller jobs overtake a job that is waiting for resources, so that it won't starve
+            if not resources_available(memory, cores):
+                break
+
+        if not claim_folder(task):
+            continue
+
+        with slot_lock:
+            active_jobs[task] = (memory, cores)
+
+        logger.info(f"Starting processing of {task} ({len(active_jobs)} of {slots} slots in use)")
+        future = pool.submit(process_series, task)
+        future.add_done_callback(lambda f, task=task: release_slot(task, f))
+
+    helper.g_log("processing.active", len(active_jobs))
+
+
+def uses_docker() -> bool:
+    """Checks if the processing jobs are run with Docker (and not with Nomad)."""
+    return config.mercure.process_runner != "nomad" and config.get_runner() in ("docker", "systemd")
+
+
 def run_processor(args=None) -> None:
     """Main processing function that is called every second."""
     if helper.is_terminated():
@@ -169,6 +388,10 @@ def run_processor(args=None) -> None:
         )
         return
 
+    # Pull the images of the processing modules in the background if the configuration has changed
+    if uses_docker():
+        module_images.update_module_images()
+
     call_counter = 0
 
     while search_folder(call_counter):
@@ -180,6 +403,10 @@ def run_processor(args=None) -> None:
 
 def exit_processor(args) -> None:
     """Callback function that is triggered when the process terminates. Stops the asyncio event loop."""
+    # Wait until the active processing jobs have been completed
+    if processing_pool is not None:
+        processing_pool.shutdown(wait=True)
+    module_images.shutdown()
     helper.loop.call_soon_threadsafe(helper.loop.stop)
 
 
@@ -219,6 +446,7 @@ def main(args=sys.argv[1:]) -> None:
     except Exception:
         logger.exception("Cannot start service. Going down.")
         sys.exit(1)
+    config.start_watcher()
 
     appliance_name = config.mercure.appliance_name
 
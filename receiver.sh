@@ -19,6 +19,8 @@ fi
 incoming=$(cat $config | jq -r '.incoming_folder')
 port=$(cat $config | jq '.port')
 bookkeeper=$(cat $config | jq -r '.bookkeeper')
+series_folders=$(cat $config | jq -r '.incoming_series_folders')
+bulk_register=$(cat $config | jq -r '.bookkeeper_bulk_register')
 
 # Check if incoming folder exists
 if [ ! -d "$incoming" ]; then
@@ -56,6 +58,24 @@ else
     bookkeeper=" $bookkeeper"
 fi
 
+# Check if the received series should be collected in separate subfolders
+if [ "$series_folders" = "true" ]
+then
+    echo "Using series subfolders"
+    series_folders=" --series-folders"
+else
+    series_folders=""
+fi
+
+# Check if the received files should be registered on the bookkeeper by the router (per series) instead of here
+if [ "$bulk_register" = "true" ]
+then
+    echo "Registering received files per series"
+    bulk_register=" --skip-register"
+else
+    bulk_register=""
+fi
+
 echo ""
 echo "Starting receiver process..."
-storescp --fork --promiscuous -od "$incoming" +uf -xcr "$binary $incoming/#f$bookkeeper" $port
+storescp --fork --promiscuous -od "$incoming" +uf -xcr "$binary $incoming/#f$bookkeeper$series_folders$bulk_register" $port
@@ -7,6 +7,7 @@ mercure's central router module that evaluates the routing rules and decides whi
 # Standard python includes
 import time
 import signal
+import threading
 import os
 import sys
 import graphyte
@@ -14,15 +15,19 @@ import logging
 import daiquiri
 import hupper
 
-from typing import Dict, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
 
 # App-specific includes
 from common.constants import mercure_defs, mercure_names
 import common.helper as helper
 import common.config as config
 import common.monitor as monitor
+import common.status_board as status_board
 from routing.route_series import route_series, route_error_files
 from routing.route_studies import route_studies
+from routing.study_index import study_index
+from routing.incoming_index import IncomingIndex
 
 # Setup daiquiri logger
 daiquiri.setup(
@@ -38,6 +43,13 @@ daiquiri.setup(
 # Create local logger instance
 logger = daiquiri.getLogger("router")
 main_loop = None  # type: helper.RepeatedTimer # type: ignore
+incoming_index = IncomingIndex()
+studies_queue = status_board.QueuePublisher("studies")
+routing_pool: Optional[ThreadPoolExecutor] = None
+routing_pool_size = 0
+# Series that have been submitted to the routing workers and are not completed yet
+active_series: Set[str] = set()
+active_series_lock = threading.Lock()
 
 
 def terminate_process(signalNumber, frame) -> None:
@@ -73,65 +85,116 @@ def run_router(args=None) -> None:
         monitor.send_event(monitor.m_events.CONFIG_UPDATE, monitor.severity.WARNING, error_message)
         return
 
-    filecount = 0
-    series: Dict[str, float] = {}
-    complete_series = {}
-
-    error_files_found = False
-
-    # Check the incoming folder for completed series. To this end, generate a map of all
-    # series in the folder with the timestamp of the latest DICOM file as value
-    for entry in os.scandir(config.mercure.incoming_folder):
-        if entry.name.endswith(mercure_names.TAGS) and not entry.is_dir():
-            filecount += 1
-            seriesString = entry.name.split(mercure_defs.SEPARATOR, 1)[0]
-            modificationTime = entry.stat().st_mtime
-
-            if seriesString in series.keys():
-                if modificationTime > series[seriesString]:
-                    series[seriesString] = modificationTime
-            else:
-                series[seriesString] = modificationTime
-        # Check if at least one .error file exists. In that case, the incoming folder should
-        # be searched for .error files at the end of the update run
-        if (not error_files_found) and entry.name.endswith(mercure_names.ERROR):
-            error_files_found = True
+    # Bring the index of the incoming folder up-to-date. Usually, the index is maintained from file-system
+    # notifications, but the folder is scanned completely if notifications are not available or if the
+    # periodic rescan is due
+    incoming_index.refresh(config.mercure.incoming_folder, config.mercure.router_rescan_interval)
 
     # Check if any of the series exceeds the "series complete" threshold
-    for series_entry in series:
-        if (time.time() - series[series_entry]) > config.mercure.series_complete_trigger:
-            complete_series[series_entry] = series[series_entry]
-
-    # logger.info(f'Files found     = {filecount}')
-    # logger.info(f'Series found    = {len(series)}')
-    # logger.info(f'Complete series = {len(complete_series)}')
-    helper.g_log("incoming.files", filecount)
-    helper.g_log("incoming.series", len(series))
-
-    # Process all complete series
-    for complete_entry in sorted(complete_series):
-        try:
-            route_series(complete_entry)
-        except Exception:
-            error_message = f"Problems while processing series {complete_entry}"
-            logger.exception(error_message)
-            monitor.send_series_event(monitor.s_events.ERROR, complete_entry, 0, "", error_message)
-            monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
-        # If termination is requested, stop processing series after the active one has been completed
+    complete_series = incoming_index.get_complete_series(config.mercure.series_complete_trigger)
+
+    helper.g_log("incoming.files", incoming_index.file_count())
+    helper.g_log("incoming.series", incoming_index.series_count())
+
+    # Process all complete series. If multiple routing workers have been configured, different series
+    # are routed in parallel (every series is still protected by its own lock file)
+    if config.mercure.router_workers > 1:
+        route_parallel(config.mercure.router_workers, complete_series)
         if helper.is_terminated():
             return
-
-    if error_files_found:
+    else:
+        for complete_entry in sorted(complete_series):
+            route_complete_series(complete_entry, complete_series[complete_entry])
+            # If termination is requested, stop processing series after the active one has been completed
+            if helper.is_terminated():
+                return
+
+    # Check if at least one .error file exists. In that case, the incoming folder should
+    # be searched for .error files
+    if incoming_index.has_error_files():
         route_error_files()
 
     # Now, check if studies in the studies folder are ready for routing/processing
     route_studies()
+    studies = study_index.get_studies()
+    studies_queue.publish(studies, lambda name: studies[name].info)
+
+
+def route_complete_series(series_uid: str, file_list: List[str]) -> None:
+    """
+    Routes a complete series and removes its files from the incoming index. Called either directly or from
+    the routing workers
+    """
+    # Series that are still waiting for a worker when termination is requested are left for the next start
+    if helper.is_terminated():
+        return
+    try:
+        routed = route_series(series_uid, file_list)
+    except Exception:
+        routed = False
+        error_message = f"Problems while processing series {series_uid}"
+        logger.exception(error_message)
+        monitor.send_series_event(monitor.s_events.ERROR, series_uid, 0, "", error_message)
+        monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
+    # If the series has not been routed (e.g., because it is locked), the files remain in the index, so that the
+    # series is tried again during the next run. Files that have been moved nevertheless are removed by the
+    # notifications or the next rescan
+    if routed:
+        incoming_index.remove_files(series_uid, file_list)
+
+
+def route_parallel(workers: int, complete_series: Dict[str, List[str]]) -> None:
+    """
+    Submits the complete series to the routing workers without waiting for the routing to finish, so that series
+    completing during the routing of a large series are picked up with the next run. Series that are still being
+    routed are skipped. At most one series per worker is submitted, the remaining series are picked up by the next
+    runs, so that no backlog builds up in the queue of the pool
+    """
+    pool = get_routing_pool(workers)
+    for series_uid in sorted(complete_series):
+        # If termination is requested, no further series are submitted. The active ones are completed on exit
+        if helper.is_terminated():
+            return
+        with active_series_lock:
+            if len(active_series) >= workers:
+                return
+            if series_uid in active_series:
+                continue
+            active_series.add(series_uid)
+        future = pool.submit(route_complete_series, series_uid, complete_series[series_uid])
+        future.add_done_callback(lambda f, series_uid=series_uid: release_series(series_uid, f))
+
+
+def release_series(series_uid: str, future: Future) -> None:
+    """Marks the routing of the given series as completed, so that new files of the series can be routed."""
+    with active_series_lock:
+        active_series.discard(series_uid)
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Error routing series {series_uid}: {future.exception()}")
+
+
+def get_routing_pool(workers: int) -> ThreadPoolExecutor:
+    """
+    Returns the pool of routing workers. The pool is recreated if the configured number of workers has changed
+    """
+    global routing_pool
+    global routing_pool_size
+    if routing_pool is None or routing_pool_size != workers:
+        if routing_pool is not None:
+            routing_pool.shutdown(wait=True)
+        logger.info(f"Starting {workers} routing workers")
+        routing_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="route_series")
+        routing_pool_size = workers
+    return routing_pool
 
 
 def exit_router(args) -> None:
     """
     Callback function that is triggered when the process terminates. Stops the asyncio event loop
     """
+    incoming_index.stop()
+    if routing_pool is not None:
+        routing_pool.shutdown(wait=True)
     helper.loop.call_soon_threadsafe(helper.loop.stop)
 
 
@@ -162,6 +225,7 @@ def main(args=sys.argv[1:]) -> None:
     except Exception:
         logger.exception("Cannot start service. Going down.")
         sys.exit(1)
+    config.start_watcher()
 
     appliance_name = config.mercure.appliance_name
 
@@ -26,6 +26,7 @@ import common.rule_evaluation as rule_evaluation
 import common.monitor as monitor
 import common.helper as helper
 from common.types import *
+from routing.study_index import study_index
 from common.constants import (
     mercure_defs,
     mercure_names,
@@ -49,6 +50,7 @@ def compose_task(
     applied_rule: str,
     tags_list: Dict[str, str],
     target: str,
+    manifest: Optional[List[ManifestEntry]] = None,
 ) -> Task:
     """
     Composes the JSON content that is written into a task file when submitting a job (for processing, dispatching, or both)
@@ -62,6 +64,8 @@ def compose_task(
         process=add_processing(uid, applied_rule, tags_list) or cast(EmptyDict, {}),
         # Add information about the study, included all collected series
         study=add_study(uid, uid_type, applied_rule, tags_list) or cast(EmptyDict, {}),
+        # Add the list of DICOM files, so that the files don't need to be searched in the folder
+        manifest=manifest,
     )
 
 
@@ -191,8 +195,10 @@ def add_info(
     """
     if applied_rule:
         task_action = config.mercure.rules[applied_rule].get("action", "process")
+        task_priority = config.mercure.rules[applied_rule].get(mercure_rule.PRIORITY, mercure_options.NORMAL)
     else:
         task_action = "route"
+        task_priority = mercure_options.NORMAL
 
     return TaskInfo(
         action=task_action,
@@ -205,6 +211,7 @@ def add_info(
         mercure_version=mercure_defs.VERSION,
         mercure_appliance=config.mercure.appliance_name,
         mercure_server=socket.gethostname(),
+        priority=task_priority,
     )
 
 
@@ -215,12 +222,13 @@ def create_series_task(
     series_UID: str,
     tags_list: Dict[str, str],
     target: str,
+    manifest: Optional[List[ManifestEntry]] = None,
 ) -> bool:
     """
     Writes a task file for the received series, containing all information needed by the processor and dispatcher. Additional information is written into the file as well
     """
     # Compose the JSON content for the file
-    task = compose_task(series_UID, "series", triggered_rules, applied_rule, tags_list, target)
+    task = compose_task(series_UID, "series", triggered_rules, applied_rule, tags_list, target, manifest)
 
     task_filename = folder_name + mercure_names.TASKFILE
     try:
@@ -242,12 +250,13 @@ def create_study_task(
     applied_rule: str,
     study_UID: str,
     tags_list: Dict[str, str],
+    manifest: Optional[List[ManifestEntry]] = None,
 ) -> bool:
     """
     Generate task file with information on the study
     """
     # Compose the JSON content for the file
-    task_json = compose_task(study_UID, "study", triggered_rules, applied_rule, tags_list, "")
+    task_json = compose_task(study_UID, "study", triggered_rules, applied_rule, tags_list, "", manifest)
 
     task_filename = folder_name + mercure_names.TASKFILE
     try:
@@ -259,6 +268,7 @@ def create_study_task(
         monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
         return False
 
+    study_index.update(folder_name, task_json)
     return True
 
 
@@ -268,6 +278,7 @@ def update_study_task(
     applied_rule: str,
     study_UID: str,
     tags_list: Dict[str, str],
+    manifest: Optional[List[ManifestEntry]] = None,
 ) -> bool:
     """
     Update the study task file with information from the latest received series
@@ -303,6 +314,13 @@ def update_study_task(
     else:
         study.received_series = [series_description]
 
+    # Add the files of the series to the manifest. If the files of one series are not listed, the manifest is
+    # incomplete and can't be used anymore
+    if task.manifest is not None and manifest is not None:
+        task.manifest.extend(manifest)
+    else:
+        task.manifest = None
+
     # Safe the updated file back to disk
     try:
         with open(task_filename, "w") as task_file:
@@ -313,4 +331,5 @@ def update_study_task(
         monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
         return False
 
+    study_index.update(folder_name, task)
     return True
@@ -0,0 +1,301 @@
+"""
+incoming_index.py
+=================
+Incremental index of the series contained in the incoming folder. The index is updated from file-system notifications
+(inotify via watchdog), so that the router does not need to scan and stat the complete incoming folder during every run.
+A periodic full rescan keeps the index consistent in case notifications have been missed. Series can either be stored
+directly in the incoming folder or in one subfolder per series (if enabled for the receiver). For series stored in a
+subfolder, the file names in the index include the subfolder name.
+"""
+
+# Standard python includes
+import os
+import time
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import daiquiri
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
+# App-specific includes
+from common.constants import mercure_defs, mercure_names
+
+# Create local logger instance
+logger = daiquiri.getLogger("incoming_index")
+
+
+class SeriesEntry:
+    """Files of one series that are currently stored in the incoming folder, and the time of the latest arrival."""
+
+    def __init__(self) -> None:
+        self.files: Set[str] = set()
+        self.last_arrival: float = 0
+
+
+class IncomingEventHandler(FileSystemEventHandler):
+    """Forwards the file-system notifications for the incoming folder (and the series subfolders) to the index."""
+
+    def __init__(self, index: "IncomingIndex") -> None:
+        super().__init__()
+        self.index = index
+
+    def get_name(self, path: str) -> Optional[str]:
+        """Returns the path relative to the incoming folder, or None if the path is not located in the incoming
+        folder or in one of the series subfolders."""
+        name = os.path.relpath(path, self.index.folder)
+        if name.startswith("..") or name.count(os.sep) > 1:
+            return None
+        return name
+
+    def on_created(self, event) -> None:
+        name = self.get_name(event.src_path)
+        if name and not event.is_directory:
+            self.index.add_file(name)
+
+    def on_modified(self, event) -> None:
+        name = self.get_name(event.src_path)
+        if name and not event.is_directory:
+            self.index.add_file(name)
+
+    def on_moved(self, event) -> None:
+        name = self.get_name(event.src_path)
+        if name:
+            if event.is_directory:
+                self.index.remove_folder(name)
+            else:
+                self.index.remove_file(name)
+        dest_name = self.get_name(event.dest_path)
+        if dest_name and not event.is_directory:
+            self.index.add_file(dest_name)
+
+    def on_deleted(self, event) -> None:
+        name = self.get_name(event.src_path)
+        if name:
+            if event.is_directory:
+                self.index.remove_folder(name)
+            else:
+                self.index.remove_file(name)
+
+
+class IncomingIndex:
+    """
+    Map of all series in the incoming folder with the contained files and the time of the latest file arrival.
+    If the file-system notifications cannot be used (e.g., on network shares), the index falls back to a full
+    scan of the folder during every refresh.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._observer: Optional[Observer] = None
+        self.folder = ""
+        self.series: Dict[str, SeriesEntry] = {}
+        self.error_files: Set[str] = set()
+        self.last_rescan: float = 0
+        self.watch_failed = False
+        # Changes received while a rescan is running (None if no rescan is running)
+        self._pending: Optional[List[Tuple[Callable, tuple]]] = None
+
+    def is_watching(self) -> bool:
+        """Returns true if the index is currently updated from file-system notifications."""
+        return self._observer is not None and self._observer.is_alive()
+
+    def start(self, folder: str) -> bool:
+        """Starts watching the given folder. Returns false if notifications are not available for the folder."""
+        self.stop()
+        self.folder = folder
+        self.watch_failed = False
+        observer = Observer()
+        try:
+            observer.schedule(IncomingEventHandler(self), folder, recursive=True)
+            observer.start()
+        except Exception as e:
+            logger.warning(f"Unable to watch incoming folder {folder}, falling back to folder scans ({e})")
+            self.watch_failed = True
+            return False
+        self._observer = observer
+        # Notifications only cover files arriving from now on, so the folder needs to be scanned once
+        self.last_rescan = 0
+        return True
+
+    def stop(self) -> None:
+        """Stops watching the folder."""
+        if self._observer is not None:
+            try:
+                self._observer.stop()
+                self._observer.join(timeout=5)
+            except Exception:
+                logger.exception("Unable to stop watching the incoming folder")
+            self._observer = None
+
+    def refresh(self, folder: str, rescan_interval: float) -> None:
+        """
+        Makes sure that the index is up-to-date for the given folder. A full scan is performed if notifications are
+        not available or if the last full scan is longer ago than the rescan interval.
+        """
+        if folder != self.folder or (not self.is_watching() and not self.watch_failed):
+            self.start(folder)
+
+        if (not self.is_watching()) or (time.time() - self.last_rescan >= rescan_interval):
+            self.rescan()
+
+    def rescan(self) -> None:
+        """Rebuilds the index by scanning the complete incoming folder. Notifications that are received during the
+        scan are applied to the new index afterwards, so that they are not lost when the index is replaced."""
+        series: Dict[str, SeriesEntry] = {}
+        error_files: Set[str] = set()
+        scan_time = time.time()
+        with self._lock:
+            self._pending = []
+
+        def add_tags_file(entry: os.DirEntry, name: str) -> None:
+            series_uid = entry.name.split(mercure_defs.SEPARATOR, 1)[0]
+            try:
+                modification_time = entry.stat().st_mtime
+            except FileNotFoundError:
+                return
+            series_entry = series.setdefault(series_uid, SeriesEntry())
+            series_entry.files.add(name[: -len(mercure_names.TAGS)])
+            if modification_time > series_entry.last_arrival:
+                series_entry.last_arrival = modification_time
+
+        try:
+            for entry in os.scandir(self.folder):
+                if entry.is_dir():
+                    # Subfolder containing the files of one series
+                    try:
+                        with os.scandir(entry.path) as series_folder:
+                            for series_file in series_folder:
+                                if series_file.name.endswith(mercure_names.TAGS):
+                                    add_tags_file(series_file, os.path.join(entry.name, series_file.name))
+                    except FileNotFoundError:
+                        # Series folder has been moved away in the meantime
+                        continue
+                elif entry.name.endswith(mercure_names.TAGS):
+                    add_tags_file(entry, entry.name)
+                elif entry.name.endswith(mercure_names.ERROR):
+                    error_files.add(entry.name)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            pending = self._pending or []
+            self._pending = None
+            self.series = series
+            self.error_files = error_files
+            self.last_rescan = scan_time
+            for operation, args in pending:
+                operation(*args)
+
+    def _apply(self, operation: Callable, *args) -> None:
+        """Applies a change to the index (the lock needs to be held). If a rescan is running, the change is also
+        recorded, so that it can be applied again to the index built by the scan."""
+        operation(*args)
+        if self._pending is not None:
+            self._pending.append((operation, args))
+
+    def add_file(self, name: str) -> None:
+        """Registers a newly arrived (or modified) file. The name is given relative to the incoming folder."""
+        if name.endswith(mercure_names.ERROR):
+            if os.path.dirname(name) == "":
+                with self._lock:
+                    self._apply(self._add_error_file, name)
+            return
+
+        if not name.endswith(mercure_names.TAGS):
+            return
+
+        try:
+            arrival_time = os.stat(os.path.join(self.folder, name)).st_mtime
+        except OSError:
+            # File has been removed again already
+            return
+
+        with self._lock:
+            self._apply(self._add_file, name, arrival_time)
+
+    def _add_error_file(self, name: str) -> None:
+        self.error_files.add(name)
+
+    def _add_file(self, name: str, arrival_time: float) -> None:
+        series_uid = os.path.basename(name).split(mercure_defs.SEPARATOR, 1)[0]
+        series_entry = self.series.setdefault(series_uid, SeriesEntry())
+        series_entry.files.add(name[: -len(mercure_names.TAGS)])
+        if arrival_time > series_entry.last_arrival:
+            series_entry.last_arrival = arrival_time
+
+    def remove_file(self, name: str) -> None:
+        """Removes a file that has been deleted or moved out of the incoming folder."""
+        if not name.endswith((mercure_names.ERROR, mercure_names.TAGS)):
+            return
+        with self._lock:
+            self._apply(self._remove_file, name)
+
+    def _remove_file(self, name: str) -> None:
+        if name.endswith(mercure_names.ERROR):
+            self.error_files.discard(name)
+            return
+        series_uid = os.path.basename(name).split(mercure_defs.SEPARATOR, 1)[0]
+        series_entry = self.series.get(series_uid)
+        if series_entry is None:
+            return
+        series_entry.files.discard(name[: -len(mercure_names.TAGS)])
+        if not series_entry.files:
+            del self.series[series_uid]
+
+    def remove_folder(self, name: str) -> None:
+        """Removes all files of a series subfolder that has been deleted or moved out of the incoming folder."""
+        with self._lock:
+            self._apply(self._remove_folder, name)
+
+    def _remove_folder(self, name: str) -> None:
+        prefix = name + os.sep
+        for series_uid in list(self.series.keys()):
+            series_entry = self.series[series_uid]
+            series_entry.files = {file for file in series_entry.files if not file.startswith(prefix)}
+            if not series_entry.files:
+                del self.series[series_uid]
+
+    def remove_files(self, series_uid: str, file_list: List[str]) -> None:
+        """Removes the given files of a series after they have been routed. Files of the series that arrived in
+        the meantime remain in the index, unless the series subfolder has been moved as a whole."""
+        moved_folders = {
+            folder
+            for folder in {os.path.dirname(file) for file in file_list}
+            if folder and not os.path.isdir(os.path.join(self.folder, folder))
+        }
+        with self._lock:
+            for folder in moved_folders:
+                self._apply(self._remove_folder, folder)
+            self._apply(self._remove_series_files, series_uid, list(file_list))
+
+    def _remove_series_files(self, series_uid: str, file_list: List[str]) -> None:
+        series_entry = self.series.get(series_uid)
+        if series_entry is None:
+            return
+        series_entry.files.difference_update(file_list)
+        if not series_entry.files:
+            del self.series[series_uid]
+
+    def get_complete_series(self, complete_trigger: float) -> Dict[str, List[str]]:
+        """Returns the files of all series for which no new file has arrived since the given time (in sec)."""
+        now = time.time()
+        with self._lock:
+            return {
+                series_uid: sorted(series_entry.files)
+                for series_uid, series_entry in self.series.items()
+                if (now - series_entry.last_arrival) > complete_trigger
+            }
+
+    def series_count(self) -> int:
+        with self._lock:
+            return len(self.series)
+
+    def file_count(self) -> int:
+        with self._lock:
+            return sum(len(series_entry.files) for series_entry in self.series.values())
+
+    def has_error_files(self) -> bool:
+        with self._lock:
+            return len(self.error_files) > 0
@@ -7,11 +7,14 @@ Provides functions for routing/processing of series. For study-level processing,
 # Standard python includes
 import os
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 from typing_extensions import Literal
 import uuid
 import json
 import shutil
+import threading
+import errno
+import fcntl
 import daiquiri
 
 # App-specific includes
@@ -20,7 +23,9 @@ import common.rule_evaluation as rule_evaluation
 import common.monitor as monitor
 import common.helper as helper
 import common.notification as notification
-from common.types import Rule
+import common.retention as retention
+from common.manifest import create_manifest, get_manifest_size
+from common.types import ManifestEntry, Rule
 from common.constants import (
     mercure_defs,
     mercure_names,
@@ -36,15 +41,26 @@ from routing.generate_taskfile import compose_task, create_series_task, create_s
 # Create local logger instance
 logger = daiquiri.getLogger("route_series")
 
+# ioctl request code for cloning files on file systems with reflink support (Linux)
+FICLONE = 0x40049409
+# Combinations of source and destination folders for which reflinks are not supported
+reflink_unsupported: Set[Tuple[str, str]] = set()
 
-def route_series(series_UID: str) -> None:
+# Locks for serializing updates of the study folders (the folders are mapped onto a fixed set of locks)
+study_locks = [threading.Lock() for _ in range(64)]
+
+
+def route_series(series_UID: str, file_list: Optional[List[str]] = None) -> bool:
     """
-    Processes the series with the given series UID from the incoming folder.
+    Processes the series with the given series UID from the incoming folder. If the list of files belonging to
+    the series is already known (e.g., from the router's incoming index), it can be provided to avoid scanning
+    the incoming folder again. Files stored in the series subfolder are listed including the subfolder name.
+    Returns False if the series has not been routed (e.g., because it is locked by another instance).
     """
     lock_file = Path(config.mercure.incoming_folder + "/" + str(series_UID) + mercure_names.LOCK)
     if lock_file.exists():
         # Series is locked, so another instance might be working on it
-        return
+        return False
 
     # Create lock file in the incoming folder and prevent other instances from working on this series
     try:
@@ -54,24 +70,51 @@ def route_series(series_UID: str) -> None:
         error_message = f"Unable to create lock file {lock_file}"
         logger.error(error_message)
         monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
-        return
+        return False
 
+    # The lock is removed on every path, also if the series couldn't be routed, so that it can be tried again
+    try:
+        return route_locked_series(series_UID, file_list)
+    finally:
+        try:
+            lock.free()
+        except:
+            # Can't delete lock file, so something must be seriously wrong
+            error_message = f"Unable to remove lock file {lock_file}"
+            logger.error(error_message)
+            monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
+
+
+def route_locked_series(series_UID: str, file_list: Optional[List[str]]) -> bool:
+    """
+    Routes the series after the lock file has been created by route_series. Returns False if the series has not been
+    routed because its files are missing or invalid.
+    """
     logger.info(f"Processing series {series_UID}")
     fileList = []
     seriesPrefix = series_UID + mercure_defs.SEPARATOR
 
-    # Collect all files belonging to the series
-    for entry in os.scandir(config.mercure.incoming_folder):
-        if entry.name.endswith(mercure_names.TAGS) and entry.name.startswith(seriesPrefix) and not entry.is_dir():
-            stemName = entry.name[:-5]
-            fileList.append(stemName)
+    if file_list is not None:
+        fileList = list(file_list)
+    else:
+        # Collect all files belonging to the series
+        for entry in os.scandir(config.mercure.incoming_folder):
+            if entry.name.endswith(mercure_names.TAGS) and entry.name.startswith(seriesPrefix) and not entry.is_dir():
+                stemName = entry.name[:-5]
+                fileList.append(stemName)
+        # Also collect the files from the series subfolder (if the receiver stores the series in subfolders)
+        series_folder = Path(config.mercure.incoming_folder) / series_UID
+        if series_folder.is_dir():
+            for entry in os.scandir(series_folder):
+                if entry.name.endswith(mercure_names.TAGS) and entry.name.startswith(seriesPrefix):
+                    fileList.append(series_UID + "/" + entry.name[:-5])
 
     logger.info("DICOM files found: " + str(len(fileList)))
     if not len(fileList):
         error_message = f"No tags files found for series {series_UID}"
         monitor.send_series_event(monitor.s_events.ERROR, series_UID, 0, "", error_message)
         monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
-        return
+        return False
 
     # Use the tags file from the first slice for evaluating the routing rules
     tagsMasterFile = Path(config.mercure.incoming_folder + "/" + fileList[0] + mercure_names.TAGS)
@@ -79,7 +122,7 @@ def route_series(series_UID: str) -> None:
         error_message = f"Missing file! {tagsMasterFile.name}"
         logger.error(error_message)
         monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
-        return
+        return False
 
     try:
         with open(tagsMasterFile, "r") as json_file:
@@ -89,9 +132,17 @@ def route_series(series_UID: str) -> None:
         logger.exception(error_message)
         monitor.send_series_event(monitor.s_events.ERROR, series_UID, 0, "", error_message)
         monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
-        return
+        return False
+
+    # List the files with size and SOP instance UID in the task files, so that the other services don't need to
+    # search the folders for the files
+    manifest = create_manifest(config.mercure.incoming_folder, fileList)
 
     monitor.send_register_series(tagsList)
+    if config.mercure.bookkeeper_bulk_register:
+        monitor.send_register_instances(
+            series_UID, [{"filename": entry.name, "file_uid": entry.sop_uid} for entry in manifest]
+        )
     monitor.send_series_event(monitor.s_events.REGISTERED, series_UID, len(fileList), "", "")
 
     # Now test the routing rules and evaluate which rules have been triggered. If one of the triggered
@@ -101,24 +152,18 @@ def route_series(series_UID: str) -> None:
 
     if (len(triggered_rules) == 0) or (discard_series):
         # If no routing rule has triggered or discarding has been enforced, discard the series
-        push_series_complete(fileList, series_UID, "DISCARD", discard_series, False)
+        push_series_complete(fileList, series_UID, "DISCARD", discard_series, False, manifest)
     else:
         # File handling strategy: If only one triggered rule, move files (faster than copying). If multiple rules, copy files
-        push_series_studylevel(triggered_rules, fileList, series_UID, tagsList)
-        push_series_serieslevel(triggered_rules, fileList, series_UID, tagsList)
+        push_series_studylevel(triggered_rules, fileList, series_UID, tagsList, manifest)
+        push_series_serieslevel(triggered_rules, fileList, series_UID, tagsList, manifest)
 
         # If more than one rule has triggered, the series files need to be removed
         if len(triggered_rules) > 1:
             remove_series(fileList)
 
-    try:
-        lock.free()
-    except:
-        # Can't delete lock file, so something must be seriously wrong
-        error_message = f"Unable to remove lock file {lock_file}"
-        logger.error(error_message)
-        monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
-        return
+    remove_series_folder(fileList)
+    return True
 
 
 def get_triggered_rules(tagList: Dict[str, str]) -> Tuple[Dict[str, Literal[True]], Union[Any, Literal[""]]]:
@@ -129,21 +174,19 @@ def get_triggered_rules(tagList: Dict[str, str]) -> Tuple[Dict[str, Literal[True
     discard_rule = ""
     fallback_rule = ""
 
-    # Iterate over all defined processing rules
-    for current_rule in config.mercure.rules:
+    # Fetch the compiled rule expressions and the rule index (only rebuilt if the configuration has changed)
+    rules_version = config.get_section_version("rules")
+    compiled_rules = rule_evaluation.get_compiled_rules(config.mercure.rules, rules_version)
+    rule_index = rule_evaluation.get_rule_index(config.mercure.rules, rules_version)
+    fallback_rule = rule_index.fallback_rule
+
+    # Iterate over the enabled rules that can trigger for the series, based on the tag values required by the rules
+    for current_rule in rule_index.get_candidates(tagList):
         try:
             rule: Rule = config.mercure.rules[current_rule]
 
-            # Check if the current rule has been disabled
-            if rule.get(mercure_rule.DISABLED, "False") == "True":
-                continue
-
-            # If the current rule is flagged as fallback rule, remember the name (to avoid having to iterate over the rules again)
-            if rule.get(mercure_rule.FALLBACK, "False") == "True":
-                fallback_rule = current_rule
-
             # Check if the current rule is triggered for the provided tag set
-            if rule_evaluation.parse_rule(rule.get("rule", "False"), tagList):
+            if compiled_rules[current_rule].evaluate(tagList):
                 triggered_rules[current_rule] = True
                 if rule.get(mercure_rule.ACTION, "") == mercure_actions.DISCARD:
                     discard_rule = current_rule
@@ -169,7 +212,12 @@ def get_triggered_rules(tagList: Dict[str, str]) -> Tuple[Dict[str, Literal[True
 
 
 def push_series_complete(
-    file_list: List[str], series_UID: str, destination: str, discard_rule: str, copy_files: bool
+    file_list: List[str],
+    series_UID: str,
+    destination: str,
+    discard_rule: str,
+    copy_files: bool,
+    manifest: Optional[List[ManifestEntry]] = None,
 ) -> None:
     """
     Moves all files of the series into either the "discard" or "success" folders, which both are periodically cleared.
@@ -181,14 +229,17 @@ def push_series_complete(
     else:
         destination_path = config.mercure.success_folder + "/" + str(uuid.uuid1())
 
-    # Create subfolder in the discard directory and validate that is has been created
-    try:
-        os.mkdir(destination_path)
-    except Exception:
-        error_message = f"Unable to create outgoing folder {destination_path}"
-        logger.exception(error_message)
-        monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
-        return
+    # If the series is stored in its own subfolder, move the subfolder as a whole. Otherwise, create
+    # subfolder in the discard directory and validate that is has been created
+    folder_moved = (not copy_files) and move_series_folder(file_list, destination_path)
+    if not folder_moved:
+        try:
+            os.mkdir(destination_path)
+        except Exception:
+            error_message = f"Unable to create outgoing folder {destination_path}"
+            logger.exception(error_message)
+            monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
+            return
 
     if not Path(destination_path).exists():
         error_message = f"Creating discard folder not possible {destination_path}"
@@ -216,7 +267,7 @@ def push_series_complete(
         info_text = "Discard by rule " + discard_rule
         monitor.send_series_event(monitor.s_events.DISCARD, series_UID, len(file_list), "", info_text)
 
-    if not push_files(file_list, destination_path, copy_files):
+    if not folder_moved and not push_files(file_list, destination_path, copy_files, allow_hardlink=True):
         error_message = f"Problem while moving completed files from {series_UID}"
         logger.error(error_message)
         monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
@@ -232,9 +283,15 @@ def push_series_complete(
         monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
         return
 
+    retention.record(destination_path, series_UID, get_manifest_size(manifest))
+
 
 def push_series_studylevel(
-    triggered_rules: Dict[str, Literal[True]], file_list: List[str], series_UID: str, tags_list: Dict[str, str]
+    triggered_rules: Dict[str, Literal[True]],
+    file_list: List[str],
+    series_UID: str,
+    tags_list: Dict[str, str],
+    manifest: Optional[List[ManifestEntry]] = None,
 ) -> None:
     """
     Prepeares study-level routing for the current series.
@@ -249,51 +306,76 @@ def push_series_studylevel(
             folder_name = config.mercure.studies_folder + "/" + study_UID + mercure_defs.SEPARATOR + current_rule
             target_folder = folder_name + "/"
 
-            if not os.path.exists(folder_name):
+            # Series of the same study might be routed in parallel by different routing workers, so the
+            # creation and update of the study folder needs to be serialized
+            with get_study_lock(folder_name):
+                folder_moved = False
+                if not os.path.exists(folder_name):
+                    # For the first series of a study, the series subfolder can become the study folder
+                    if len(triggered_rules) == 1 and move_series_folder(file_list, folder_name):
+                        folder_moved = True
+                        first_series = True
+                    else:
+                        try:
+                            os.mkdir(folder_name)
+                            first_series = True
+                        except:
+                            error_message = f"Unable to create folder {folder_name}"
+                            logger.error(error_message)
+                            monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
+                            continue
+
+                lock_file = Path(folder_name) / mercure_names.LOCK
                 try:
-                    os.mkdir(folder_name)
-                    first_series = True
+                    lock = helper.FileLock(lock_file)
                 except:
-                    error_message = f"Unable to create folder {folder_name}"
+                    # Can't create lock file, so something must be seriously wrong
+                    error_message = f"Unable to create lock file {lock_file}"
                     logger.error(error_message)
                     monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
                     continue
 
-            lock_file = Path(folder_name) / mercure_names.LOCK
-            try:
-                lock = helper.FileLock(lock_file)
-            except:
-                # Can't create lock file, so something must be seriously wrong
-                error_message = f"Unable to create lock file {lock_file}"
-                logger.error(error_message)
-                monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
-                continue
+                if first_series:
+                    # Create task file with information on complete criteria
+                    create_study_task(target_folder, triggered_rules, current_rule, study_UID, tags_list, manifest)
+                else:
+                    # Add data from latest series to task file
+                    update_study_task(target_folder, triggered_rules, current_rule, study_UID, tags_list, manifest)
 
-            if first_series:
-                # Create task file with information on complete criteria
-                create_study_task(target_folder, triggered_rules, current_rule, study_UID, tags_list)
-            else:
-                # Add data from latest series to task file
-                update_study_task(target_folder, triggered_rules, current_rule, study_UID, tags_list)
+                # Copy (or move) the files into the study folder
+                if not folder_moved:
+                    push_files(file_list, folder_name, (len(triggered_rules) > 1))
+                lock.free()
 
-            # Copy (or move) the files into the study folder
-            push_files(file_list, folder_name, (len(triggered_rules) > 1))
-            lock.free()
+
+def get_study_lock(folder_name: str) -> threading.Lock:
+    """
+    Returns the lock that protects the given study folder against concurrent updates from multiple routing workers.
+    """
+    return study_locks[hash(folder_name) % len(study_locks)]
 
 
 def push_series_serieslevel(
-    triggered_rules: Dict[str, Literal[True]], file_list: List[str], series_UID: str, tags_list: Dict[str, str]
+    triggered_rules: Dict[str, Literal[True]],
+    file_list: List[str],
+    series_UID: str,
+    tags_list: Dict[str, str],
+    manifest: Optional[List[ManifestEntry]] = None,
 ) -> None:
     """
     Prepeares all series-level routings for the current series.
     """
-    push_serieslevel_routing(triggered_rules, file_list, series_UID, tags_list)
-    push_serieslevel_processing(triggered_rules, file_list, series_UID, tags_list)
-    push_serieslevel_notification(triggered_rules, file_list, series_UID, tags_list)
+    push_serieslevel_routing(triggered_rules, file_list, series_UID, tags_list, manifest)
+    push_serieslevel_processing(triggered_rules, file_list, series_UID, tags_list, manifest)
+    push_serieslevel_notification(triggered_rules, file_list, series_UID, tags_list, manifest)
 
 
 def push_serieslevel_routing(
-    triggered_rules: Dict[str, Literal[True]], file_list: List[str], series_UID: str, tags_list: Dict[str, str]
+    triggered_rules: Dict[str, Literal[True]],
+    file_list: List[str],
+    series_UID: str,
+    tags_list: Dict[str, str],
+    manifest: Optional[List[ManifestEntry]] = None,
 ) -> None:
     selected_targets = {}
     # Collect the dispatch-only targets to avoid that a series is sent twice to the
@@ -308,11 +390,15 @@ def push_serieslevel_routing(
                     selected_targets[target] = current_rule
                 trigger_serieslevel_notification_reception(current_rule, tags_list)
 
-    push_serieslevel_outgoing(triggered_rules, file_list, series_UID, tags_list, selected_targets)
+    push_serieslevel_outgoing(triggered_rules, file_list, series_UID, tags_list, selected_targets, manifest)
 
 
 def push_serieslevel_processing(
-    triggered_rules: Dict[str, Literal[True]], file_list: List[str], series_UID: str, tags_list: Dict[str, str]
+    triggered_rules: Dict[str, Literal[True]],
+    file_list: List[str],
+    series_UID: str,
+    tags_list: Dict[str, str],
+    manifest: Optional[List[ManifestEntry]] = None,
 ) -> bool:
     # Rules with action "processing" or "processing & routing" need to be processed separately (because the processing step can create varying results).
     # Thus, loop over all series-level rules that have triggered.
@@ -330,18 +416,20 @@ def push_serieslevel_processing(
                 folder_name = config.mercure.processing_folder + "/" + str(uuid.uuid1())
                 target_folder = folder_name + "/"
 
-                # Create processing folder
-                try:
-                    os.mkdir(folder_name)
-                except Exception:
-                    error_message = f"Unable to create outgoing folder {folder_name}"
-                    logger.exception(error_message)
-                    monitor.send_event(
-                        monitor.m_events.PROCESSING,
-                        monitor.severity.ERROR,
-                        error_message,
-                    )
-                    return False
+                # Create processing folder (or move the series subfolder if the files don't need to be copied)
+                folder_moved = (not copy_files) and move_series_folder(file_list, folder_name)
+                if not folder_moved:
+                    try:
+                        os.mkdir(folder_name)
+                    except Exception:
+                        error_message = f"Unable to create outgoing folder {folder_name}"
+                        logger.exception(error_message)
+                        monitor.send_event(
+                            monitor.m_events.PROCESSING,
+                            monitor.severity.ERROR,
+                            error_message,
+                        )
+                        return False
 
                 if not Path(folder_name).exists():
                     error_message = f"Creating folder not possible {folder_name}"
@@ -365,10 +453,12 @@ def push_serieslevel_processing(
                     return False
 
                 # Generate task file with processing information
-                if not create_series_task(target_folder, triggered_rules, current_rule, series_UID, tags_list, ""):
+                if not create_series_task(
+                    target_folder, triggered_rules, current_rule, series_UID, tags_list, "", manifest
+                ):
                     return False
 
-                if not push_files(file_list, target_folder, copy_files):
+                if not folder_moved and not push_files(file_list, target_folder, copy_files):
                     error_message = f"Unable to push files into processing folder {target_folder}"
                     logger.error(error_message)
                     monitor.send_event(
@@ -392,7 +482,11 @@ def push_serieslevel_processing(
 
 
 def push_serieslevel_notification(
-    triggered_rules: Dict[str, Literal[True]], file_list: List[str], series_UID: str, tags_list: Dict[str, str]
+    triggered_rules: Dict[str, Literal[True]],
+    file_list: List[str],
+    series_UID: str,
+    tags_list: Dict[str, str],
+    manifest: Optional[List[ManifestEntry]] = None,
 ) -> bool:
     notification_rules_count = 0
 
@@ -409,7 +503,7 @@ def push_serieslevel_notification(
     # make a copy of the files into the discard folder, so that the files can be recovered
     if notification_rules_count > 0:
         if (len(triggered_rules) == 1) or (len(triggered_rules) == notification_rules_count):
-            push_series_complete(file_list, series_UID, "SUCCESS", "", len(triggered_rules) > 1)
+            push_series_complete(file_list, series_UID, "SUCCESS", "", len(triggered_rules) > 1, manifest)
 
     return True
 
@@ -420,6 +514,7 @@ def push_serieslevel_outgoing(
     series_UID: str,
     tags_list: Dict[str, str],
     selected_targets: Dict[str, str],
+    manifest: Optional[List[ManifestEntry]] = None,
 ) -> None:
     """
     Move the DICOM files of the series to a separate subfolder for each target in the outgoing folder.
@@ -441,13 +536,15 @@ def push_serieslevel_outgoing(
         folder_name = config.mercure.outgoing_folder + "/" + str(uuid.uuid1())
         target_folder = folder_name + "/"
 
-        try:
-            os.mkdir(folder_name)
-        except Exception:
-            error_message = f"Unable to create outgoing folder {folder_name}"
-            logger.exception(error_message)
-            monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
-            return
+        folder_moved = move_operation and move_series_folder(file_list, folder_name)
+        if not folder_moved:
+            try:
+                os.mkdir(folder_name)
+            except Exception:
+                error_message = f"Unable to create outgoing folder {folder_name}"
+                logger.exception(error_message)
+                monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
+                return
 
         if not Path(folder_name).exists():
             error_message = f"Creating folder not possible {folder_name}"
@@ -466,21 +563,26 @@ def push_serieslevel_outgoing(
             return
 
         # Generate task file with dispatch information
-        if not create_series_task(target_folder, triggered_rules, "", series_UID, tags_list, target):
+        if not create_series_task(target_folder, triggered_rules, "", series_UID, tags_list, target, manifest):
             continue
 
         monitor.send_series_event(monitor.s_events.ROUTE, series_UID, len(file_list), target, selected_targets[target])
 
+        # Files in the outgoing folder are only read by the dispatcher, so hard links can be used when fanning
+        # out the series to multiple targets
         operation: Callable
         if move_operation:
             operation = shutil.move
         else:
-            operation = shutil.copy
+            operation = lambda source, target: clone_file(source, target, allow_hardlink=True)
 
-        for entry in file_list:
+        # If the series folder has been moved, all files are already in place
+        pushed_files = [] if folder_moved else file_list
+        for entry in pushed_files:
+            target_name = target_folder + os.path.basename(entry)
             try:
-                operation(source_folder + entry + mercure_names.DCM, target_folder + entry + mercure_names.DCM)
-                operation(source_folder + entry + mercure_names.TAGS, target_folder + entry + mercure_names.TAGS)
+                operation(source_folder + entry + mercure_names.DCM, target_name + mercure_names.DCM)
+                operation(source_folder + entry + mercure_names.TAGS, target_name + mercure_names.TAGS)
             except Exception:
                 error_message = f"Problem while pushing file to outgoing {entry}"
                 logger.exception(error_message)
@@ -504,24 +606,26 @@ def push_serieslevel_outgoing(
             return
 
 
-def push_files(file_list: List[str], target_path: str, copy_files: bool) -> bool:
+def push_files(file_list: List[str], target_path: str, copy_files: bool, allow_hardlink: bool = False) -> bool:
     """
     Copies or moves the given files to the target path. If copy_files is True, files are copied, otherwise moved.
+    Copies are created as reflinks or (if allow_hardlink is True) as hard links when possible, see clone_file.
     Note that this function does not create a lock file (this needs to be done by the calling function).
     """
     operation: Callable
     if copy_files == False:
         operation = shutil.move
     else:
-        operation = shutil.copy
+        operation = lambda source, target: clone_file(source, target, allow_hardlink)
 
     source_folder = config.mercure.incoming_folder + "/"
     target_folder = target_path + "/"
 
     for entry in file_list:
+        target_name = target_folder + os.path.basename(entry)
         try:
-            operation(source_folder + entry + mercure_names.DCM, target_folder + entry + mercure_names.DCM)
-            operation(source_folder + entry + mercure_names.TAGS, target_folder + entry + mercure_names.TAGS)
+            operation(source_folder + entry + mercure_names.DCM, target_name + mercure_names.DCM)
+            operation(source_folder + entry + mercure_names.TAGS, target_name + mercure_names.TAGS)
         except Exception:
             error_message = f"Problem while pushing file to outgoing {entry}"
             logger.exception(error_message)
@@ -533,6 +637,123 @@ def push_files(file_list: List[str], target_path: str, copy_files: bool) -> bool
     return True
 
 
+def get_series_folder(file_list: List[str]) -> Optional[str]:
+    """
+    Returns the subfolder of the incoming folder that contains all given files, or None if the files are (at least
+    partially) stored directly in the incoming folder.
+    """
+    folders = {os.path.dirname(entry) for entry in file_list}
+    if len(folders) != 1:
+        return None
+    folder = folders.pop()
+    return folder or None
+
+
+def move_series_folder(file_list: List[str], destination_path: str) -> bool:
+    """
+    Moves the series subfolder containing the given files to the destination path with a single rename operation.
+    The moved folder contains a lock file, which needs to be removed by the calling function once the folder has been
+    prepared. Returns False if the files are not stored in a series subfolder, if the subfolder contains further files
+    (e.g., instances that have arrived after the file list was taken), or if the folder cannot be renamed (e.g.,
+    because the destination is located on a different file system). In this case, the destination folder needs to be
+    created and the files need to be pushed individually.
+    """
+    series_folder = get_series_folder(file_list)
+    if not series_folder:
+        return False
+
+    source_path = Path(config.mercure.incoming_folder) / series_folder
+    lock_file = source_path / mercure_names.LOCK
+    expected_files = {os.path.basename(entry) + mercure_names.DCM for entry in file_list}
+    expected_files.update(os.path.basename(entry) + mercure_names.TAGS for entry in file_list)
+    try:
+        if set(os.listdir(source_path)) != expected_files:
+            logger.info(f"Series folder {source_path} contains further files, moving files individually")
+            return False
+        # Lock the folder before moving it, so that the destination folder is never visible without lock
+        lock_file.touch()
+        os.rename(source_path, destination_path)
+    except OSError:
+        logger.info(f"Unable to move series folder {source_path} to {destination_path}, moving files individually")
+        try:
+            lock_file.unlink()
+        except OSError:
+            pass
+        return False
+
+    # Files that have arrived between the check and the rename belong to the next batch of the series
+    expected_files.add(mercure_names.LOCK)
+    for entry in os.listdir(destination_path):
+        if entry in expected_files:
+            continue
+        try:
+            os.makedirs(source_path, exist_ok=True)
+            os.replace(Path(destination_path) / entry, source_path / entry)
+        except OSError:
+            error_message = f"Unable to return file {entry} to series folder {source_path}"
+            logger.exception(error_message)
+            monitor.send_event(monitor.m_events.PROCESSING, monitor.severity.ERROR, error_message)
+    return True
+
+
+def remove_series_folder(file_list: List[str]) -> None:
+    """
+    Removes the series subfolder from the incoming folder after all files have been routed. If new files of the
+    series have arrived in the meantime, the folder is kept.
+    """
+    for series_folder in {os.path.dirname(entry) for entry in file_list}:
+        if not series_folder:
+            continue
+        try:
+            os.rmdir(Path(config.mercure.incoming_folder) / series_folder)
+        except OSError:
+            pass
+
+
+def clone_file(source: str, target: str, allow_hardlink: bool) -> None:
+    """
+    Creates a copy of the source file without duplicating the data, if possible. First, a reflink (copy-on-write
+    clone, supported by XFS and btrfs) is tried. Otherwise, a hard link is created if allowed by the caller. Hard links
+    must only be used if the target is never modified in place (processing modules might change their input files).
+    If the target is located on a different file system, the file is copied.
+    """
+    if reflink_file(source, target):
+        return
+    if allow_hardlink:
+        try:
+            os.link(source, target)
+            return
+        except OSError:
+            pass
+    shutil.copy(source, target)
+
+
+def reflink_file(source: str, target: str) -> bool:
+    """
+    Clones the source file using the FICLONE ioctl. Returns False if the file system does not support reflinks,
+    in which case the folder combination is remembered so that the attempt is not repeated for every file.
+    """
+    folders = (os.path.dirname(source), os.path.dirname(os.path.dirname(target)))
+    if folders in reflink_unsupported:
+        return False
+    try:
+        with open(source, "rb") as source_file, open(target, "wb") as target_file:
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+            # Make sure that the data has actually been cloned
+            if os.fstat(target_file.fileno()).st_size != os.fstat(source_file.fileno()).st_size:
+                raise OSError(errno.EOPNOTSUPP, "Reflink not performed")
+        shutil.copymode(source, target)
+        return True
+    except OSError as e:
+        try:
+            os.remove(target)
+        except OSError:
+            pass
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS):
+            reflink_unsupported.add(folders)
+        return False
+
+
 def remove_series(file_list: List[str]) -> bool:
     """
     Deletes the given files from the incoming folder.
@@ -0,0 +1,191 @@
+"""
+study_index.py
+==============
+In-memory index of the studies that are buffered in the studies folder until the study-completion criteria are met.
+The index is updated whenever the router writes a study task file, and it keeps a heap of the times when the studies
+are due for the next completion check. Thus, the router does not need to open the task files of all studies during
+every run. A periodic full rescan picks up changes made by other processes (e.g., forced completion).
+"""
+
+# Standard python includes
+import heapq
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+import daiquiri
+
+# App-specific includes
+import common.config as config
+import common.rule_evaluation as rule_evaluation
+import common.status_board as status_board
+from common.constants import mercure_names, mercure_rule
+from common.types import Task
+
+# Create local logger instance
+logger = daiquiri.getLogger("study_index")
+
+# Delay before checking a study again if it was locked or not complete when it was due (in seconds)
+RECHECK_DELAY = 5
+
+
+def parse_time(value: Optional[str]) -> float:
+    """Converts the time format used in the task files into a timestamp."""
+    if not value:
+        return 0
+    try:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timestamp()
+    except ValueError:
+        return 0
+
+
+class StudyEntry:
+    """Completion state of a buffered study, as stored in the task file of the study folder."""
+
+    def __init__(self, task: Task) -> None:
+        study: Any = task.study
+        self.complete_trigger = study.get("complete_trigger", "") or mercure_rule.STUDY_TRIGGER_CONDITION_TIMEOUT
+        self.required_series = study.get("complete_required_series", "")
+        self.received_series: List[str] = list(study.get("received_series", []) or [])
+        self.creation_time = parse_time(study.get("creation_time", ""))
+        self.last_receive_time = parse_time(study.get("last_receive_time", ""))
+        self.complete_force = study.get("complete_force", "False") == "True"
+        self.deadline: float = 0
+        # Information shown in the studies queue of the web interface
+        self.info = status_board.describe_study_task(task)
+
+    def get_deadline(self) -> float:
+        """Returns the time when the study will be complete according to the trigger condition of the rule."""
+        if self.complete_force:
+            return 0
+        if self.complete_trigger == mercure_rule.STUDY_TRIGGER_CONDITION_RECEIVED_SERIES and self.required_series:
+            if rule_evaluation.parse_completion_series(self.required_series, self.received_series):
+                return 0
+            # If the required series don't arrive, the study is completed after the force-complete timeout
+            return self.creation_time + config.mercure.study_forcecomplete_trigger
+        return self.last_receive_time + config.mercure.study_complete_trigger
+
+
+class StudyIndex:
+    """Map of the buffered studies (keyed by the name of the study folder) and the heap of completion deadlines."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.folder = ""
+        self.studies: Dict[str, StudyEntry] = {}
+        self.deadlines: List[Tuple[float, str]] = []
+        self.last_rescan: float = 0
+        self.config_version: Any = None
+
+    def refresh(self, folder: str, rescan_interval: float) -> None:
+        """
+        Makes sure that the index is up-to-date. The studies folder is scanned completely when the folder has changed
+        or the rescan interval has passed. The deadlines are recalculated if the settings have changed.
+        """
+        if folder != self.folder or (time.time() - self.last_rescan >= rescan_interval):
+            self.folder = folder
+            self.rescan()
+        elif self.config_version != config.get_section_version("settings"):
+            with self._lock:
+                self._rebuild_deadlines()
+
+    def rescan(self) -> None:
+        """Rebuilds the index by reading the task files of all study folders."""
+        studies: Dict[str, StudyEntry] = {}
+        scan_time = time.time()
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if entry.is_dir():
+                    study_entry = self._read_study(entry.name)
+                    if study_entry is not None:
+                        studies[entry.name] = study_entry
+
+        with self._lock:
+            self.studies = studies
+            self.last_rescan = scan_time
+            self._rebuild_deadlines()
+
+    def _read_study(self, study: str) -> Optional[StudyEntry]:
+        try:
+            with open(Path(self.folder) / study / mercure_names.TASKFILE, "r") as json_file:
+                task = Task(**json.load(json_file))
+            if not task.study:
+                return None
+            return StudyEntry(task)
+        except Exception:
+            # Studies without valid task file can never be completed. If the file is written right now, the study
+            # is added by the router after writing or during the next rescan
+            return None
+
+    def _rebuild_deadlines(self) -> None:
+        self.config_version = config.get_section_version("settings")
+        self.deadlines = []
+        for study, study_entry in self.studies.items():
+            study_entry.deadline = study_entry.get_deadline()
+            self.deadlines.append((study_entry.deadline, study))
+        heapq.heapify(self.deadlines)
+
+    def _schedule(self, study: str, study_entry: StudyEntry, deadline: float) -> None:
+        study_entry.deadline = deadline
+        heapq.heappush(self.deadlines, (deadline, study))
+
+    def update(self, folder_name: str, task: Task) -> None:
+        """Updates the study after the task file has been written by the router."""
+        study = os.path.basename(os.path.normpath(folder_name))
+        if not task.study:
+            return
+        study_entry = StudyEntry(task)
+        with self._lock:
+            self.studies[study] = study_entry
+            self._schedule(study, study_entry, study_entry.get_deadline())
+
+    def reload(self, study: str) -> None:
+        """Reads the task file of the study again, e.g. if the completion check did not confirm the deadline."""
+        study_entry = self._read_study(study)
+        with self._lock:
+            if study_entry is None:
+                self.studies.pop(study, None)
+                return
+            self.studies[study] = study_entry
+            self._schedule(study, study_entry, max(study_entry.get_deadline(), time.time() + RECHECK_DELAY))
+
+    def postpone(self, study: str) -> None:
+        """Checks the study again after a short delay (e.g., because the study is currently locked)."""
+        with self._lock:
+            study_entry = self.studies.get(study)
+            if study_entry is not None:
+                self._schedule(study, study_entry, time.time() + RECHECK_DELAY)
+
+    def remove(self, study: str) -> None:
+        """Removes a study that has been moved out of the studies folder."""
+        with self._lock:
+            self.studies.pop(study, None)
+
+    def get_due_studies(self, now: Optional[float] = None) -> List[str]:
+        """Returns the studies with a deadline that has passed. The returned studies are removed from the heap, so
+        they need to be scheduled again (via postpone or reload) if they remain in the studies folder."""
+        now = now or time.time()
+        due: List[str] = []
+        with self._lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, study = heapq.heappop(self.deadlines)
+                study_entry = self.studies.get(study)
+                # Skip outdated heap entries (the study has been removed or rescheduled)
+                if study_entry is None or study_entry.deadline != deadline or study in due:
+                    continue
+                due.append(study)
+        return due
+
+    def get_studies(self) -> Dict[str, StudyEntry]:
+        with self._lock:
+            return dict(self.studies)
+
+    def study_count(self) -> int:
+        with self._lock:
+            return len(self.studies)
+
+
+study_index = StudyIndex()
@@ -0,0 +1,262 @@
+"""
+benchmark_router.py
+===================
+Throughput benchmark for the router. Fills a temporary incoming folder with synthetic series (pairs of .dcm and .tags
+files), routes them either by calling run_router (as the router service does) or by calling route_series for every
+series directly, and reports the throughput, the time spent in the individual routing phases, and the peak memory.
+
+Usage (from the mercure base folder):
+
+    python tests/benchmark_router.py --series 200 --instances 100 --rules 20 --matching 1
+
+The generated rules compare the SeriesDescription tag, so that the given number of rules triggers for every series
+(if --matching is larger than one, the series is copied to multiple outgoing folders). Alternatively, a JSON file
+with a dictionary of rules can be provided with --rules-file. The phase timings are summed over all routing workers.
+"""
+
+# Standard python includes
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List
+
+# The configuration module reads the location of the configuration file and the log level when imported
+work_folder = tempfile.mkdtemp(prefix="mercure_benchmark_")
+os.environ["MERCURE_CONFIG_FOLDER"] = work_folder
+os.environ.setdefault("MERCURE_LOG_LEVEL", "error")
+sys.path.insert(0, os.path.realpath(os.path.dirname(os.path.realpath(__file__)) + "/.."))
+
+# App-specific includes
+import common.config as config
+import router
+import routing.route_series as route_series
+
+folders = ["incoming", "studies", "outgoing", "success", "error", "discard", "processing"]
+
+
+class PhaseTimer:
+    """Accumulates the time spent in the routing phases (thread-safe, as series can be routed in parallel)."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.durations: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+
+    @contextmanager
+    def measure(self, phase: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.durations[phase] = self.durations.get(phase, 0) + duration
+                self.calls[phase] = self.calls.get(phase, 0) + 1
+
+    def wrap(self, phase: str, function: Callable) -> Callable:
+        def timed_function(*args, **kwargs):
+            with self.measure(phase):
+                return function(*args, **kwargs)
+
+        return timed_function
+
+
+def create_config(args) -> None:
+    """Writes the configuration file for the benchmark into the work folder."""
+    if args.rules_file:
+        with open(args.rules_file, "r") as json_file:
+            rules = json.load(json_file)
+    else:
+        # Only the first rules (given by --matching) trigger for the generated series
+        rules = {
+            f"rule_{i}": {
+                "rule": f"@SeriesDescription@ == '{'BENCHMARK' if i < args.matching else 'OTHER'}'",
+                "target": f"target_{i}",
+                "action": args.action,
+                "action_trigger": args.trigger,
+            }
+            for i in range(args.rules)
+        }
+
+    targets = {
+        rule.get("target", ""): {"ip": "127.0.0.1", "port": "104", "aet_target": "BENCHMARK"}
+        for rule in rules.values()
+        if rule.get("target", "")
+    }
+
+    settings: Dict[str, Any] = {
+        **config.mercure_defaults,
+        **{f"{folder}_folder": f"{work_folder}/{folder}" for folder in folders},
+        "series_complete_trigger": -1,
+        "study_complete_trigger": 3600,
+        "router_workers": args.workers,
+        "incoming_series_folders": args.series_folders,
+        "bookkeeper": "",
+        "targets": targets,
+        "rules": rules,
+    }
+    with open(config.configuration_filename, "w") as json_file:
+        json.dump(settings, json_file, indent=4)
+
+
+def generate_incoming(args) -> int:
+    """Creates the synthetic series in the incoming folder. Returns the number of files created."""
+    incoming_folder = Path(work_folder) / "incoming"
+    dicom_payload = os.urandom(args.file_size)
+    file_count = 0
+
+    for series in range(args.series):
+        series_uid = f"1.2.826.0.1.3680043.9.7433.{series + 1}"
+        study_uid = f"1.2.826.0.1.3680043.9.7434.{series // args.series_per_study + 1}"
+        series_folder = incoming_folder / series_uid if args.series_folders else incoming_folder
+        series_folder.mkdir(exist_ok=True)
+
+        for instance in range(args.instances):
+            tags = {
+                "SpecificCharacterSet": "ISO_IR 100",
+                "Modality": "MR",
+                "SeriesDescription": "BENCHMARK",
+                "PatientName": "Benchmark^Patient",
+                "PatientID": f"PAT{series // args.series_per_study}",
+                "AccessionNumber": f"ACC{series // args.series_per_study}",
+                "SeriesNumber": str(series + 1),
+                "InstanceNumber": str(instance + 1),
+                "SOPInstanceUID": f"{series_uid}.{instance + 1}",
+                "SeriesInstanceUID": series_uid,
+                "StudyInstanceUID": study_uid,
+                "Filename": f"MR.{series_uid}.{instance + 1}",
+            }
+            stem = f"{series_uid}#MR.{series_uid}.{instance + 1}"
+            (series_folder / (stem + ".dcm")).write_bytes(dicom_payload)
+            (series_folder / (stem + ".tags")).write_text(json.dumps(tags))
+            file_count += 1
+
+    return file_count
+
+
+def instrument(timer: PhaseTimer) -> None:
+    """Replaces the functions of the routing phases with timed versions."""
+    router.incoming_index.refresh = timer.wrap("scan", router.incoming_index.refresh)  # type: ignore
+    router.incoming_index.get_complete_series = timer.wrap(  # type: ignore
+        "scan", router.incoming_index.get_complete_series
+    )
+    route_series.get_triggered_rules = timer.wrap("rule evaluation", route_series.get_triggered_rules)
+    for function in ["create_series_task", "create_study_task", "update_study_task"]:
+        setattr(route_series, function, timer.wrap("task files", getattr(route_series, function)))
+    for function in ["clone_file", "move_series_folder", "remove_series"]:
+        setattr(route_series, function, timer.wrap("file moves", getattr(route_series, function)))
+    shutil.move = timer.wrap("file moves", shutil.move)  # type: ignore
+    router.route_studies = timer.wrap("studies", router.route_studies)
+
+
+def run_benchmark(args) -> Dict[str, Any]:
+    for folder in folders:
+        os.mkdir(f"{work_folder}/{folder}")
+    create_config(args)
+    config.read_config()
+
+    print(f"Generating {args.series} series with {args.instances} instances in {work_folder}", file=sys.stderr)
+    file_count = generate_incoming(args)
+
+    timer = PhaseTimer()
+    instrument(timer)
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    if args.mode == "router":
+        # Call the router repeatedly, as done by the router service, until the incoming folder is empty
+        runs = 0
+        while runs < args.max_runs:
+            router.run_router()
+            runs += 1
+            if not any(os.scandir(f"{work_folder}/incoming")):
+                break
+    else:
+        with timer.measure("scan"):
+            series_uids = sorted({entry.name.split("#", 1)[0] for entry in os.scandir(f"{work_folder}/incoming")})
+        for series_uid in series_uids:
+            route_series.route_series(series_uid)
+    duration = time.perf_counter() - start
+
+    results: Dict[str, Any] = {
+        "mode": args.mode,
+        "series": args.series,
+        "files": file_count,
+        "duration": duration,
+        "series_per_second": args.series / duration,
+        "files_per_second": file_count / duration,
+        "phases": {phase: timer.durations[phase] for phase in sorted(timer.durations)},
+        "remaining_files": sum(len(files) for _, _, files in os.walk(f"{work_folder}/incoming")),
+        # ru_maxrss is given in kB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if args.tracemalloc:
+        results["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+    return results
+
+
+def print_results(results: Dict[str, Any]) -> None:
+    print("")
+    print(f"Mode:              {results['mode']}")
+    print(f"Series routed:     {results['series']} ({results['files']} files)")
+    print(f"Duration:          {results['duration']:.3f} s")
+    print(f"Series/s:          {results['series_per_second']:.1f}")
+    print(f"Files/s:           {results['files_per_second']:.1f}")
+    print(f"Peak RSS:          {results['peak_rss_mb']:.1f} MB")
+    if "peak_traced_mb" in results:
+        print(f"Peak allocations:  {results['peak_traced_mb']:.1f} MB")
+    if results["remaining_files"]:
+        print(f"WARNING: {results['remaining_files']} files remain in the incoming folder")
+    print("")
+    print("Phase              Time (s)   Share")
+    for phase, duration in results["phases"].items():
+        print(f"{phase:<18} {duration:>8.3f}   {100 * duration / results['duration']:5.1f}%")
+
+
+def main(argv: List[str] = sys.argv[1:]) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark for the mercure router")
+    parser.add_argument("--series", type=int, default=100, help="number of series to generate")
+    parser.add_argument("--instances", type=int, default=100, help="number of instances per series")
+    parser.add_argument("--series-per-study", type=int, default=4, help="number of series per study")
+    parser.add_argument("--file-size", type=int, default=16384, help="size of the synthetic DICOM files in bytes")
+    parser.add_argument("--rules", type=int, default=10, help="number of generated rules")
+    parser.add_argument("--matching", type=int, default=1, help="number of generated rules triggering per series")
+    parser.add_argument("--rules-file", help="JSON file with rules to use instead of the generated rules")
+    parser.add_argument("--action", default="route", choices=["route", "process", "both", "discard", "notification"])
+    parser.add_argument("--trigger", default="series", choices=["series", "study"], help="action trigger of the rules")
+    parser.add_argument("--workers", type=int, default=1, help="number of routing workers")
+    parser.add_argument("--series-folders", action="store_true", help="store every series in its own subfolder")
+    parser.add_argument("--mode", default="router", choices=["router", "series"], help="call run_router or route_series")
+    parser.add_argument("--max-runs", type=int, default=100, help="maximum number of router runs")
+    parser.add_argument("--tracemalloc", action="store_true", help="trace the peak memory allocations (slow)")
+    parser.add_argument("--json", action="store_true", help="print the results in JSON format")
+    parser.add_argument("--keep", action="store_true", help="keep the work folder after the benchmark")
+    args = parser.parse_args(argv)
+
+    try:
+        results = run_benchmark(args)
+        if router.routing_pool is not None:
+            router.routing_pool.shutdown(wait=True)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,7 @@ from subprocess import CalledProcessError
 
 import pytest
 
-from dispatch.retry import increase_retry
+from dispatch.retry import RetryQueue, increase_retry
 from common.constants import mercure_names
 
 
@@ -60,3 +60,43 @@ def test_execute_increase_fail(fs, mocker):
     result = increase_retry(source, 5, 50)
 
     assert not result
+
+
+def test_retry_queue_backoff(fs, mocker):
+    """Checks that the delay grows with the failures of the target and that the queue is restored after a restart."""
+    fs.create_dir("/var/outgoing")
+    mocker.patch("dispatch.retry.random.uniform", return_value=0)
+    now = time.time()
+    clock = mocker.patch("dispatch.retry.time.time", return_value=now)
+
+    queue = RetryQueue()
+    queue.configure("/var/outgoing", 400)
+    # Jobs of a target failing within the same backoff period count as a single failure of the target
+    due_a = queue.schedule("job_a", "pacs", 1, 100)
+    due_b = queue.schedule("job_b", "pacs", 1, 100)
+    due_d = queue.schedule("job_d", "other", 1, 100)
+    # Only half of the delay is fixed, the other half is random
+    assert round(due_a - now) == 50
+    assert round(due_b - now) == 50
+    assert round(due_d - now) == 50
+    assert queue.is_waiting("job_a", now)
+
+    # Failures after the shortest delay of the backoff count again
+    clock.return_value = now + 50
+    assert round(queue.schedule("job_c", "pacs", 1, 100) - now) == 150
+    clock.return_value = now + 60
+    assert round(queue.schedule("job_b", "pacs", 1, 100) - now) == 160
+
+    # The queue is only written when it is flushed
+    assert not Path("/var/outgoing/.retries").exists()
+    queue.flush()
+    restored = RetryQueue()
+    restored.configure("/var/outgoing", 400)
+    assert restored.pop_due(now + 60) == ["job_a", "job_d"]
+    assert restored.waiting_count() == 2
+
+    # After a successful transfer, the target starts again with the shortest delay
+    restored.record_success("pacs")
+    assert round(restored.schedule("job_a", "pacs", 1, 100) - now) == 110
+    restored.prune(["job_a"])
+    assert restored.waiting_count() == 1
@@ -6,6 +6,7 @@ from subprocess import CalledProcessError
 
 import pytest
 
+from dispatch.process_dcmsend_result import get_stored_files, parse_instances
 from dispatch.send import execute, is_ready_for_sending
 from common.constants import mercure_names
 
@@ -137,3 +138,113 @@ def test_execute_error_case_delay_is_not_over(fs, mocker):
 
     execute(Path(source), Path(success), Path(error), 5, 1)
     assert not mock.called
+
+
+def test_execute_partial_resend(fs, mocker):
+    """This case simulates a dcmsend error after some files have been stored. The retry only sends the remaining
+    files, and the folder is moved to the success folder once all files have been stored."""
+    source = "/var/data/source/a"
+    success = "/var/data/success/"
+    error = "/var/data/error"
+
+    fs.create_dir(success)
+    fs.create_dir(error)
+    for name in ["one", "two", "three"]:
+        fs.create_file(f"{source}/{name}.dcm")
+    target = {
+        "info": dummy_info,
+        "dispatch": {"target_name": "partial", "target": {"ip": "0.0.0.0", "aet_target": "a", "port": 90}},
+    }
+    fs.create_file(f"{source}/{mercure_names.TASKFILE}", contents=json.dumps(target))
+    report = """Status Summary
+--------------
+
+Number of SOP instances : 3
+- sent to the peer       : 2
+  * with status SUCCESS  : 1
+  * with status ERROR    : 1
+
+Status Details
+--------------
+
+Number  : 1
+Filename: /var/data/source/a/one.dcm
+DIMSE Status: 0x0000 (Success)
+
+Number  : 2
+Filename: /var/data/source/a/two.dcm
+DIMSE Status: 0xa700 (Error: Refused - Out of Resources)
+
+Number  : 3
+Filename: /var/data/source/a/three.dcm
+Status  : not sent
+"""
+
+    def failed_send(command, **kwargs):
+        with open(f"{source}/{mercure_names.SENDLOG}", "w") as f:
+            f.write(report)
+        raise CalledProcessError(62, cmd="dcmsend")
+
+    mocker.patch("dispatch.send.check_output", side_effect=failed_send)
+    execute(Path(source), Path(success), Path(error), 10, 0)
+
+    assert not (Path(source) / mercure_names.SENDLOG).exists()
+    with open(f"{source}/{mercure_names.SENTFILES}", "r") as f:
+        assert json.load(f) == ["one.dcm"]
+
+    staged_files = []
+
+    def resend(command, **kwargs):
+        staged_files.extend(sorted(os.listdir(f"{source}/{mercure_names.RESENDFOLDER}")))
+        return b"Success"
+
+    sent_command = mocker.patch("dispatch.send.check_output", side_effect=resend)
+    execute(Path(source), Path(success), Path(error), 10, 0)
+
+    # The remaining files are read from a staging folder instead of being passed on the command line
+    command = sent_command.call_args[0][0]
+    assert f"{source}/{mercure_names.RESENDFOLDER}" in command
+    assert not any(argument.endswith("two.dcm") for argument in command)
+    assert staged_files == ["three.dcm", "two.dcm"]
+    assert (Path(success) / "a" / "one.dcm").exists()
+    assert not (Path(success) / "a" / mercure_names.RESENDFOLDER).exists()
+
+
+def test_execute_command_not_started(fs, mocker):
+    """This case simulates that the command cannot be started (e.g., because the command line is too long). The
+    folder is unlocked and the retry counter gets increased, as after a failed transfer."""
+    source = "/var/data/source/a"
+    success = "/var/data/success/"
+    error = "/var/data/error"
+
+    fs.create_dir(success)
+    fs.create_dir(error)
+    fs.create_file(f"{source}/one.dcm")
+    target = {
+        "info": dummy_info,
+        "dispatch": {"target_name": "unstarted", "target": {"ip": "0.0.0.0", "aet_target": "a", "port": 90}},
+    }
+    fs.create_file(f"{source}/{mercure_names.TASKFILE}", contents=json.dumps(target))
+
+    mocker.patch("dispatch.send.check_output", side_effect=OSError(7, "Argument list too long"))
+    execute(Path(source), Path(success), Path(error), 10, 0)
+
+    assert not (Path(source) / mercure_names.PROCESSING).exists()
+    with open(f"{source}/{mercure_names.TASKFILE}", "r") as f:
+        assert json.load(f)["dispatch"]["retries"] == 1
+
+
+def test_parse_dcmsend_report():
+    """Checks that the stored files are read from the status details of a dcmsend report (+crf). Files stored with a
+    warning count as stored, files that failed, have not been sent or have no recognizable DIMSE status code need to be
+    sent again."""
+    report_file = Path(__file__).parent.parent / "data" / "dcmsend_report.txt"
+    assert parse_instances(report_file) == {
+        "1.2.840.1#001.dcm": True,
+        "1.2.840.1#002.dcm": True,
+        "1.2.840.1#003.dcm": False,
+        "1.2.840.1#004.dcm": False,
+        "1.2.840.1#005.dcm": False,
+        "1.2.840.1#006.dcm": False,
+    }
+    assert get_stored_files(report_file) == {"1.2.840.1#001.dcm", "1.2.840.1#002.dcm"}
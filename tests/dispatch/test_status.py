@@ -43,6 +43,21 @@ def test_is_read_for_sending(fs):
     assert is_ready_for_sending("/var/data")
 
 
+def test_is_read_for_sending_with_manifest(fs):
+    """Checks that the files listed in the manifest of the task file are used instead of searching the folder."""
+    fs.create_dir("/var/data/")
+    target = {
+        "info": dummy_info,
+        "dispatch": {"target": {"ip": "0.0.0.0", "port": 104, "aet_target": "ANY"}},
+        "manifest": [{"name": "a", "size": 3, "sop_uid": "1.2.3"}, {"name": "b", "size": 3, "sop_uid": "1.2.4"}],
+    }
+    fs.create_file("/var/data/task.json", contents=json.dumps(target))
+    fs.create_file("/var/data/b.dcm")
+    assert not is_ready_for_sending("/var/data")
+    fs.create_file("/var/data/a.dcm")
+    assert is_ready_for_sending("/var/data")
+
+
 def test_has_been_send(fs):
     fs.create_dir("/var/data/")
     fs.create_file("/var/data/" + mercure_names.SENDLOG)
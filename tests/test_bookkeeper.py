@@ -8,3 +8,28 @@ import bookkeeper as b
 def test_bookkeeper_no_syntax_errors():
     """ Checks if bookkeeper.py can be started. """
     assert b
+
+
+def test_parse_bulk_events():
+    """Checks that bulk submissions are grouped by event type and that invalid events are skipped."""
+    rows = b.parse_bulk_events(
+        [
+            {"type": "series-event", "time": 1600000000, "data": {"event": "ROUTE", "series_uid": "UID", "file_count": "3"}},
+            {"type": "register-dicom", "data": {"filename": "a.dcm", "file_uid": "FILE", "series_uid": "UID"}},
+            {"type": "series-event", "data": {"event": "MOVE", "series_uid": "UID"}},
+            {
+                "type": "register-dicom-series",
+                "time": 1600000000,
+                "data": {"series_uid": "UID", "files": [{"filename": "b", "file_uid": "B"}, {"filename": "c", "file_uid": "C"}]},
+            },
+            {"type": "unknown", "data": {}},
+        ]
+    )
+    assert sorted(rows.keys()) == ["register-dicom", "register-dicom-series", "series-event"]
+    assert len(rows["series-event"]) == 2
+    assert rows["series-event"][0]["file_count"] == 3
+    assert rows["series-event"][0]["time"].timestamp() == 1600000000
+    assert rows["register-dicom"][0]["file_uid"] == "FILE"
+    assert [row["file_uid"] for row in rows["register-dicom-series"]] == ["B", "C"]
+    assert all(row["series_uid"] == "UID" for row in rows["register-dicom-series"])
+    assert rows["register-dicom-series"][1]["time"].timestamp() == 1600000000
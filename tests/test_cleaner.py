@@ -2,9 +2,14 @@
 test_cleaner.py
 ===============
 """
-from datetime import datetime
+import os
+import time as pytime
+from datetime import datetime, timedelta
 from datetime import time
+from pathlib import Path
 import cleaner as c
+import common.retention as retention
+from testing_common import load_config
 
 # helper func
 def _to_time(time) -> time:
@@ -39,3 +44,89 @@ def test_wrong_start_input_offpeak():
 def test_wrong_end_input_offpeak():
     is_ = c._is_offpeak("22:00", "asdf", _to_time("5:00"))
     assert is_
+
+
+def test_retention_low_disk_space(fs, mocker):
+    load_config(fs, {"retention": 10000, "cleaner_min_retention": 1000, "cleaner_space_low": 20, "cleaner_space_critical": 5})
+    send_event = mocker.patch("cleaner.monitor.send_event")
+    mocker.patch.object(c, "reported_retention", {})
+
+    mocker.patch("cleaner.get_free_space", return_value=50)
+    assert c.get_retention("/var/success") == timedelta(seconds=10000)
+    assert send_event.call_count == 0
+    mocker.patch("cleaner.get_free_space", return_value=12.5)
+    assert c.get_retention("/var/success") == timedelta(seconds=5500)
+    assert send_event.call_count == 1
+
+    # The reduction is only reported again if the retention changes noticeably
+    assert c.get_retention("/var/success") == timedelta(seconds=5500)
+    mocker.patch("cleaner.get_free_space", return_value=12.4)
+    c.get_retention("/var/success")
+    assert send_event.call_count == 1
+
+    mocker.patch("cleaner.get_free_space", return_value=2)
+    assert c.get_retention("/var/success") == timedelta(seconds=1000)
+    assert send_event.call_count == 2
+    mocker.patch("cleaner.get_free_space", return_value=50)
+    c.get_retention("/var/success")
+    assert send_event.call_count == 3
+
+
+def test_clean_dir_budget(fs, mocker):
+    load_config(fs, {})
+    mocker.patch("cleaner.send_series_event")
+    now = pytime.time()
+    for index, age in enumerate([3000, 5000, 100]):
+        fs.create_file(f"/var/success/case_{index}/SERIES#file.dcm", st_size=1000)
+        os.utime(f"/var/success/case_{index}", (now - age, now - age))
+
+    c.journals.clear()
+    deleted = []
+    mocker.patch("cleaner.rmtree", side_effect=lambda path: deleted.append(path.name))
+    clock = mocker.patch("cleaner.time.monotonic", return_value=100)
+    budget = c.DeletionBudget(1000, 1)
+    sleep = mocker.patch("cleaner.time.sleep")
+    c.clean_dir("/var/success", timedelta(seconds=1000), budget)
+
+    # Oldest folders are deleted first. Once the budget is used up, the cleaner returns without waiting
+    assert deleted == ["case_1"]
+    assert budget.deleted == 1000
+    assert not sleep.called
+
+    # The remaining folders are deleted during the next run, after the budget has been refilled
+    clock.return_value = 101
+    c.clean_dir("/var/success", timedelta(seconds=1000), budget)
+    assert deleted == ["case_1", "case_0"]
+    assert budget.deleted == 2000
+
+
+def test_clean_dir_journal(fs, mocker):
+    load_config(fs, {})
+    mocker.patch("cleaner.send_series_event")
+    c.journals.clear()
+    now = pytime.time()
+
+    # Folders recorded in the journal are deleted in the order of the journal entries. The services don't walk the
+    # folders to determine their size
+    mocker.patch("common.retention.get_folder_size", side_effect=AssertionError("folder walked"))
+    timestamp = mocker.patch("common.retention.time.time")
+    for name, age in [("case_0", 3000), ("case_1", 5000), ("case_2", 100)]:
+        fs.create_file(f"/var/success/{name}/{name}#file.dcm", st_size=1000)
+        timestamp.return_value = now - age
+        retention.record(f"/var/success/{name}", name)
+    # Folders missing in the journal are found by the scan, using the modification time
+    fs.create_file("/var/success/case_3/case_3#file.dcm")
+    os.utime("/var/success/case_3", (now - 4000, now - 4000))
+    # Folders in other locations are not recorded
+    fs.create_dir("/var/error/case_4")
+    retention.record("/var/error/case_4", "case_4")
+    assert not (Path("/var/error") / retention.JOURNAL).exists()
+
+    deleted = []
+    mocker.patch("cleaner.rmtree", side_effect=lambda path: deleted.append(path.name))
+    find_series_uid = mocker.patch("cleaner.find_series_uid", return_value="case_3")
+    c.clean_dir("/var/success", timedelta(seconds=1000))
+
+    assert deleted == ["case_1", "case_3", "case_0"]
+    find_series_uid.assert_called_once_with(Path("/var/success/case_3"))
+    assert [entry[1] for entry in c.journals["/var/success"].entries] == ["case_2"]
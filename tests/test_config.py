@@ -0,0 +1,48 @@
+"""
+test_config.py
+==============
+"""
+import json
+import time
+
+import common.config as config
+
+
+def write_config(path, settings) -> None:
+    with open(path, "w") as json_file:
+        json.dump(settings, json_file)
+
+
+def test_config_watcher(tmp_path, monkeypatch):
+    settings = {f"{folder}_folder": str(tmp_path) for folder in ["incoming", "studies", "outgoing", "success", "error", "discard", "processing"]}
+    settings["rules"] = {"rule": {"rule": "True", "target": "target"}}
+    config_file = tmp_path / "mercure.json"
+    write_config(config_file, settings)
+    monkeypatch.setattr(config, "configuration_filename", str(config_file))
+    monkeypatch.setattr(config, "configuration_timestamp", 0)
+
+    try:
+        config.start_watcher()
+        first = config.read_config()
+        rules_version = config.get_section_version("rules")
+        targets_version = config.get_section_version("targets")
+
+        # Without modification, the configuration is not read again
+        assert config.read_config() is first
+
+        settings["rules"]["rule"]["target"] = "other_target"
+        write_config(config_file, settings)
+        for _ in range(50):
+            if config.config_modified.is_set():
+                break
+            time.sleep(0.1)
+        assert config.config_modified.is_set()
+
+        second = config.read_config()
+        assert second is not first
+        assert second.rules["rule"].target == "other_target"
+        # Only the changed section gets a new version
+        assert config.get_section_version("rules") > rules_version
+        assert config.get_section_version("targets") == targets_version
+    finally:
+        config.stop_watcher()
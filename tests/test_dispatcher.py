@@ -2,9 +2,164 @@
 test_dispatcher.py
 ==================
 """
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
 import dispatcher as d
+from common.constants import mercure_names
+from common.target_health import FAILURE_THRESHOLD, PROBE_INTERVAL, TargetHealth, read_health
+from common.types import DicomTarget
+from dispatch.outgoing_index import OutgoingIndex
+from testing_common import load_config
+
+dummy_info = {
+    "action": "route",
+    "uid": "",
+    "uid_type": "series",
+    "triggered_rules": "",
+    "mrn": "",
+    "acc": "",
+    "mercure_version": "",
+    "mercure_appliance": "",
+    "mercure_server": "",
+}
 
 
 def test_dispatcher_no_syntax_errors():
     """ Checks if dispatcher.py can be started. """
     assert d
+
+
+def test_dispatch_parallel_target_limits(fs, mocker):
+    """Checks that the number of parallel transfers is limited per target."""
+    load_config(
+        fs,
+        {
+            "dispatcher_workers": 4,
+            "targets": {
+                "target_a": {"ip": "", "port": "", "aet_target": "", "max_parallel_transfers": 1},
+                "target_b": {"ip": "", "port": "", "aet_target": "", "max_parallel_transfers": 2},
+            },
+        },
+    )
+    for target_name in ["target_a", "target_b"]:
+        for i in range(3):
+            folder = f"/var/outgoing/{target_name}_{i}"
+            fs.create_file(f"{folder}/one.dcm")
+            task = {
+                "info": dummy_info,
+                "dispatch": {"target_name": target_name, "target": {"ip": "", "port": "", "aet_target": ""}},
+            }
+            fs.create_file(f"{folder}/{mercure_names.TASKFILE}", contents=json.dumps(task))
+
+    release = threading.Event()
+    sent_folders = []
+
+    def fake_execute(source_folder, *args):
+        sent_folders.append(source_folder.name)
+        release.wait(5)
+
+    mocker.patch("dispatcher.execute", new=fake_execute)
+    d.dispatch(None)
+
+    assert sorted(sent_folders) == ["target_a_0", "target_b_0", "target_b_1"]
+    assert d.active_transfers == {"target_a": 1, "target_b": 2}
+
+    # Folders that are still being sent must not be submitted again
+    d.dispatch(None)
+    assert len(sent_folders) == 3
+
+    release.set()
+    d.dispatch_pool.shutdown(wait=True)
+    d.dispatch_pool = None
+    assert d.active_transfers == {}
+    assert d.active_folders == set()
+
+
+def test_outgoing_index(fs):
+    """Checks that the task files are only read again if the job folder has been modified."""
+    fs.create_dir("/var/outgoing")
+    for name, next_retry_at in [("a", None), ("b", time.time() + 3600)]:
+        task = {
+            "info": dummy_info,
+            "dispatch": {"target": {"ip": "", "port": "", "aet_target": ""}, "next_retry_at": next_retry_at},
+        }
+        fs.create_file(f"/var/outgoing/{name}/one.dcm")
+        fs.create_file(f"/var/outgoing/{name}/{mercure_names.TASKFILE}", contents=json.dumps(task))
+        os.utime(f"/var/outgoing/{name}", (time.time() - 60, time.time() - 60))
+
+    index = OutgoingIndex()
+    index.refresh("/var/outgoing")
+    assert index.reads == 2
+    # Jobs that are waiting for a retry are not returned
+    assert [folder for folder, _ in index.get_ready_jobs()] == ["/var/outgoing/a"]
+
+    index.refresh("/var/outgoing")
+    assert index.reads == 2
+
+    # Locking the job modifies the folder, so that the job is read again (the fake file system doesn't update the
+    # modification time of the folder by itself)
+    Path(f"/var/outgoing/a/{mercure_names.LOCK}").touch()
+    os.utime("/var/outgoing/a", (time.time() - 30, time.time() - 30))
+    index.refresh("/var/outgoing")
+    assert index.reads == 3
+    assert index.get_ready_jobs() == []
+
+    fs.remove_object("/var/outgoing/b")
+    index.refresh("/var/outgoing")
+    assert index.job_count() == 1
+
+
+def test_target_circuit_breaker(fs, mocker):
+    """Checks that an unavailable target is skipped until it responds to the probe again and a trial job succeeds."""
+    fs.create_dir("/var/outgoing")
+    probe = mocker.patch("common.target_health.probe_target", return_value=(False, 0.5))
+    mocker.patch("common.target_health.monitor.send_event")
+    # Run the probes synchronously, so that their result can be checked
+    mocker.patch(
+        "common.target_health.threading.Thread",
+        side_effect=lambda target, args, **kwargs: mocker.Mock(start=lambda: target(*args)),
+    )
+    target = DicomTarget(ip="127.0.0.1", port="104", aet_target="ANY")
+
+    health = TargetHealth()
+    health.configure("/var/outgoing")
+
+    # Failures caused by the job itself don't count towards the breaker
+    for _ in range(FAILURE_THRESHOLD):
+        health.record_failure("pacs", "EXITCODE_INVALID_INPUT_FILE", False)
+    assert health.is_available("pacs", target)
+
+    for _ in range(FAILURE_THRESHOLD):
+        assert health.is_available("pacs", target)
+        health.record_failure("pacs", "EXITCODE_CANNOT_INITIALIZE_NETWORK")
+
+    # The target is not probed again before the probe interval has passed
+    assert not health.is_available("pacs", target)
+    probe.assert_not_called()
+    assert read_health("/var/outgoing")["pacs"]["unavailable_since"] > 0
+
+    health.targets["pacs"].last_probe -= PROBE_INTERVAL
+    assert not health.is_available("pacs", target)
+    assert probe.call_count == 1
+
+    # After a successful probe, only a single job is sent as trial
+    probe.return_value = (True, 0.01)
+    health.targets["pacs"].last_probe -= PROBE_INTERVAL
+    assert not health.is_available("pacs", target)
+    assert read_health("/var/outgoing")["pacs"]["echo_latency"] == 0.01
+    assert health.is_available("pacs", target)
+    assert not health.is_available("pacs", target)
+
+    # If the trial fails, the target is probed again
+    health.record_failure("pacs", "EXITCODE_CANNOT_INITIALIZE_NETWORK")
+    assert not health.is_available("pacs", target)
+    health.targets["pacs"].last_probe -= PROBE_INTERVAL
+    assert not health.is_available("pacs", target)
+    assert health.is_available("pacs", target)
+    health.record_success("pacs", 1.5)
+    assert health.is_available("pacs", target)
+    assert health.is_available("pacs", target)
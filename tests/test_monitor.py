@@ -0,0 +1,82 @@
+"""
+test_monitor.py
+===============
+"""
+import queue
+import threading
+import common.monitor as monitor
+
+
+def test_events_are_queued(mocker):
+    """Checks that events are queued instead of being sent from the calling thread."""
+    mocker.patch.object(monitor, "bookkeeper_address", "http://bookkeeper")
+    mocker.patch.object(monitor, "event_queue", queue.Queue(maxsize=10))
+    post = mocker.patch("requests.post")
+
+    monitor.send_event(monitor.m_events.BOOT, monitor.severity.INFO, "test")
+    monitor.send_series_event(monitor.s_events.ROUTE, "UID", 1, "target", "")
+
+    assert not post.called
+    endpoint, payload, _ = monitor.event_queue.get_nowait()
+    assert endpoint == "/mercure-event"
+    assert payload == {"sender": monitor.sender_name, "event": "BOOT", "severity": 0, "description": "test"}
+    assert monitor.event_queue.get_nowait()[0] == "/series-event"
+
+
+def test_events_are_dropped_when_queue_full(mocker):
+    """Checks that the caller is not blocked if the queue is full and that dropped events are counted."""
+    mocker.patch.object(monitor, "bookkeeper_address", "http://bookkeeper")
+    mocker.patch.object(monitor, "event_queue", queue.Queue(maxsize=2))
+    mocker.patch.object(monitor, "dropped_events", 0)
+
+    for _ in range(5):
+        monitor.send_event(monitor.m_events.BOOT)
+
+    assert monitor.get_event_statistics()["queued"] == 2
+    assert monitor.get_event_statistics()["dropped"] == 3
+
+
+def test_dropped_events_are_reported(mocker):
+    """Checks that the sender thread warns about dropped events once per interval, and only if the count increased."""
+    mocker.patch.object(monitor, "dropped_events", 3)
+    mocker.patch.object(monitor, "reported_dropped_events", 0)
+    mocker.patch.object(monitor, "last_statistics_report", 0)
+    warning = mocker.patch.object(monitor.logger, "warning")
+
+    monitor.report_statistics()
+    assert warning.call_count == 1
+    assert "Dropped 3 events" in warning.call_args[0][0]
+
+    # Further drops are reported after the interval has passed
+    monitor.dropped_events = 5
+    monitor.report_statistics()
+    assert warning.call_count == 1
+    monitor.last_statistics_report = 0
+    monitor.report_statistics()
+    assert warning.call_count == 2
+    assert "Dropped 2 events" in warning.call_args[0][0]
+
+    monitor.last_statistics_report = 0
+    monitor.report_statistics()
+    assert warning.call_count == 2
+
+
+def test_sender_survives_failed_batch(mocker):
+    """Checks that bytes values are converted and that an error while sending a batch doesn't end the sender."""
+    mocker.patch.object(monitor, "bookkeeper_address", "http://bookkeeper")
+    mocker.patch.object(monitor, "event_queue", queue.Queue(maxsize=10))
+    mocker.patch.object(monitor, "failed_events", 0)
+    mocker.patch.object(monitor, "EVENT_FLUSH_INTERVAL", 0)
+
+    monitor.send_series_event(monitor.s_events.ERROR, "UID", 0, "target", b"dcmsend output")
+    assert monitor.event_queue.queue[0][1]["info"] == "dcmsend output"
+
+    send_batch = mocker.patch.object(monitor, "send_batch", side_effect=[TypeError("not serializable"), None])
+    monitor.send_event(monitor.m_events.BOOT)
+    thread = threading.Thread(target=monitor.process_event_queue, daemon=True)
+    thread.start()
+    monitor.event_queue.join()
+
+    assert thread.is_alive()
+    assert send_batch.call_count == 2
+    assert monitor.failed_events == 1
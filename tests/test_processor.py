@@ -3,9 +3,11 @@ test_processor.py
 ==============
 """
 import shutil
+import threading
 from pytest_mock import MockerFixture
 
 import process.process_series
+import process.module_images
 import router
 import daiquiri
 import processor
@@ -84,9 +86,10 @@ def create_and_route(fs, mocker, uid="TESTFAKEUID") -> List[str]:
 
     router.run_router()
 
-    router.route_series.assert_called_once_with(uid)  # type: ignore
-    routing.route_series.push_series_serieslevel.assert_called_once_with({"catchall": True}, [f"{uid}#bar"], uid, {})  # type: ignore
-    routing.route_series.push_serieslevel_outgoing.assert_called_once_with({"catchall": True}, [f"{uid}#bar"], uid, {}, {})  # type: ignore
+    router.route_series.assert_called_once_with(uid, [f"{uid}#bar"])  # type: ignore
+    manifest = [ManifestEntry(name=f"{uid}#bar", size=11, sop_uid="")]
+    routing.route_series.push_series_serieslevel.assert_called_once_with({"catchall": True}, [f"{uid}#bar"], uid, {}, manifest)  # type: ignore
+    routing.route_series.push_serieslevel_outgoing.assert_called_once_with({"catchall": True}, [f"{uid}#bar"], uid, {}, {}, manifest)  # type: ignore
 
     processor_path = next(Path("/var/processing").iterdir())
     assert ["task.json", f"{uid}#bar.dcm", f"{uid}#bar.tags"] == [
@@ -128,6 +131,14 @@ def test_process_series_nomad(fs, mocker: MockerFixture):
     mocker.patch.object(Job, "register_job", new=lambda *args: None)
     mocker.patch.object(Job, "dispatch_job", new=fake_run)
     mocker.patch.object(Job, "get_job", new=lambda x, y: dict(Status="dead"))
+    mocker.patch.object(
+        Jobs,
+        "get_jobs",
+        new=lambda *args, **kwargs: [
+            dict(ID="mercure-processor/dispatch-1624378734-e8388181", Status="dead"),
+            dict(ID="mercure-processor/dispatch-1234567898-12345678", Status="dead"),
+        ],
+    )
 
     logger.info("Run processing...")
     processor.run_processor()
@@ -158,6 +169,7 @@ def test_process_series_nomad(fs, mocker: MockerFixture):
             "mercure_version": "0.2a",
             "mercure_appliance": "master",
             "mercure_server": socket.gethostname(),
+            "priority": "normal",
         },
         "dispatch": {},
         "process": {
@@ -251,3 +263,146 @@ def test_process_series(fs, mocker: MockerFixture):
 
     assert [] == [k.name for k in Path("/var/processing").glob("**/*")]
     assert files == [k.name for k in (Path("/var/success") / processor_path.name).glob("*") if k.is_file()]
+
+
+def test_processing_slots(fs, mocker: MockerFixture):
+    load_config(fs, {"processing_slots": 2, **config_partial})
+    for name in ["case_1", "case_2", "case_3"]:
+        fs.create_file(f"/var/processing/{name}/{name}#bar.dcm", contents="asdfasdfafd")
+        fs.create_file(f"/var/processing/{name}/task.json", contents="{}")
+
+    release = threading.Event()
+    started: List[str] = []
+
+    def fake_process_series(folder):
+        started.append(folder)
+        release.wait(5)
+        (Path(folder) / ".processing").unlink()
+
+    mocker.patch("processor.process_series", new=fake_process_series)
+
+    # Only two jobs should be started, and both folders need to be marked as processing
+    processor.search_folder(0)
+    assert sorted(processor.active_jobs) == ["/var/processing/case_1", "/var/processing/case_2"]
+    assert (Path("/var/processing/case_1") / ".processing").exists()
+    assert (Path("/var/processing/case_2") / ".processing").exists()
+    assert not (Path("/var/processing/case_3") / ".processing").exists()
+
+    # No free slot, so the remaining case should not be started
+    processor.search_folder(1)
+    assert "/var/processing/case_3" not in processor.active_jobs
+
+    release.set()
+    processor.processing_pool.shutdown(wait=True)  # type: ignore
+    processor.processing_pool = None
+    assert processor.active_jobs == {}
+    assert sorted(started) == ["/var/processing/case_1", "/var/processing/case_2"]
+
+
+def test_prioritize_tasks(fs, mocker: MockerFixture):
+    load_config(fs, config_partial)
+    tasks = {}
+    for index, priority in enumerate(["normal", "offpeak", "urgent", "normal"]):
+        folder = f"/var/processing/case_{index}"
+        fs.create_file(f"{folder}/task.json", contents=json.dumps({"info": {"priority": priority}}))
+        tasks[folder] = 1000.0 + index
+    fs.create_file("/var/processing/case_4/task.json", contents="{}")
+    tasks["/var/processing/case_4"] = 999.0
+
+    mocker.patch("processor.helper.is_offpeak", return_value=False)
+    processor.scheduler_runs = 0
+    processor.task_priorities = {}
+
+    # Urgent cases first, offpeak cases are held outside of the offpeak window
+    expected = ["case_2", "case_4", "case_0", "case_3"]
+    assert [Path(k).name for k in processor.prioritize_tasks(tasks)] == expected
+    assert [Path(k).name for k in processor.prioritize_tasks(tasks)] == expected
+    # Every third run, urgent cases don't overtake older normal cases
+    assert [Path(k).name for k in processor.prioritize_tasks(tasks)] == ["case_4", "case_0", "case_2", "case_3"]
+
+    processor.helper.is_offpeak.return_value = True  # type: ignore
+    assert [Path(k).name for k in processor.prioritize_tasks(tasks)] == ["case_2", "case_4", "case_0", "case_3", "case_1"]
+
+
+def test_module_images(fs, mocker: MockerFixture):
+    load_config(fs, {**config_partial, "modules": {**config_partial["modules"], "other": {"docker_tag": "busybox:stable"}}})
+    client = mocker.Mock()
+    client.api.pull.return_value = [
+        {"status": "Pulling from library/busybox", "id": "stable"},
+        {"status": "Downloading", "id": "layer1"},
+        {"status": "Pull complete", "id": "layer1"},
+    ]
+    mocker.patch("process.module_images.get_docker_client", return_value=client)
+    module_images = process.module_images
+    module_images.pulled_config_version = -1
+
+    module_images.update_module_images()
+    # The images are only pulled again if the configuration has changed
+    module_images.update_module_images()
+    module_images.wait_for_image("busybox:stable", 5)
+    module_images.pull_pool.shutdown(wait=True)  # type: ignore
+    module_images.pull_pool = None
+
+    client.api.pull.assert_called_once_with("busybox", "stable", stream=True, decode=True)
+    assert module_images.active_pulls == {}
+
+    # Jobs don't wait longer than the timeout for a pull that hangs
+    module_images.active_pulls["busybox:stable"] = threading.Event()
+    assert not module_images.wait_for_image("busybox:stable", 0.01)
+    module_images.finish_pull("busybox:stable")
+    assert module_images.wait_for_image("busybox:stable", 0.01)
+
+
+def test_nomad_job_status(mocker: MockerFixture):
+    connection = mocker.Mock()
+    connection.jobs.get_jobs.return_value = [{"ID": "processor-a/dispatch-1", "Status": "dead"}]
+    connection.job.get_job.return_value = {"Status": "running"}
+    mocker.patch("processor.get_nomad_connection", return_value=connection)
+
+    # Jobs of the same module are listed with a single request
+    status = processor.get_job_status(["processor-a/dispatch-1", "processor-a/dispatch-2"])
+    connection.jobs.get_jobs.assert_called_once_with(prefix="processor-a/dispatch-")
+    assert status == {"processor-a/dispatch-1": "dead", "processor-a/dispatch-2": "running"}
+
+    # Without a specific common prefix, the jobs are queried individually instead of listing all jobs
+    connection.reset_mock()
+    processor.get_job_status(["processor-a/dispatch-1", "processor-b/dispatch-2"])
+    assert not connection.jobs.get_jobs.called
+    assert connection.job.get_job.call_count == 2
+
+
+def test_nomad_job_registration(fs, mocker: MockerFixture):
+    load_config(fs, {"process_runner": "nomad", **config_partial})
+    fs.create_file(f"nomad/mercure-processor-template.nomad", contents="{{ image }}")
+    connection = mocker.Mock()
+    connection.jobs.parse.return_value = {}
+    connection.job.dispatch_job.return_value = {"DispatchedJobID": "processor-test_module/dispatch-1"}
+    mocker.patch("process.process_series.get_nomad_connection", return_value=connection)
+    process.process_series.registered_jobs.clear()
+
+    task = Task(
+        info=TaskInfo(
+            action="process",
+            uid="TESTFAKEUID",
+            uid_type="series",
+            triggered_rules={"catchall": True},
+            applied_rule="catchall",
+            mrn="",
+            acc="",
+            mercure_version="",
+            mercure_appliance="",
+            mercure_server="",
+        ),
+        process=TaskProcessing(module_name="test_module", module_config=Module(docker_tag="busybox:stable")),
+    )
+    for name in ["case_1", "case_2"]:
+        fs.create_dir(f"/var/processing/{name}")
+        assert process.process_series.nomad_runtime(task, f"/var/processing/{name}")
+
+    # The job is only registered again if the rendered specification changes
+    connection.job.register_job.assert_called_once()
+    assert connection.job.dispatch_job.call_count == 2
+
+    task.process.module_config.docker_tag = "busybox:latest"  # type: ignore
+    assert process.process_series.nomad_runtime(task, "/var/processing/case_1")
+    assert connection.job.register_job.call_count == 2
@@ -3,10 +3,13 @@ test_router.py
 ==============
 """
 import os
+import time
 import router
+import common.config as config
 import json
 from pprint import pprint
 from common.types import *
+from common.constants import mercure_names
 import routing
 import routing.generate_taskfile
 from pathlib import Path
@@ -64,9 +67,10 @@ def test_route_series(fs, mocker):
 
     router.run_router()
 
-    router.route_series.assert_called_once_with(uid)  # type: ignore
-    routing.route_series.push_series_serieslevel.assert_called_once_with({"catchall": True}, [f"{uid}#bar"], uid, {})  # type: ignore
-    routing.route_series.push_serieslevel_outgoing.assert_called_once_with({"catchall": True}, [f"{uid}#bar"], uid, {}, {"test_target": "catchall"})  # type: ignore
+    router.route_series.assert_called_once_with(uid, [f"{uid}#bar"])  # type: ignore
+    manifest = [ManifestEntry(name=f"{uid}#bar", size=11, sop_uid="")]
+    routing.route_series.push_series_serieslevel.assert_called_once_with({"catchall": True}, [f"{uid}#bar"], uid, {}, manifest)  # type: ignore
+    routing.route_series.push_serieslevel_outgoing.assert_called_once_with({"catchall": True}, [f"{uid}#bar"], uid, {}, {"test_target": "catchall"}, manifest)  # type: ignore
 
     out_path = next(Path("/var/outgoing").iterdir())
     try:
@@ -86,6 +90,7 @@ def test_route_series(fs, mocker):
         assert task.info.triggered_rules["catchall"] == True  # type: ignore
         assert task.process == TaskProcessing()  # TODO: should this be {}?
         assert task.study == {}
+        assert task.manifest == manifest
 
     # routing.generate_taskfile.create_series_task.assert_called_once()
 
@@ -93,3 +98,374 @@ def test_route_series(fs, mocker):
 def test_router_no_syntax_errors():
     """Checks if router.py can be started."""
     assert router
+
+
+def test_incoming_index(fs):
+    """Checks that the incoming index collects the series and that routed files are removed from the index."""
+    from routing.incoming_index import IncomingIndex
+
+    fs.create_dir("/var/incoming")
+    fs.create_file("/var/incoming/SERIESA#one.dcm")
+    fs.create_file("/var/incoming/SERIESA#one.tags", contents="{}")
+    fs.create_file("/var/incoming/SERIESA#two.dcm")
+    fs.create_file("/var/incoming/SERIESA#two.tags", contents="{}")
+    fs.create_file("/var/incoming/SERIESB#one.dcm")
+    fs.create_file("/var/incoming/SERIESB#one.tags", contents="{}")
+
+    index = IncomingIndex()
+    index.refresh("/var/incoming", 60)
+
+    assert index.get_complete_series(-60) == {
+        "SERIESA": ["SERIESA#one", "SERIESA#two"],
+        "SERIESB": ["SERIESB#one"],
+    }
+    assert index.get_complete_series(60) == {}
+    assert index.file_count() == 3
+    assert not index.has_error_files()
+
+    index.remove_files("SERIESA", ["SERIESA#one", "SERIESA#two"])
+    assert index.get_complete_series(-60) == {"SERIESB": ["SERIESB#one"]}
+
+
+def test_incoming_index_events_during_rescan(fs, mocker):
+    """Checks that notifications received during a rescan are kept when the scanned index replaces the old one."""
+    from routing import incoming_index
+    from routing.incoming_index import IncomingIndex
+
+    fs.create_dir("/var/incoming")
+    fs.create_file("/var/incoming/SERIESA#one.tags", contents="{}")
+    index = IncomingIndex()
+    index.folder = "/var/incoming"
+
+    real_scandir = os.scandir
+
+    def scandir(path):
+        entries = list(real_scandir(path))
+        # File that arrives after the folder has been listed
+        fs.create_file("/var/incoming/SERIESA#two.tags", contents="{}")
+        index.add_file("SERIESA#two.tags")
+        return iter(entries)
+
+    mocker.patch.object(incoming_index.os, "scandir", side_effect=scandir)
+    index.rescan()
+
+    assert index.get_complete_series(-60) == {"SERIESA": ["SERIESA#one", "SERIESA#two"]}
+
+
+def test_locked_series_remains_in_index(fs, mocker):
+    """Checks that the files of a series remain in the incoming index if the series could not be routed."""
+    load_config(fs, {"rules": {"catchall": {"rule": "True", "target": "test_target", "action": "route"}}})
+
+    uid = "UIDUIDUID"
+    fs.create_file(f"/var/incoming/{uid}#bar.dcm", contents="asdfasdfafd")
+    fs.create_file(f"/var/incoming/{uid}#bar.tags", contents="{}")
+    fs.create_file(f"/var/incoming/{uid}{mercure_names.LOCK}")
+
+    router.run_router()
+
+    assert list(Path("/var/outgoing").iterdir()) == []
+    assert router.incoming_index.get_complete_series(-60) == {uid: [f"{uid}#bar"]}
+
+    os.remove(f"/var/incoming/{uid}{mercure_names.LOCK}")
+    router.run_router()
+
+    assert len(list(Path("/var/outgoing").iterdir())) == 1
+    assert router.incoming_index.series_count() == 0
+
+
+def test_route_series_frees_lock_on_error(fs, mocker):
+    """Checks that the lock file of a series is removed if the series can't be routed because of missing or invalid
+    tags files."""
+    load_config(fs, {"rules": {"catchall": {"rule": "True", "target": "test_target", "action": "route"}}})
+    uid = "UIDUIDUID"
+
+    assert not routing.route_series.route_series(uid, [f"{uid}#missing"])
+    assert not Path(f"/var/incoming/{uid}{mercure_names.LOCK}").exists()
+
+    fs.create_file(f"/var/incoming/{uid}#bar.dcm", contents="asdfasdfafd")
+    fs.create_file(f"/var/incoming/{uid}#bar.tags", contents="{invalid")
+    assert not routing.route_series.route_series(uid, [f"{uid}#bar"])
+    assert not Path(f"/var/incoming/{uid}{mercure_names.LOCK}").exists()
+
+
+def test_compiled_rules():
+    """Checks that compiled rules evaluate like parsed rules and that unchanged rules are reused."""
+    from common import rule_evaluation
+
+    tags = {"Modality": "MR", "SeriesDescription": "AX T1", "SliceThickness": "3"}
+    for rule in [
+        "@Modality@ == 'MR'",
+        "'T2' in @SeriesDescription@",
+        "float(@SliceThickness@) > 2",
+        "@Missing@ == 'x'",
+        "True in [k in @SeriesDescription@ for k in ['T1','T2']]",
+    ]:
+        assert rule_evaluation.CompiledRule(rule).evaluate(tags) == rule_evaluation.parse_rule(rule, tags)
+
+    assert rule_evaluation.CompiledRule("True in [k in @SeriesDescription@ for k in ['T1','T2']]").evaluate(tags)
+    assert rule_evaluation.CompiledRule("(lambda d: 'AX' in d)(@SeriesDescription@)").evaluate(tags)
+
+    first = rule_evaluation.get_compiled_rules({"a": Rule(rule="True"), "b": Rule(rule="False")}, 1)
+    second = rule_evaluation.get_compiled_rules({"a": Rule(rule="True"), "b": Rule(rule="1 == 1")}, 2)
+    assert first["a"] is second["a"]
+    assert second["b"].evaluate(tags)
+
+
+def test_rule_index():
+    """Checks that the rule index only skips rules that cannot trigger for the given tags."""
+    from common import rule_evaluation
+
+    rules = {
+        "mr": Rule(rule="@Modality@ == 'MR'"),
+        "ct_pt": Rule(rule="@Modality@ in ['CT', 'PT']"),
+        "t2": Rule(rule="'T2' in @SeriesDescription@"),
+        "mr_station": Rule(rule="(@Modality@ == 'MR') & (@StationName@ == 'MR1')"),
+        "station_or": Rule(rule="(@StationName@ == 'MR1') | (@StationName@ == 'CT1')"),
+        "mixed_or": Rule(rule="(@Modality@ == 'CT') or (@StationName@ == 'MR1')"),
+        "disabled": Rule(rule="@Modality@ == 'MR'", disabled="True"),
+        "fallback": Rule(rule="False", fallback="True"),
+    }
+    index = rule_evaluation.get_rule_index(rules, 1)
+    compiled = rule_evaluation.get_compiled_rules(rules, 1)
+    assert index.fallback_rule == "fallback"
+    assert compiled["t2"].required_values is None
+    assert compiled["mr_station"].required_values == ("Modality", frozenset(["MR"]))
+    assert compiled["station_or"].required_values == ("StationName", frozenset(["MR1", "CT1"]))
+
+    for tags in [
+        {"Modality": "MR", "StationName": "MR1", "SeriesDescription": "AX T2"},
+        {"Modality": "CT", "StationName": "CT1", "SeriesDescription": "AX"},
+        {"Modality": "US", "StationName": "US1", "SeriesDescription": "T2"},
+        {"SeriesDescription": "AX"},
+    ]:
+        candidates = index.get_candidates(tags)
+        assert candidates == [name for name in rules if name in candidates]
+        triggered = [name for name in rules if name != "disabled" and compiled[name].evaluate(tags)]
+        assert set(triggered) <= set(candidates)
+
+    assert index.get_candidates({"Modality": "MR", "StationName": "US1", "SeriesDescription": ""}) == [
+        "mr",
+        "t2",
+        "mr_station",
+        "mixed_or",
+        "fallback",
+    ]
+
+
+def test_route_series_parallel(fs, mocker):
+    """Checks that multiple series are routed when using several routing workers."""
+    load_config(
+        fs,
+        {
+            "router_workers": 4,
+            "rules": {"catchall": {"rule": "True", "target": "test_target", "action": "route"}},
+        },
+    )
+    mocker.patch("router.route_series", new=mocker.spy(router, "route_series"))
+
+    uids = [f"SERIES{i}" for i in range(8)]
+    for uid in uids:
+        fs.create_file(f"/var/incoming/{uid}#bar.dcm", contents="asdfasdfafd")
+        fs.create_file(f"/var/incoming/{uid}#bar.tags", contents="{}")
+
+    # The router doesn't wait for the routing workers and submits at most one series per worker, so the remaining
+    # series are picked up during the next runs
+    deadline = time.time() + 10
+    router.run_router()
+    while time.time() < deadline:
+        while router.active_series and time.time() < deadline:
+            time.sleep(0.01)
+        if not list(Path("/var/incoming").iterdir()):
+            break
+        router.run_router()
+
+    assert router.route_series.call_count == len(uids)  # type: ignore
+    assert len(list(Path("/var/outgoing").iterdir())) == len(uids)
+    assert [k.name for k in Path("/var/incoming").iterdir()] == []
+
+
+def test_route_parallel_skips_active_series(mocker):
+    """Checks that the router doesn't wait for the routing workers and doesn't submit a series that is still being
+    routed or more series than workers."""
+    import threading
+
+    release = threading.Event()
+    route = mocker.patch("router.route_complete_series", side_effect=lambda *args: release.wait(10))
+
+    router.route_parallel(2, {"SERIESA": ["SERIESA#one"]})
+    router.route_parallel(2, {"SERIESA": ["SERIESA#one"], "SERIESB": ["SERIESB#one"], "SERIESC": ["SERIESC#one"]})
+    # No more series than workers are submitted
+    assert router.active_series == {"SERIESA", "SERIESB"}
+
+    release.set()
+    deadline = time.time() + 10
+    while router.active_series and time.time() < deadline:
+        time.sleep(0.01)
+    assert route.call_count == 2
+
+
+def test_route_complete_series_terminated(mocker):
+    """Checks that series still waiting for a routing worker are not routed after termination has been requested."""
+    route = mocker.patch("router.route_series")
+    mocker.patch("router.helper.is_terminated", return_value=True)
+    router.route_complete_series("SERIESA", ["SERIESA#one"])
+    route.assert_not_called()
+
+
+def test_route_series_multiple_targets(fs, mocker):
+    """Checks that a series triggering multiple rules is linked into every outgoing folder."""
+    load_config(
+        fs,
+        {
+            "targets": {
+                "target_a": {"ip": "", "port": "", "aet_target": ""},
+                "target_b": {"ip": "", "port": "", "aet_target": ""},
+            },
+            "rules": {
+                "rule_a": {"rule": "True", "target": "target_a", "action": "route"},
+                "rule_b": {"rule": "True", "target": "target_b", "action": "route"},
+            },
+        },
+    )
+
+    uid = "UIDUIDUID"
+    fs.create_file(f"/var/incoming/{uid}#bar.dcm", contents="asdfasdfafd")
+    fs.create_file(f"/var/incoming/{uid}#bar.tags", contents="{}")
+
+    router.run_router()
+
+    out_folders = list(Path("/var/outgoing").iterdir())
+    assert len(out_folders) == 2
+    for folder in out_folders:
+        assert (folder / f"{uid}#bar.dcm").read_text() == "asdfasdfafd"
+        assert (folder / f"{uid}#bar.tags").read_text() == "{}"
+    assert [k.name for k in Path("/var/incoming").iterdir()] == []
+
+
+def test_route_series_folder(fs, mocker):
+    """Checks that a series stored in its own subfolder of incoming is moved as a whole."""
+    load_config(
+        fs,
+        {
+            "incoming_series_folders": True,
+            "rules": {"catchall": {"rule": "True", "target": "test_target", "action": "route"}},
+        },
+    )
+    mocker.patch("router.route_series", new=mocker.spy(router, "route_series"))
+    rename = mocker.spy(os, "rename")
+
+    uid = "UIDUIDUID"
+    fs.create_file(f"/var/incoming/{uid}/{uid}#one.dcm", contents="asdfasdfafd")
+    fs.create_file(f"/var/incoming/{uid}/{uid}#one.tags", contents="{}")
+    fs.create_file(f"/var/incoming/{uid}/{uid}#two.dcm", contents="asdfasdfafd")
+    fs.create_file(f"/var/incoming/{uid}/{uid}#two.tags", contents="{}")
+
+    router.run_router()
+
+    router.route_series.assert_called_once_with(uid, [f"{uid}/{uid}#one", f"{uid}/{uid}#two"])  # type: ignore
+    out_folders = list(Path("/var/outgoing").iterdir())
+    assert len(out_folders) == 1
+    rename.assert_any_call(Path(f"/var/incoming/{uid}"), str(out_folders[0]))
+    assert sorted(k.name for k in out_folders[0].iterdir()) == sorted(
+        [mercure_names.TASKFILE, f"{uid}#one.dcm", f"{uid}#one.tags", f"{uid}#two.dcm", f"{uid}#two.tags"]
+    )
+    assert [k.name for k in Path("/var/incoming").iterdir()] == []
+    assert router.incoming_index.series_count() == 0
+
+
+def test_route_series_folder_new_files(fs, mocker):
+    """Checks that a series folder is not moved as a whole if further files have arrived after the file list was
+    taken, so that these files remain in the incoming folder."""
+    load_config(
+        fs,
+        {
+            "incoming_series_folders": True,
+            "rules": {"catchall": {"rule": "True", "target": "test_target", "action": "route"}},
+        },
+    )
+
+    uid = "UIDUIDUID"
+    fs.create_file(f"/var/incoming/{uid}/{uid}#one.dcm", contents="asdfasdfafd")
+    fs.create_file(f"/var/incoming/{uid}/{uid}#one.tags", contents="{}")
+    # DICOM file whose tags file has not been written yet
+    fs.create_file(f"/var/incoming/{uid}/{uid}#two.dcm", contents="asdfasdfafd")
+
+    routing.route_series.route_series(uid, [f"{uid}/{uid}#one"])
+
+    out_folders = list(Path("/var/outgoing").iterdir())
+    assert len(out_folders) == 1
+    assert sorted(k.name for k in out_folders[0].iterdir()) == sorted(
+        [mercure_names.TASKFILE, f"{uid}#one.dcm", f"{uid}#one.tags"]
+    )
+    assert [k.name for k in Path(f"/var/incoming/{uid}").iterdir()] == [f"{uid}#two.dcm"]
+
+
+def test_route_study_forcecomplete(fs, mocker):
+    """Checks that buffered studies are tracked by the study index and that studies are force-completed if the
+    required series don't arrive."""
+    from routing.study_index import study_index
+
+    load_config(
+        fs,
+        {
+            "study_complete_trigger": 3600,
+            "study_forcecomplete_trigger": 3600,
+            "rules": {
+                "study": {
+                    "rule": "True",
+                    "target": "test_target",
+                    "action": "route",
+                    "action_trigger": "study",
+                    "study_trigger_condition": "received_series",
+                    "study_trigger_series": "'MISSING SERIES'",
+                }
+            },
+        },
+    )
+
+    uid = "UIDUIDUID"
+    tags = {"SeriesInstanceUID": uid, "StudyInstanceUID": "STUDYUID", "SeriesDescription": "AX T1"}
+    fs.create_file(f"/var/incoming/{uid}#bar.dcm", contents="asdfasdfafd")
+    fs.create_file(f"/var/incoming/{uid}#bar.tags", contents=json.dumps(tags))
+
+    router.run_router()
+
+    assert [k.name for k in Path("/var/studies").iterdir()] == ["STUDYUID#study"]
+    assert study_index.studies["STUDYUID#study"].received_series == ["AX T1"]
+    assert study_index.get_due_studies() == []
+    assert study_index.get_due_studies(time.time() + 3601) == ["STUDYUID#study"]
+
+    config.mercure = Config(**{**config.mercure.dict(), "study_forcecomplete_trigger": 0})
+    config.save_config()
+    router.run_router()
+
+    assert list(Path("/var/studies").iterdir()) == []
+    assert len(list(Path("/var/outgoing").iterdir())) == 1
+    assert "STUDYUID#study" not in study_index.studies
+
+
+def test_route_series_bulk_register(fs, mocker):
+    """Checks that the received files of a series are registered on the bookkeeper with one event."""
+    load_config(
+        fs,
+        {
+            "bookkeeper_bulk_register": True,
+            "rules": {"catchall": {"rule": "True", "target": "test_target", "action": "route"}},
+        },
+    )
+    register = mocker.patch("common.monitor.send_register_instances")
+
+    uid = "UIDUIDUID"
+    for name, sop_uid in (("one", "SOP1"), ("two", "SOP2")):
+        fs.create_file(f"/var/incoming/{uid}#{name}.dcm", contents="asdfasdfafd")
+        fs.create_file(f"/var/incoming/{uid}#{name}.tags", contents=json.dumps({"SOPInstanceUID": sop_uid}))
+
+    router.run_router()
+
+    register.assert_called_once()
+    series_uid, instances = register.call_args[0]
+    assert series_uid == uid
+    assert sorted(instances, key=lambda x: x["filename"]) == [
+        {"filename": f"{uid}#one", "file_uid": "SOP1"},
+        {"filename": f"{uid}#two", "file_uid": "SOP2"},
+    ]
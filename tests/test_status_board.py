@@ -0,0 +1,66 @@
+"""
+test_status_board.py
+====================
+"""
+import json
+from pathlib import Path
+
+import common.status_board as status_board
+from testing_common import load_config
+
+
+def create_job(fs, name: str, acc: str) -> None:
+    task = {
+        "info": {
+            "action": "process",
+            "uid": name,
+            "uid_type": "series",
+            "triggered_rules": {"catchall": True},
+            "applied_rule": "catchall",
+            "mrn": "MRN_" + acc,
+            "acc": acc,
+            "mercure_version": "",
+            "mercure_appliance": "",
+            "mercure_server": "",
+        },
+        "process": {"module_name": "test_module", "module_config": {}},
+    }
+    fs.create_file(f"/var/processing/{name}/task.json", contents=json.dumps(task))
+
+
+def test_status_board(fs, mocker):
+    # The SQLite file is not part of the fake filesystem, so use an in-memory database
+    load_config(fs, {"status_board": ":memory:"})
+    status_board.connection = None
+    for index in range(3):
+        create_job(fs, f"job_{index}", f"ACC{index}")
+    states = {f"job_{index}": False for index in range(3)}
+    describe = mocker.Mock(
+        side_effect=lambda name: status_board.describe_processing_job(Path("/var/processing") / name)
+    )
+
+    # No data is available before the queue has been published
+    assert status_board.read_jobs("processing") is None
+
+    publisher = status_board.QueuePublisher("processing")
+    publisher.publish(states, describe)
+    total, jobs = status_board.read_jobs("processing", offset=1, limit=1)  # type: ignore
+    assert total == 3
+    assert jobs == {"job_1": {"Module": "test_module", "ACC": "ACC1", "MRN": "MRN_ACC1", "Status": "Queued", "Scope": "Series"}}
+    assert status_board.read_jobs("processing", search="acc2")[0] == 1  # type: ignore
+    assert describe.call_count == 3
+
+    # Unchanged jobs are neither described nor written again
+    publisher.publish(states, describe)
+    assert describe.call_count == 3
+
+    # Only jobs whose state has changed are described again
+    (Path("/var/processing/job_2/.processing")).touch()
+    fs.create_file("/var/processing/job_2/in/task.json", contents=Path("/var/processing/job_2/task.json").read_text())
+    publisher.publish({"job_1": False, "job_2": True}, describe)
+
+    assert describe.call_count == 4
+    total, jobs = status_board.read_jobs("processing")  # type: ignore
+    assert total == 2
+    assert jobs["job_1"]["Status"] == "Queued"
+    assert jobs["job_2"]["Status"] == "Processing"
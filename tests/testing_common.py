@@ -8,6 +8,8 @@ def load_config(fs, extra) -> Config:
     fs.add_real_file(config_path, target_path=config.configuration_filename, read_only=False)
     for k in ["incoming", "studies", "outgoing", "success", "error", "discard", "processing"]:
         fs.create_dir(f"/var/{k}")
+    # Force reading the configuration file, as the previous test might have loaded a file with the same timestamp
+    config.configuration_timestamp = 0
     config.read_config()
     config.mercure = Config(**{**config.mercure.dict(), **extra})  #   # type: ignore
     config.save_config()
@@ -659,6 +659,7 @@ def main(args=sys.argv[1:]) -> None:
     try:
         services.read_services()
         config.read_config()
+        config.start_watcher()
         users.read_users()
         if str(SECRET_KEY) == "PutSomethingRandomHere":
             logger.error("You need to change the SECRET_KEY in configuration/webgui.env")
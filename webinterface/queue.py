@@ -5,9 +5,8 @@ Queue page for the graphical user interface of mercure.
 """
 
 # Standard python includes
-import os
 from pathlib import Path
-import json
+from typing import Optional
 import daiquiri
 
 # Starlette-related includes
@@ -17,10 +16,10 @@ from starlette.authentication import requires
 
 # App-specific includes
 import common.config as config
-from common.constants import mercure_defs, mercure_names, mercure_options
+import common.status_board as status_board
+from common.constants import mercure_defs, mercure_names
 from webinterface.common import get_user_information
 from webinterface.common import templates
-from common.types import Task
 
 
 logger = daiquiri.getLogger("queue")
@@ -66,6 +65,39 @@ async def show_queues(request):
     return templates.TemplateResponse(template, context)
 
 
+def get_jobs(request, queue: str) -> JSONResponse:
+    """
+    Returns the jobs of the given queue, preferably from the status board published by the services. Supports paging
+    (offset and limit) and filtering (search) via query parameters. The total number of matching jobs is returned in
+    the X-Total-Count header.
+    """
+    try:
+        offset = max(0, int(request.query_params.get("offset", 0)))
+        limit: Optional[int] = int(request.query_params["limit"]) if "limit" in request.query_params else None
+    except ValueError:
+        return PlainTextResponse("Invalid paging parameters", status_code=400)
+    search = request.query_params.get("search", "")
+
+    result = None
+    try:
+        result = status_board.read_jobs(queue, offset, limit, search)
+    except Exception:
+        logger.exception("Unable to read status board")
+
+    if result is None:
+        jobs = status_board.scan_queue(queue)
+        if search:
+            jobs = {
+                name: job for name, job in jobs.items() if search.lower() in status_board.get_search_text(name, job)
+            }
+        names = sorted(jobs)
+        page = names[offset : offset + limit if limit is not None else None]
+        result = (len(names), {name: jobs[name] for name in page})
+
+    total, job_list = result
+    return JSONResponse(job_list, headers={"X-Total-Count": str(total)})
+
+
 @queue_app.route("/jobs/processing", methods=["GET"])
 @requires("authenticated", redirect="login")
 async def show_jobs_processing(request):
@@ -74,51 +106,7 @@ async def show_jobs_processing(request):
     except:
         return PlainTextResponse("Configuration is being updated. Try again in a minute.")
 
-    job_list = {}
-    for entry in os.scandir(config.mercure.processing_folder):
-        if entry.is_dir():
-            job_module = ""
-            job_acc = ""
-            job_mrn = ""
-            job_scope = "Series"
-            job_status = "Queued"
-
-            processing_file = Path(entry.path) / mercure_names.PROCESSING
-            task_file = Path(entry.path) / mercure_names.TASKFILE
-            if processing_file.exists():
-                job_status = "Processing"
-                task_file = Path(entry.path) / "in" / mercure_names.TASKFILE
-            else:
-                pass
-
-            try:
-                with open(task_file, "r") as f:
-                    task: Task = Task(**json.load(f))
-                    if task.process and task.process.module_name:
-                        job_module = task.process.module_name
-                    job_acc = task.info.acc
-                    job_mrn = task.info.mrn
-                    if task.info.uid_type=="series":
-                        job_scope = "Series"
-                    else:
-                        job_scope = "Study"
-            except Exception as e:
-                logger.exception(e)
-                job_module = "Error"
-                job_acc = "Error"
-                job_mrn = "Error"
-                job_scope = "Error"
-                job_status = "Error"
-
-            job_list[entry.name] = {
-                "Module": job_module,
-                "ACC": job_acc,
-                "MRN": job_mrn,
-                "Status": job_status,
-                "Scope": job_scope,
-            }
-
-    return JSONResponse(job_list)
+    return get_jobs(request, "processing")
 
 
 @queue_app.route("/jobs/routing", methods=["GET"])
@@ -129,45 +117,7 @@ async def show_jobs_routing(request):
     except:
         return PlainTextResponse("Configuration is being updated. Try again in a minute.")
 
-    job_list = {}
-    for entry in os.scandir(config.mercure.outgoing_folder):
-        if entry.is_dir():
-            job_target = ""
-            job_acc = ""
-            job_mrn = ""
-            job_scope = "Series"
-            job_status = "Queued"
-
-            task_file = Path(entry.path) / mercure_names.TASKFILE
-
-            try:
-                with open(task_file, "r") as f:
-                    task: Task = Task(**json.load(f))
-                    if task.dispatch and task.dispatch.target_name:
-                        job_target = task.dispatch.target_name
-                    job_acc = task.info.acc
-                    job_mrn = task.info.mrn
-                    if task.info.uid_type=="series":
-                        job_scope = "Series"
-                    else:
-                        job_scope = "Study"
-            except Exception as e:
-                logger.exception(e)
-                job_target = "Error"
-                job_acc = "Error"
-                job_mrn = "Error"
-                job_scope = "Error"
-                job_status = "Error"                
-
-            job_list[entry.name] = {
-                "Target": job_target,
-                "ACC": job_acc,
-                "MRN": job_mrn,
-                "Status": job_status,
-                "Scope": job_scope,
-            }
-
-    return JSONResponse(job_list)
+    return get_jobs(request, "routing")
 
 
 @queue_app.route("/jobs/studies", methods=["GET"])
@@ -178,57 +128,7 @@ async def show_jobs_studies(request):
     except:
         return PlainTextResponse("Configuration is being updated. Try again in a minute.")
 
-    job_list = {}
-    for entry in os.scandir(config.mercure.studies_folder):
-        if entry.is_dir():
-            job_uid = ""
-            job_rule = ""
-            job_acc = ""
-            job_mrn = ""
-            job_completion = "Timeout"
-            job_created = ""
-            job_series = 0
-
-            task_file = Path(entry.path) / mercure_names.TASKFILE
-
-            try:
-                with open(task_file, "r") as f:
-                    task: Task = Task(**json.load(f))
-                    if (not task.study) or (not task.info):
-                        raise Exception()
-                    job_uid = task.info.uid
-                    if task.info.applied_rule:
-                        job_rule = task.info.applied_rule
-                    job_acc = task.info.acc
-                    job_mrn = task.info.mrn
-                    if task.study.complete_force == "True":
-                        job_completion = "Force"
-                    else:
-                        if task.study.complete_trigger == "received_series":
-                            job_completion = "Series"
-                    job_created = task.study.creation_time
-                    if task.study.received_series:
-                        job_series = len(task.study.received_series)
-            except Exception as e:
-                logger.exception(e)
-                job_uid = "Error"
-                job_rule = "Error"
-                job_acc = "Error"
-                job_mrn = "Error"
-                job_completion = "Error"
-                job_created = "Error"
-
-            job_list[entry.name] = {
-                "UID": job_uid,
-                "Rule": job_rule,
-                "ACC": job_acc,
-                "MRN": job_mrn,
-                "Completion": job_completion,
-                "Created": job_created,
-                "Series": job_series,
-            }
-
-    return JSONResponse(job_list)
+    return get_jobs(request, "studies")
 
 
 @queue_app.route("/status", methods=["GET"])
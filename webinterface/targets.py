@@ -8,7 +8,8 @@ Targets page for the graphical user interface of mercure.
 import json
 import logging
 import daiquiri
-from typing import Union
+from datetime import datetime
+from typing import Any, Dict, Union
 
 # Starlette-related includes
 from starlette.applications import Starlette
@@ -18,6 +19,7 @@ from starlette.authentication import requires
 # App-specific includes
 import common.config as config
 import common.monitor as monitor
+import common.target_health as target_health
 from common.constants import mercure_defs
 from common.types import DicomTarget, SftpTarget, Target
 from webinterface.common import *
@@ -35,6 +37,27 @@ logger = daiquiri.getLogger("targets")
 targets_app = Starlette()
 
 
+def describe_health(health: Dict[str, Any]) -> Dict[str, str]:
+    """Converts the health of a target, as stored by the dispatcher, into the texts shown on the targets page."""
+    if not health:
+        return {"status": "unknown", "text": "No transfers yet", "latency": ""}
+
+    latency = []
+    if health.get("echo_latency") is not None:
+        latency.append(f"C-Echo {health['echo_latency'] * 1000:.0f} ms")
+    if health.get("transfer_time") is not None:
+        latency.append(f"last transfer {health['transfer_time']:.1f} s")
+
+    if health.get("unavailable_since"):
+        since = datetime.fromtimestamp(health["unavailable_since"]).strftime("%Y-%m-%d %H:%M:%S")
+        text = f"Unavailable since {since} ({health.get('last_error', '')})"
+        return {"status": "unavailable", "text": text, "latency": ", ".join(latency)}
+    if health.get("failures"):
+        text = f"{health['failures']} failed transfers ({health.get('last_error', '')})"
+        return {"status": "failing", "text": text, "latency": ", ".join(latency)}
+    return {"status": "healthy", "text": "Healthy", "latency": ", ".join(latency)}
+
+
 @targets_app.route("/", methods=["GET"])
 @requires("authenticated", redirect="login")
 async def show_targets(request) -> Response:
@@ -49,6 +72,9 @@ async def show_targets(request) -> Response:
         used_target = config.mercure.rules[rule].get("target", "NONE")
         used_targets[used_target] = rule
 
+    stored_health = target_health.read_health(config.mercure.outgoing_folder)
+    health = {target: describe_health(stored_health.get(target, {})) for target in config.mercure.targets}
+
     template = "targets.html"
     context = {
         "request": request,
@@ -56,6 +82,7 @@ async def show_targets(request) -> Response:
         "page": "targets",
         "targets": config.mercure.targets,
         "used_targets": used_targets,
+        "health": health,
     }
     context.update(get_user_information(request))
     return templates.TemplateResponse(template, context)
@@ -140,6 +167,10 @@ async def targets_edit_post(request) -> Union[RedirectResponse, PlainTextRespons
 
     config.mercure.targets[edittarget].contact = form["contact"]
     config.mercure.targets[edittarget].comment = form["comment"]
+    try:
+        config.mercure.targets[edittarget].max_parallel_transfers = max(1, int(form.get("max_parallel_transfers", 1)))
+    except ValueError:
+        config.mercure.targets[edittarget].max_parallel_transfers = 1
 
     try:
         config.save_config()